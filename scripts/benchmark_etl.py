@@ -0,0 +1,294 @@
+import sys
+import os
+import io
+import json
+import math
+import time
+import shutil
+import tempfile
+import asyncio
+import argparse
+import datetime
+import contextlib
+import pandas as pd
+
+# The benchmark runs against a temporary outputs folder, the real one is never touched.
+os.environ["GEO_OUTPUTS_DIR"] = tempfile.mkdtemp(prefix="geo-benchmark-")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.config import (
+    OUTPUTS_DIR,
+    OUTPUT_FORMAT,
+    HTTP_RATE_LIMIT,
+    MAX_WORKERS,
+    MERGE_WORKERS,
+)
+from src.client.geo_client import GEO_Client, map_service_dict, name_dict
+from src.client.async_geo_client import AsyncGEO_Client
+from src.client.http import HttpClient
+from src.client.session_cache import SessionCache
+from src.final_tables import merge_and_parse_files_final
+from src.writers import read_table, table_extension
+from src.telemetry import telemetry
+from mock_arcgis_server import MockServer, build_layers, default_aliases
+import warnings
+
+warnings.filterwarnings("ignore")
+
+# Stages timed by every run of the scenario, in order.
+stages = [
+    "log_in",
+    "get_available_layers",
+    "get_all_attributes",
+    "get_all_features",
+    "merge_and_parse_files_final",
+    "get_new_features",
+    "merge_and_parse_files_final_incremental",
+]
+
+
+def new_client(server: MockServer, rate: float, async_client: bool = False):
+    """
+    GEO_Client (AsyncGEO_Client if async_client) pointing to the mock server, caching its session in the temporary outputs folder.
+    """
+    client_class = AsyncGEO_Client if async_client else GEO_Client
+    geo_client = client_class(**server.client_kwargs())
+    geo_client.session_cache = SessionCache(os.path.join(OUTPUTS_DIR, ".geo_session"))
+    geo_client._load_session()
+    geo_client.transport = HttpClient(rate=rate)
+    return geo_client
+
+
+def check_final_tables(server: MockServer, output_format: str = OUTPUT_FORMAT):
+    """
+    Make sure every final table has as many rows as its layer has features on the server.
+    """
+    for map_service, layer in server.layers():
+        path = os.path.join(
+            OUTPUTS_DIR,
+            name_dict[map_service_dict[map_service]],
+            "final",
+            f"{layer.name}{table_extension(output_format)}",
+        )
+        rows = len(read_table(path, columns=["OBJECTID"]))
+        if rows != layer.count():
+            raise AssertionError(
+                f"{map_service}, {layer.name}: {rows} rows in the final table, {layer.count()} on the server"
+            )
+
+
+def run_stage(geo_client: GEO_Client, func, *args, **kwargs):
+    """
+    Call func, running it in its own event loop with the pooled session of geo_client open if it is a coroutine function (AsyncGEO_Client).
+    """
+    if not asyncio.iscoroutinefunction(func):
+        return func(*args, **kwargs)
+
+    async def stage():
+        await geo_client.open()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            await geo_client.close()
+
+    return asyncio.run(stage())
+
+
+def run_scenario(args):
+    """
+    Log in, list the layers, fetch every attribute and feature and build the final tables from an empty outputs folder,
+    then edit, add and delete features on the server and run the incremental sync and the merge again.
+
+    Returns:
+        seconds (dict): Seconds taken by every stage.
+        server (MockServer): Server the scenario ran against, to read its request count.
+    """
+    for entry in os.listdir(OUTPUTS_DIR):
+        shutil.rmtree(os.path.join(OUTPUTS_DIR, entry), ignore_errors=True)
+    telemetry.reset()
+    seconds = {}
+    log = io.StringIO()
+
+    def timed(stage, func, *func_args, **kwargs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+            run_stage(geo_client, func, *func_args, **kwargs)
+        seconds[stage] = time.perf_counter() - start
+
+    services = build_layers(
+        scale=args.scale,
+        max_record_count=args.max_record_count,
+        latency=args.latency,
+        feature_latency=args.feature_latency,
+    )
+    with MockServer(services, default_aliases, latency=args.latency) as server:
+        geo_client = new_client(server, args.rate, args.async_client)
+        timed("log_in", geo_client.log_in)
+        timed("get_available_layers", geo_client.get_available_layers)
+        timed("get_all_attributes", geo_client.get_all_attributes)
+        fused = {"fused": True} if args.fused else {}
+        timed(
+            "get_all_features",
+            geo_client.get_all_features,
+            max_workers=args.max_workers,
+            **fused,
+        )
+        timed(
+            "merge_and_parse_files_final",
+            merge_and_parse_files_final,
+            max_workers=args.merge_workers,
+            output_format=geo_client.output_format,
+        )
+        check_final_tables(server, geo_client.output_format)
+
+        for layer in {id(layer): layer for _, layer in server.layers()}.values():
+            count = layer.count()
+            layer.mutate(
+                edited=math.ceil(count * args.edited),
+                added=math.ceil(count * args.added),
+                deleted=math.ceil(count * args.deleted),
+            )
+        # A new client, like the next scheduled run: it reads the manifest and reuses the cached session.
+        geo_client = new_client(server, args.rate, args.async_client)
+        timed("get_new_features", geo_client.get_new_features, max_workers=args.max_workers)
+        timed(
+            "merge_and_parse_files_final_incremental",
+            merge_and_parse_files_final,
+            max_workers=args.merge_workers,
+            output_format=geo_client.output_format,
+        )
+        check_final_tables(server, geo_client.output_format)
+    return seconds, server
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_seconds: float):
+    """
+    Compare the stages with those of a baseline results file.
+
+    Returns:
+        comparison (pd.DataFrame): seconds, baseline, change and regression per stage.
+    """
+    comparison = pd.DataFrame(
+        {
+            "seconds": pd.Series(results["stages"]),
+            "baseline": pd.Series((baseline or {}).get("stages", {}), dtype=float),
+        }
+    ).reindex(stages)
+    comparison["change"] = comparison["seconds"] / comparison["baseline"] - 1
+    # Stages that take a few milliseconds are too noisy to fail on their relative change alone.
+    comparison["regression"] = (comparison["change"] > tolerance) & (
+        comparison["seconds"] - comparison["baseline"] > min_seconds
+    )
+    return comparison
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the log in, layer listing, full and incremental extraction and merge against a local mock ArcGIS / Geocortex server."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplies the number of features of every synthetic layer (about 48k features at 1).",
+    )
+    parser.add_argument(
+        "--max-record-count", type=int, default=2000, help="maxRecordCount of every layer."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds every request waits before answering."
+    )
+    parser.add_argument(
+        "--feature-latency",
+        type=float,
+        default=0.0,
+        help="Extra seconds per feature returned by a query.",
+    )
+    parser.add_argument(
+        "--edited",
+        type=float,
+        default=0.01,
+        help="Share of the features of every layer edited before the incremental sync.",
+    )
+    parser.add_argument(
+        "--added", type=float, default=0.005, help="Share of features added before the incremental sync."
+    )
+    parser.add_argument(
+        "--deleted", type=float, default=0.005, help="Share of features deleted before the incremental sync."
+    )
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--merge-workers", type=int, default=MERGE_WORKERS)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=HTTP_RATE_LIMIT,
+        help="Requests per second of the request layer, so the client and not its rate limit is measured.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs of the scenario, the fastest time of every stage is kept."
+    )
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Results JSON of a previous run. Exits with status 1 if a stage is slower than it by more than --tolerance.",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.05,
+        help="Slowdowns shorter than this are never regressions.",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Build the final tables in get_all_features (fused pipeline), the first merge then has nothing left to do.",
+    )
+    parser.add_argument(
+        "--async-client",
+        action="store_true",
+        help="Run the scenario with AsyncGEO_Client instead of GEO_Client.",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the client.")
+    args = parser.parse_args()
+
+    try:
+        best = {}
+        for run in range(args.repeat):
+            seconds, server = run_scenario(args)
+            for stage, value in seconds.items():
+                best[stage] = min(best.get(stage, value), value)
+            print(
+                f"Run {run + 1}/{args.repeat}: {sum(seconds.values()):.2f} s, {server.requests} requests"
+            )
+        results = {
+            "date": datetime.datetime.now().strftime("%Y-%m-%d %X"),
+            "options": vars(args),
+            "features": sum(
+                layer.count()
+                for layer in {id(layer): layer for _, layer in server.layers()}.values()
+            ),
+            "requests": server.requests,
+            "stages": {stage: round(value, 4) for stage, value in best.items()},
+            "telemetry": telemetry.report(spans=False),
+        }
+    finally:
+        shutil.rmtree(OUTPUTS_DIR, ignore_errors=True)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    comparison = compare(results, baseline, args.tolerance, args.min_seconds)
+    print(comparison.to_string(float_format=lambda value: f"{value:.3f}"))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, default=str)
+        print(f"Results: {args.output}")
+
+    if comparison["regression"].any():
+        print(f"Regressions: {comparison.index[comparison['regression']].tolist()}")
+        sys.exit(1)
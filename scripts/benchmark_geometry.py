@@ -0,0 +1,107 @@
+import sys
+import os
+import ast
+import time
+import argparse
+import pandas as pd
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.config import OUTPUTS_DIR
+from src.geometry import add_geometry_columns
+from src.writers import read_table
+
+
+def legacy_geometry_columns(df: pd.DataFrame, column: str):
+    """
+    Geometry decoding as it was done in merge_and_parse_files_final before the vectorised decoder.
+    """
+    indices = df[~df[column].isna()].index
+    df.loc[indices, column] = df.loc[indices, column].apply(
+        lambda x: ast.literal_eval(x) if isinstance(x, str) else x
+    )
+    df.loc[indices, "x"] = df.loc[indices, column].apply(
+        lambda x: (
+            (np.sum([coord[0] for coord in x[0]]) / len([coord[0] for coord in x[0]]))
+            if len(x) != 0
+            else np.nan
+        )
+    )
+    df.loc[indices, "y"] = df.loc[indices, column].apply(
+        lambda x: (
+            (np.sum([coord[1] for coord in x[0]]) / len([coord[1] for coord in x[0]]))
+            if len(x) != 0
+            else np.nan
+        )
+    )
+
+
+def synthetic_layer(features: int, vertices: int, rings: int = 2, seed: int = 0):
+    """
+    Polygon layer with stringified rings, like the features CSV files.
+    """
+    rng = np.random.default_rng(seed)
+    values = []
+    for _ in range(features):
+        centre = rng.uniform(-70, -50, size=2)
+        polygon = []
+        for _ in range(rings):
+            angles = np.linspace(0, 2 * np.pi, vertices)
+            ring = centre + 0.1 * np.c_[np.cos(angles), np.sin(angles)]
+            polygon.append(ring.round(8).tolist())
+        values.append(str(polygon))
+    return pd.DataFrame({"rings": values})
+
+
+def timed(func, df: pd.DataFrame, column: str, repeat: int):
+    best = np.inf
+    for _ in range(repeat):
+        copy = df.copy()
+        start = time.perf_counter()
+        func(copy, column)
+        best = min(best, time.perf_counter() - start)
+    return best, copy
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the vectorised geometry decoding against the previous per-row implementation."
+    )
+    parser.add_argument(
+        "file",
+        nargs="?",
+        default=os.path.join(OUTPUTS_DIR, "landbase", "features", "bordes.csv"),
+        help="Features file of a polygon / polyline layer. Defaults to the landbase bordes layer.",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=None,
+        help="Benchmark a synthetic polygon layer with this many features instead of a file.",
+    )
+    parser.add_argument("--vertices", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        df = synthetic_layer(args.synthetic, args.vertices)
+        source = f"synthetic ({args.synthetic} features x {args.vertices} vertices)"
+    else:
+        df = read_table(args.file)
+        df.columns = df.columns.str.replace("geometry.", "")
+        source = args.file
+    column = "rings" if "rings" in df.columns else "paths"
+
+    legacy_time, legacy = timed(legacy_geometry_columns, df, column, args.repeat)
+    vectorised_time, vectorised = timed(add_geometry_columns, df, column, args.repeat)
+
+    same = np.allclose(
+        legacy[["x", "y"]].astype(float),
+        vectorised[["x", "y"]].astype(float),
+        equal_nan=True,
+    )
+    print(f"Layer: {source}, {len(df)} rows, column {column}")
+    print(f"Per-row literal_eval + lambdas: {legacy_time:.3f}s")
+    print(f"Vectorised decoding (+ bounding boxes): {vectorised_time:.3f}s")
+    print(f"Speed-up: {legacy_time / vectorised_time:.1f}x, same centroids: {same}")
@@ -0,0 +1,676 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import struct
+import asyncio
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+# Map services of the default scenario: {map_service: [(name, geometryType, features, vertices), ...]}.
+# 0 and 6 both save to the "provincia" folder, so their layer names must not collide.
+default_layers = {
+    0: [
+        ("postes", "esriGeometryPoint", 20000, 1),
+        ("lineas_media_tension", "esriGeometryPolyline", 5000, 16),
+    ],
+    1: [("parcelas", "esriGeometryPolygon", 5000, 32)],
+    2: [
+        ("bordes", "esriGeometryPolygon", 24, 256),
+        ("transformadores", "esriGeometryPoint", 3000, 1),
+    ],
+    3: [("calles", "esriGeometryPolyline", 5000, 8)],
+    6: [("medidores", "esriGeometryPoint", 10000, 1)],
+}
+
+# Map services serving the same layers as another one, like on the real server ({alias: map_service}).
+default_aliases = {7: 1, 8: 0}
+
+# Coded values of the TIPO field of every synthetic layer.
+tipo_domain = {1: "Aereo", 2: "Subterraneo", 3: "Mixto"}
+
+# Extent of the synthetic features, EPSG:4326.
+default_extent = (-73.5, -55.0, -53.6, -21.8)
+
+
+class SyntheticLayer:
+    """
+    Feature layer with n random features (OBJECTID, DATEMODIFIED, TIPO with a coded-value domain, NOMBRE and a geometry),
+    answering layer definitions and /query requests like an ArcGIS MapServer layer.
+
+    Usage:
+        layer = SyntheticLayer(0, "postes", "esriGeometryPoint", features=20000)
+        layer.query({"where": "1=1", "returnIdsOnly": "true"})
+        layer.mutate(edited=100, added=50, deleted=50)
+    """
+
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        geometry_type: str = "esriGeometryPoint",
+        features: int = 1000,
+        vertices: int = 1,
+        max_record_count: int = 2000,
+        latency: float = 0.0,
+        feature_latency: float = 0.0,
+        extent: tuple = default_extent,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            id (int): Id of the layer in its MapServer.
+            name (str): Name of the layer.
+            geometry_type (str, optional): esriGeometryPoint, esriGeometryPolyline or esriGeometryPolygon. Defaults to "esriGeometryPoint".
+            features (int, optional): Number of features. Defaults to 1000.
+            vertices (int, optional): Vertices per ring / path. Defaults to 1.
+            max_record_count (int, optional): Most features returned by a query page. Defaults to 2000.
+            latency (float, optional): Seconds every request to the layer waits before answering. Defaults to 0.0.
+            feature_latency (float, optional): Extra seconds per feature returned. Defaults to 0.0.
+            extent (tuple, optional): (xmin, ymin, xmax, ymax) of the features in EPSG:4326. Defaults to default_extent.
+            seed (int, optional): Seed of the random features. Defaults to 0.
+        """
+        self.id = id
+        self.name = name
+        self.geometry_type = geometry_type
+        self.vertices = max(1, vertices)
+        self.max_record_count = max_record_count
+        self.latency = latency
+        self.feature_latency = feature_latency
+        self.extent = extent
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        now = int(time.time() * 1000)
+        self.oids = np.arange(1, features + 1, dtype=np.int64)
+        self.dates = now - self.rng.integers(
+            86400000, 365 * 86400000, size=features, dtype=np.int64
+        )
+        self.tipo = self.rng.integers(1, 4, size=features)
+        self.x, self.y = self._random_points(features)
+        self.last_edit_date = now
+
+    def _random_points(self, n: int):
+        xmin, ymin, xmax, ymax = self.extent
+        return self.rng.uniform(xmin, xmax, size=n), self.rng.uniform(ymin, ymax, size=n)
+
+    def definition(self):
+        """
+        Layer definition, as returned by MapServer/{layer}?f=json.
+        """
+        xmin, ymin, xmax, ymax = self.extent
+        return {
+            "currentVersion": 10.81,
+            "id": self.id,
+            "name": self.name,
+            "type": "Feature Layer",
+            "geometryType": self.geometry_type,
+            "objectIdField": "OBJECTID",
+            "typeIdField": None,
+            "fields": [
+                {"name": "OBJECTID", "type": "esriFieldTypeOID", "alias": "OBJECTID"},
+                {"name": "DATEMODIFIED", "type": "esriFieldTypeDate", "alias": "DATEMODIFIED", "length": 8},
+                {
+                    "name": "TIPO",
+                    "type": "esriFieldTypeSmallInteger",
+                    "alias": "TIPO",
+                    "domain": {
+                        "type": "codedValue",
+                        "name": "TIPO",
+                        "codedValues": [
+                            {"name": name, "code": code}
+                            for code, name in tipo_domain.items()
+                        ],
+                    },
+                },
+                {"name": "NOMBRE", "type": "esriFieldTypeString", "alias": "NOMBRE", "length": 50},
+            ],
+            "maxRecordCount": self.max_record_count,
+            "supportedQueryFormats": "JSON, geoJSON",
+            "editingInfo": {"lastEditDate": self.last_edit_date},
+            "extent": {
+                "xmin": xmin,
+                "ymin": ymin,
+                "xmax": xmax,
+                "ymax": ymax,
+                "spatialReference": {"wkid": 4326, "latestWkid": 4326},
+            },
+        }
+
+    def count(self):
+        with self._lock:
+            return len(self.oids)
+
+    def mutate(self, edited: int = 0, added: int = 0, deleted: int = 0):
+        """
+        Edit, add and delete random features, stamping the edited and added ones with the current DATEMODIFIED.
+
+        Returns:
+            (edited_ids, added_ids, deleted_ids) (tuple): OBJECTIDs touched by each change.
+        """
+        with self._lock:
+            now = int(time.time() * 1000)
+            n = len(self.oids)
+            deleted_pos = self.rng.choice(n, size=min(deleted, n), replace=False)
+            keep = np.ones(n, dtype=bool)
+            keep[deleted_pos] = False
+            deleted_ids = self.oids[deleted_pos]
+            edited_pos = self.rng.choice(
+                np.flatnonzero(keep), size=min(edited, int(keep.sum())), replace=False
+            )
+            edited_ids = self.oids[edited_pos]
+            self.dates[edited_pos] = now
+            self.tipo[edited_pos] = self.rng.integers(1, 4, size=len(edited_pos))
+
+            start = int(self.oids.max()) + 1 if n else 1
+            added_ids = np.arange(start, start + added, dtype=np.int64)
+            x, y = self._random_points(added)
+            self.oids = np.concatenate([self.oids[keep], added_ids])
+            self.dates = np.concatenate(
+                [self.dates[keep], np.full(added, now, dtype=np.int64)]
+            )
+            self.tipo = np.concatenate(
+                [self.tipo[keep], self.rng.integers(1, 4, size=added)]
+            )
+            self.x = np.concatenate([self.x[keep], x])
+            self.y = np.concatenate([self.y[keep], y])
+            if edited or added or deleted:
+                self.last_edit_date = now
+        return edited_ids.tolist(), added_ids.tolist(), deleted_ids.tolist()
+
+    def _mask(self, params: dict):
+        """
+        Features matching the where clause (1=1 / 1=0, DATEMODIFIED > DATE '...' and OBJECTID ranges) and the envelope of the query.
+        """
+        where = params.get("where", "1=1")
+        mask = np.ones(len(self.oids), dtype=bool)
+        if re.search(r"\b1\s*=\s*0\b", where):
+            mask[:] = False
+        for value in re.findall(r"DATEMODIFIED\s*>\s*DATE\s*'([^']+)'", where):
+            mask &= self.dates > pd.Timestamp(value, tz="UTC").value // 10**6
+        for value in re.findall(r"OBJECTID\s*>=\s*(\d+)", where):
+            mask &= self.oids >= int(value)
+        for value in re.findall(r"OBJECTID\s*<=\s*(\d+)", where):
+            mask &= self.oids <= int(value)
+
+        geometry = params.get("geometry")
+        if geometry:
+            if geometry.lstrip().startswith("{"):
+                envelope = json.loads(geometry)
+                xmin, ymin, xmax, ymax = (
+                    envelope[key] for key in ("xmin", "ymin", "xmax", "ymax")
+                )
+            else:
+                xmin, ymin, xmax, ymax = (float(value) for value in geometry.split(","))
+            mask &= (self.x >= xmin) & (self.x < xmax) & (self.y >= ymin) & (self.y < ymax)
+        return mask
+
+    def _geometry(self, x: float, y: float):
+        if self.geometry_type == "esriGeometryPoint":
+            return {"x": round(x, 8), "y": round(y, 8)}
+        angles = np.linspace(0, 2 * np.pi, self.vertices)
+        part = np.c_[x + 0.01 * np.cos(angles), y + 0.01 * np.sin(angles)].round(8).tolist()
+        if self.geometry_type == "esriGeometryPolygon":
+            return {"rings": [part]}
+        return {"paths": [part]}
+
+    def query(self, params: dict):
+        """
+        Answer a /query request: returnIdsOnly, returnCountOnly, or a page of features (resultOffset / resultRecordCount, capped at maxRecordCount).
+
+        Returns:
+            (data, features) (tuple): Response and number of features in it.
+        """
+        with self._lock:
+            mask = self._mask(params)
+            if params.get("returnIdsOnly") == "true":
+                return {
+                    "objectIdFieldName": "OBJECTID",
+                    "objectIds": self.oids[mask].tolist(),
+                }, 0
+            if params.get("returnCountOnly") == "true":
+                return {"count": int(mask.sum())}, 0
+
+            positions = np.flatnonzero(mask)
+            offset = int(params.get("resultOffset") or 0)
+            count = min(
+                int(params.get("resultRecordCount") or self.max_record_count),
+                self.max_record_count,
+            )
+            page = positions[offset : offset + count]
+            features = []
+            for i in page:
+                feature = {
+                    "attributes": {
+                        "OBJECTID": int(self.oids[i]),
+                        "DATEMODIFIED": int(self.dates[i]),
+                        "TIPO": int(self.tipo[i]),
+                        "NOMBRE": f"{self.name} {self.oids[i]}",
+                    }
+                }
+                if params.get("returnGeometry", "true") != "false":
+                    feature["geometry"] = self._geometry(self.x[i], self.y[i])
+                features.append(feature)
+
+        definition = self.definition()
+        data = {
+            "objectIdFieldName": "OBJECTID",
+            "geometryType": self.geometry_type,
+            "spatialReference": {"wkid": 4326, "latestWkid": 4326},
+            "fields": [
+                {key: field[key] for key in ("name", "type", "alias")}
+                for field in definition["fields"]
+            ],
+            "features": features,
+        }
+        if offset + count < len(positions):
+            data["exceededTransferLimit"] = True
+        return data, len(features)
+
+
+def ntlm_challenge():
+    """
+    NTLM CHALLENGE_MESSAGE (type 2) with a random server challenge and the MOCK domain as target.
+    The AUTHENTICATE_MESSAGE the client answers with is accepted without checking it.
+    """
+    target = "MOCK".encode("utf-16-le")
+    target_info = (
+        struct.pack("<HH", 2, len(target))
+        + target
+        + struct.pack("<HH", 1, len(target))
+        + target
+        + struct.pack("<HH", 0, 0)
+    )
+    # UNICODE | REQUEST_TARGET | SIGN | SEAL | NTLM | ALWAYS_SIGN | TARGET_TYPE_DOMAIN | EXTENDED_SESSIONSECURITY | TARGET_INFO | VERSION | 128 | KEY_EXCH | 56
+    flags = 0xE2898235
+    header = 56
+    return (
+        b"NTLMSSP\x00"
+        + struct.pack("<I", 2)
+        + struct.pack("<HHI", len(target), len(target), header)
+        + struct.pack("<I", flags)
+        + os.urandom(8)
+        + b"\x00" * 8
+        + struct.pack("<HHI", len(target_info), len(target_info), header + len(target))
+        + struct.pack("<BBHBBBB", 10, 0, 19041, 0, 0, 0, 15)
+        + target
+        + target_info
+    )
+
+
+def _ntlm_message_type(request: web.Request):
+    """
+    Type (1 negotiate, 3 authenticate) of the NTLM message in the Authorization header, None if there is none.
+    """
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("NTLM "):
+        return None
+    try:
+        message = base64.b64decode(header[5:])
+    except ValueError:
+        return None
+    if message[:8] != b"NTLMSSP\x00":
+        return None
+    return struct.unpack("<I", message[8:12])[0]
+
+
+class MockServer:
+    """
+    Local ArcGIS / Geocortex server for benchmarks and offline runs, served from a background thread:
+        1. NTLM handshake and ASP.NET form (Form1) on the home page.
+        2. Geocortex page with the oAuthInfo script, and the OAuth sign-in returning the GEOToken (gcx-...).
+        3. MapServer index, layer definitions and paged /query of SyntheticLayers, requiring the GEOToken (498 otherwise).
+
+    Usage:
+        with MockServer(build_layers(scale=0.1)) as server:
+            geo_client = GEO_Client(**server.client_kwargs())
+    """
+
+    def __init__(
+        self,
+        services: dict = None,
+        aliases: dict = None,
+        latency: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """
+        Args:
+            services (dict, optional): {map_service: [SyntheticLayer, ...]}. Defaults to build_layers().
+            aliases (dict, optional): {map_service: map_service} served with the same layers as another one, like 7 and 0 on the real server. Defaults to None.
+            latency (float, optional): Seconds every log in and metadata request waits before answering. Defaults to 0.0.
+            host (str, optional): Host to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 for a free one. Defaults to 0.
+        """
+        self.services = build_layers() if services is None else services
+        for alias, map_service in (aliases or {}).items():
+            self.services[alias] = self.services[map_service]
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.token = uuid.uuid4().hex
+        self.oauth_state = uuid.uuid4().hex
+        self.requests = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    def client_kwargs(self):
+        """
+        home_url, url and login_url of GEO_Client pointing to this server.
+        """
+        return {
+            "home_url": self.base_url,
+            "url": self.base_url + "Geocortex/",
+            "login_url": self.base_url + "portal/sharing/oauth2/signin",
+        }
+
+    def layers(self):
+        """
+        Yields:
+            (map_service, layer) (tuple): Every map service and SyntheticLayer served, aliases included.
+        """
+        for map_service, layers in self.services.items():
+            for layer in layers:
+                yield map_service, layer
+
+    def expire_token(self):
+        """
+        Issue a new GEOToken, so the next requests fail with 498 until the client logs in again.
+        """
+        self.token = uuid.uuid4().hex
+
+    def _app(self):
+        app = web.Application()
+        app.router.add_get("/", self._home)
+        app.router.add_post("/login.aspx", self._form)
+        app.router.add_get("/Geocortex/", self._geocortex)
+        app.router.add_post("/portal/sharing/oauth2/signin", self._signin)
+        prefix = "/Geocortex/Essentials/REST/sites/SIN/map/mapservices/{map_service}/rest/services/x/MapServer"
+        app.router.add_get(prefix + "/", self._index)
+        app.router.add_get(prefix + "/{layer}", self._definition)
+        app.router.add_get(prefix + "/{layer}/query", self._query)
+        app.middlewares.append(self._count_requests)
+        return app
+
+    @web.middleware
+    async def _count_requests(self, request: web.Request, handler):
+        self.requests += 1
+        return await handler(request)
+
+    async def _ntlm(self, request: web.Request):
+        """
+        NTLM handshake: 401 without credentials, the challenge for a negotiate message, None (authenticated) for an authenticate message.
+        """
+        message_type = _ntlm_message_type(request)
+        if message_type == 3:
+            return None
+        if message_type == 1:
+            challenge = base64.b64encode(ntlm_challenge()).decode()
+            return web.Response(
+                status=401, headers={"WWW-Authenticate": f"NTLM {challenge}"}
+            )
+        return web.Response(status=401, headers={"WWW-Authenticate": "NTLM"})
+
+    async def _home(self, request: web.Request):
+        challenge = await self._ntlm(request)
+        if challenge is not None:
+            return challenge
+        await asyncio.sleep(self.latency)
+        response = web.Response(
+            text=(
+                "<html><body>"
+                '<form id="Form1" method="post" action="login.aspx">'
+                f'<input type="hidden" name="__VIEWSTATE" value="{uuid.uuid4().hex}" />'
+                '<input type="hidden" name="__VIEWSTATEGENERATOR" value="C2EE9ABB" />'
+                f'<input type="hidden" name="__EVENTVALIDATION" value="{uuid.uuid4().hex}" />'
+                "</form></body></html>"
+            ),
+            content_type="text/html",
+        )
+        response.set_cookie("ASP.NET_SessionId", uuid.uuid4().hex)
+        return response
+
+    async def _form(self, request: web.Request):
+        challenge = await self._ntlm(request)
+        if challenge is not None:
+            return challenge
+        data = await request.post()
+        if not all(
+            data.get(key)
+            for key in ("__VIEWSTATE", "__VIEWSTATEGENERATOR", "__EVENTVALIDATION")
+        ):
+            return web.Response(status=400, text="Missing form fields")
+        await asyncio.sleep(self.latency)
+        return web.Response(text="<html><body>OK</body></html>", content_type="text/html")
+
+    async def _geocortex(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        oauth_info = json.dumps(
+            {"oauth_state": self.oauth_state, "client_id": "geocortex", "locale": "es"}
+        )
+        return web.Response(
+            text=(
+                "<html><head>\r\n"
+                '<script src="libs/jquery.js"></script>\r\n'
+                "<script>var config = {};</script>\r\n"
+                f"<script>\r\nvar oAuthInfo = {oauth_info}\r\nvar started = true;\r\n</script>\r\n"
+                "</head><body></body></html>"
+            ),
+            content_type="text/html",
+        )
+
+    async def _signin(self, request: web.Request):
+        data = await request.post()
+        await asyncio.sleep(self.latency)
+        if data.get("oauth_state") != self.oauth_state:
+            return web.Response(status=400, text="Invalid oauth_state")
+        return web.Response(
+            text=(
+                "<html><body>"
+                f'<form method="post" action="{self.base_url}Geocortex/oauth#gcx-{self.token}">'
+                "</form></body></html>"
+            ),
+            content_type="text/html",
+        )
+
+    def _layer(self, request: web.Request):
+        try:
+            map_service = int(request.match_info["map_service"])
+            layer = int(request.match_info.get("layer", -1))
+        except ValueError:
+            return None, None
+        return self.services.get(map_service), layer
+
+    def _json(self, data: dict):
+        return web.Response(body=json.dumps(data).encode(), content_type="application/json")
+
+    def _error(self, code: int, message: str):
+        # ArcGIS answers errors with a 200 and an error payload.
+        return self._json({"error": {"code": code, "message": message, "details": []}})
+
+    async def _index(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        if request.query.get("token") != self.token:
+            return self._error(498, "Invalid Token")
+        layers, _ = self._layer(request)
+        if layers is None:
+            return self._error(400, "Map service not found")
+        return self._json(
+            {
+                "currentVersion": 10.81,
+                "layers": [
+                    {
+                        "id": layer.id,
+                        "name": layer.name,
+                        "parentLayerId": -1,
+                        "defaultVisibility": True,
+                        "subLayerIds": None,
+                        "minScale": 0,
+                        "maxScale": 0,
+                    }
+                    for layer in layers
+                ],
+            }
+        )
+
+    async def _definition(self, request: web.Request):
+        await asyncio.sleep(self.latency)
+        if request.query.get("token") != self.token:
+            return self._error(498, "Invalid Token")
+        layers, layer = self._layer(request)
+        if layers is None or not 0 <= layer < len(layers):
+            return self._error(400, "Invalid or missing input parameters.")
+        return self._json(layers[layer].definition())
+
+    async def _query(self, request: web.Request):
+        if request.query.get("token") != self.token:
+            return self._error(498, "Invalid Token")
+        layers, layer = self._layer(request)
+        if layers is None or not 0 <= layer < len(layers):
+            return self._error(400, "Invalid or missing input parameters.")
+        layer = layers[layer]
+        try:
+            data, features = layer.query(dict(request.query))
+        except (ValueError, KeyError) as e:
+            return self._error(400, f"Unable to complete operation: {e}")
+        await asyncio.sleep(layer.latency + layer.feature_latency * features)
+        return self._json(data)
+
+    def start(self):
+        """
+        Serve in a background thread, returning once the server is listening.
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._runner = web.AppRunner(self._app(), access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            self.port = self._runner.addresses[0][1]
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def build_layers(
+    layers: dict = None,
+    scale: float = 1.0,
+    max_record_count: int = 2000,
+    latency: float = 0.0,
+    feature_latency: float = 0.0,
+    seed: int = 0,
+):
+    """
+    SyntheticLayers of every map service.
+
+    Args:
+        layers (dict, optional): {map_service: [(name, geometryType, features, vertices), ...]}. Defaults to default_layers.
+        scale (float, optional): Multiplies the number of features of every layer. Defaults to 1.0.
+        max_record_count (int, optional): maxRecordCount of every layer. Defaults to 2000.
+        latency (float, optional): Seconds every query waits before answering. Defaults to 0.0.
+        feature_latency (float, optional): Extra seconds per feature returned. Defaults to 0.0.
+        seed (int, optional): Seed of the random features. Defaults to 0.
+
+    Returns:
+        services (dict): {map_service: [SyntheticLayer, ...]}.
+    """
+    layers = default_layers if layers is None else layers
+    return {
+        map_service: [
+            SyntheticLayer(
+                id,
+                name,
+                geometry_type,
+                max(1, int(features * scale)),
+                vertices,
+                max_record_count=max_record_count,
+                latency=latency,
+                feature_latency=feature_latency,
+                seed=seed + 100 * map_service + id,
+            )
+            for id, (name, geometry_type, features, vertices) in enumerate(service)
+        ]
+        for map_service, service in layers.items()
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic layers behind a mock of the NTLM / Geocortex log in and the ArcGIS MapServer REST API."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplies the number of features of every synthetic layer.",
+    )
+    parser.add_argument(
+        "--max-record-count", type=int, default=2000, help="maxRecordCount of every layer."
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds every request waits before answering.",
+    )
+    parser.add_argument(
+        "--feature-latency",
+        type=float,
+        default=0.0,
+        help="Extra seconds per feature returned by a query.",
+    )
+    args = parser.parse_args()
+
+    server = MockServer(
+        build_layers(
+            scale=args.scale,
+            max_record_count=args.max_record_count,
+            latency=args.latency,
+            feature_latency=args.feature_latency,
+        ),
+        default_aliases,
+        latency=args.latency,
+        host=args.host,
+        port=args.port,
+    ).start()
+    print(f"Serving on {server.base_url}, GEO_Client(**{server.client_kwargs()})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+        sys.exit(0)
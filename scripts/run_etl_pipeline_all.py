@@ -1,160 +1,129 @@
 import sys
-import os
-import glob
-import ast
-import datetime
-import pandas as pd
-import numpy as np
+import argparse
+from pathlib import Path
 
-sys.path.insert(0, "\\".join(os.path.dirname(__file__).split("\\")[:-1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 from src.client.geo_client import GEO_Client
-from src.config import OUTPUTS_DIR
+from src.config import MAX_WORKERS, MERGE_WORKERS, EXTRACTION_PROFILE
+from src.profiles import profiles
+from src.final_tables import merge_and_parse_files_final
+from src.journal import RunJournal
+from src.telemetry import telemetry
 import warnings
 
 warnings.filterwarnings("ignore")
 
-features_files = glob.glob(OUTPUTS_DIR + f"/**/features/*")
-attributes_files = glob.glob(OUTPUTS_DIR + f"/**/attributes/*")
 
-geo_client = GEO_Client()
-
-
-def run_etl():
-    print("Running ETL")
-    geo_client.get_all_attributes()
-    print("Saved GEOAttributes")
-    geo_client.get_all_features()
-    print("Saved GEOFeatures")
-    merge_and_parse_files_final()
-    print("Saved Final GEOTables")
-
-
-def merge_and_parse_files_final():
-    """
-    Merging features and attributes for each layer in each MapService.
-    Saving these files in URI outputs/final/
-    """
-    for file in features_files:
-
-        variable = file.split("\\")[-3]
-        if "final" not in os.listdir(os.path.join(OUTPUTS_DIR, f"{variable}")):
-            os.mkdir(os.path.join(OUTPUTS_DIR, f"{variable}", "final"))
-
-        name_ = file.split("\\")[-1]
-        try:
-            df = pd.recsv(file)
-        except:
-            continue
-        if len(df) == 0:
-            continue
-        df.columns = df.columns.str.replace("attributes.", "")
-        df.columns = df.columns.str.replace("geometry.", "")
-
-        for col in df.columns:
-            if "DATE" in col:
-                indeces = pd.to_datetime(df[col], errors="coerce")[
-                    pd.to_datetime(df[col], errors="coerce").isna()
-                ].index
-                df.loc[indeces, col] = np.nan
-                try:
-                    indeces = df[df[col] < 0].index
-                    df.loc[indeces, col] = np.nan
-                except:
-                    pass
-                df[col] = df[col].apply(lambda x: np.nan if x > 2647813300000 else x)
-                df[col] = df[col].apply(
-                    lambda x: (
-                        datetime.datetime.fromtimestamp(x / 1e3)
-                        if pd.isna(x) == False
-                        else x
-                    )
-                )
-
-        attributes_file = [
-            x
-            for x in attributes_files
-            if "\\" + file.split("\\")[-3] in x and "\\" + file.split("\\")[-1] in x
-        ]
-        assert len(attributes_file) == 1
-        try:
-            attributes = pd.recsv(attributes_file[0])
-        except:
-            attributes = pd.DataFrame()
-
-        if len(attributes) == 0:
-            pass
-        else:
-            attributes["column"] = attributes["column"].str.upper()
-            for col in attributes["column"].unique():
-                attributes_dict = (
-                    attributes[attributes["column"] == col]
-                    .set_index("id")["name"]
-                    .to_dict()
-                )
-                try:  ########### Added because in Shunt Reactor there are some weird Attributes' columns.
-                    if df[col].dtype == float:
-                        df[col] = df[col].fillna(-1)
-                        df[col] = df[col].astype(int).astype(str).map(attributes_dict)
-                        df[col] = df[col].replace("-1", pd.NA)
-                    else:
-                        df[col] = df[col].astype(str).map(attributes_dict)
-                except:  ########### Added because in Shunt Reactor there are some weird Attributes' columns.
-                    pass
-        if "rings" in df.columns:
-            indices = df[~df["rings"].isna()].index
-            df.loc[indices, "rings"] = df.loc[indices, "rings"].apply(
-                lambda x: ast.literal_eval(x)
+def run_etl(
+    geo_client: GEO_Client,
+    profile: str = EXTRACTION_PROFILE,
+    tiled: bool = False,
+    bbox: tuple = None,
+    province: str = None,
+    resume: bool = False,
+    merge_workers: int = MERGE_WORKERS,
+    fused: bool = False,
+    raw: bool = False,
+):
+    telemetry.reset()
+    try:
+        print("Running ETL")
+        with telemetry.span("attributes"):
+            geo_client.get_all_attributes()
+        print("Saved GEOAttributes")
+        with telemetry.span("features"):
+            geo_client.get_all_features(
+                max_workers=MAX_WORKERS,
+                profile=profile,
+                tiled=tiled,
+                bbox=bbox,
+                province=province,
+                resume=resume,
+                fused=fused,
+                raw=raw,
             )
-            df.loc[indices, "x"] = df.loc[indices, "rings"].apply(
-                lambda x: (
-                    (
-                        np.sum([coord[0] for coord in x[0]])
-                        / len([coord[0] for coord in x[0]])
-                    )
-                    if len(x) != 0
-                    else np.nan
+        print("Saved GEOFeatures")
+        # The fused pipeline already wrote the final tables. A bbox / province refresh only upserts
+        # into the FeatureStores, whose final tables are always rebuilt by the merge.
+        if not fused or bbox is not None or province is not None:
+            with telemetry.span("merge"):
+                merge_and_parse_files_final(
+                    max_workers=merge_workers, output_format=geo_client.output_format
                 )
-            )
-            df.loc[indices, "y"] = df.loc[indices, "rings"].apply(
-                lambda x: (
-                    (
-                        np.sum([coord[1] for coord in x[0]])
-                        / len([coord[1] for coord in x[0]])
-                    )
-                    if len(x) != 0
-                    else np.nan
-                )
-            )
-
-        if "paths" in df.columns:
-            indices = df[~df["paths"].isna()].index
-            df.loc[indices, "paths"] = df.loc[indices, "paths"].apply(
-                lambda x: ast.literal_eval(x)
-            )
-            df.loc[indices, "x"] = df.loc[indices, "paths"].apply(
-                lambda x: (
-                    (
-                        np.sum([coord[0] for coord in x[0]])
-                        / len([coord[0] for coord in x[0]])
-                    )
-                    if len(x) != 0
-                    else np.nan
-                )
-            )
-            df.loc[indices, "y"] = df.loc[indices, "paths"].apply(
-                lambda x: (
-                    (
-                        np.sum([coord[1] for coord in x[0]])
-                        / len([coord[1] for coord in x[0]])
-                    )
-                    if len(x) != 0
-                    else np.nan
-                )
-            )
-
-        df.to_csv(os.path.join(OUTPUTS_DIR, f"{variable}", "final", name_), index=False)
-        print(f"Saved final: {variable} {name_}")
+        print("Saved Final GEOTables")
+        # The run is complete, a new one starts from scratch.
+        RunJournal().clear()
+    finally:
+        print(f"Run report: {telemetry.write_report()}")
 
 
 if __name__ == "__main__":
-    run_etl()
+    parser = argparse.ArgumentParser(
+        description="Fetch every layer, then build the final tables."
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(profiles),
+        default=EXTRACTION_PROFILE,
+        help="Extraction profile of the feature queries (fields and geometry detail). Profiles other than full are saved to outputs/{folder}.{profile}/.",
+    )
+    parser.add_argument(
+        "--tiled",
+        action="store_true",
+        help="Extract each layer by quadtree tiles of its extent, for layers too big to page by objectId.",
+    )
+    area = parser.add_mutually_exclusive_group()
+    area.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        help="Only refresh the features intersecting this bounding box (EPSG:4326).",
+    )
+    area.add_argument(
+        "--province",
+        help="Only refresh the features intersecting the bounding box of this province.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the last page committed for each layer.",
+    )
+    parser.add_argument(
+        "--profile-stages",
+        nargs="+",
+        default=[],
+        metavar="STAGE",
+        help="Profile these stages with cProfile (e.g. merge.geometry, normalize, login), dumped next to the run report.",
+    )
+    parser.add_argument(
+        "--merge-workers",
+        type=int,
+        default=MERGE_WORKERS,
+        help="Final tables built at the same time, one process per layer (1 builds them in this process).",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Build the final tables straight from the fetched pages, without writing the features files and merging them afterwards. With --bbox or --province the refreshed layers are still merged.",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="With --fused, also write the features files.",
+    )
+    args = parser.parse_args()
+    telemetry.profile_stages += args.profile_stages
+    # Built here and not at import: the merge workers spawned by the ProcessPool re-import this script.
+    geo_client = GEO_Client()
+    run_etl(
+        geo_client,
+        profile=args.profile,
+        tiled=args.tiled,
+        bbox=args.bbox,
+        province=args.province,
+        resume=args.resume,
+        merge_workers=args.merge_workers,
+        fused=args.fused,
+        raw=args.raw,
+    )
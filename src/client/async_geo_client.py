@@ -0,0 +1,1115 @@
+import os
+import time
+import asyncio
+import datetime
+from collections import deque
+from itertools import islice
+import aiohttp
+import numpy as np
+import pandas as pd
+
+from ..profiles import profile_params, profile_folder
+from ..journal import RunJournal
+from ..store import FeatureStore
+from ..writers import read_table
+from ..telemetry import telemetry
+from ..config import TILE_MAX_RECORDS, TILE_MAX_DEPTH
+from .decoding import query_headers, loads
+from .http import (
+    RequestFailed,
+    TokenExpired,
+    BadRequest,
+    payload_error,
+    error_message,
+    body_message,
+    retry_delay,
+)
+from .catalog import layer_fingerprint, layer_last_edit_date
+from .tiling import split_envelope, envelope_params, layer_envelope
+from .geo_client import (
+    GEO_Client,
+    map_service_list,
+    map_service_dict,
+    name_dict,
+    map_layers_without_features,
+)
+
+
+async def ordered_gather(func, items, max_in_flight: int):
+    """
+    Async generator version of ordered_map(): await func(item) for every item of items with at most max_in_flight in flight, yielding the results in order.
+    items is consumed lazily, so it can be a generator that depends on the results yielded so far. Pending calls are cancelled if the caller stops early.
+    """
+    items = iter(items)
+    pending = deque(
+        asyncio.ensure_future(func(item)) for item in islice(items, max(1, max_in_flight))
+    )
+    try:
+        while pending:
+            result = await pending.popleft()
+            for item in islice(items, 1):
+                pending.append(asyncio.ensure_future(func(item)))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class AsyncGEO_Client(GEO_Client):
+    """
+    asyncio version of GEO_Client.
+    Logging in goes through the same two-stage NTLM + OAuth flow, after which every metadata and query request is sent through a single aiohttp.ClientSession,
+    so thousands of pages are multiplexed over a pool of at most connection_limit keep-alive connections.
+    Every method of GEO_Client that sends requests, directly or through another one, is a coroutine (or an async generator) here,
+    the inherited synchronous ones only work on local state (the index, the plan, the manifest, the files).
+
+    Usage:
+        async with AsyncGEO_Client() as geo_client:
+            await geo_client.get_all_features()
+    """
+
+    def __init__(self, *args, connection_limit: int = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection_limit = connection_limit
+        self.http = None
+        self._async_token_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        """
+        Open the pooled HTTP session, carrying over the cookies of the logged in requests.Session (logging in first if there is no cached session).
+        """
+        if self._token is None:
+            await self.refresh_token(None)
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connection_limit,
+                    limit_per_host=self.transport.max_per_host,
+                    ssl=False,
+                ),
+                cookies=self.session.cookies.get_dict(),
+            )
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+
+    @property
+    def token(self):
+        """
+        GEOToken of the session. The async client logs in in open(), a token cannot be fetched lazily from synchronous code.
+        """
+        if self._token is None:
+            raise RuntimeError(
+                "AsyncGEO_Client is not logged in, await open() (or use async with) first"
+            )
+        return self._token
+
+    @token.setter
+    def token(self, value: str):
+        self._token = value
+
+    async def _send(
+        self,
+        url: str,
+        params: dict,
+        headers: dict = None,
+        timeout: int = None,
+        decode=None,
+    ):
+        """
+        Coroutine version of HttpClient.get(): same retries, backoff and error classification, sharing the TokenBucket of the host with self.transport.
+
+        Returns:
+            status (int): HTTP status of the last response.
+            headers (dict): Headers of the last response.
+            data (dict): Decoded body (decode(content, content_type), JSON by default), None for a 304 Not Modified.
+        """
+        await self.open()
+        bucket = self.transport.bucket(url)
+        timeout = self.transport.timeout if timeout is None else timeout
+        for attempt in range(self.transport.retries + 1):
+            await asyncio.sleep(bucket.reserve())
+            response_headers = {}
+            timed_out = False
+            try:
+                async with self.http.get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                ) as response:
+                    status = response.status
+                    response_headers = response.headers.copy()
+                    content = await response.read()
+                if status >= 400:
+                    code, error = status, f"HTTP {status} {body_message(content)}".strip()
+                elif status == 304:
+                    bucket.recover()
+                    return status, response_headers, None
+                else:
+                    content_type = response_headers.get("Content-Type", "")
+                    data = (
+                        decode(content, content_type)
+                        if decode is not None
+                        else loads(content)
+                    )
+                    code = payload_error(data)
+                    if code is None:
+                        bucket.recover()
+                        return status, response_headers, data
+                    error = f"error {code} {error_message(data)}".strip()
+            except asyncio.TimeoutError as e:
+                code, error, timed_out = None, f"{type(e).__name__}: {e}", True
+            except aiohttp.ClientError as e:
+                code, error = None, f"{type(e).__name__}: {e}"
+            except (ValueError, IndexError) as e:
+                code, error = None, f"undecodable response: {e}"
+
+            delay = retry_delay(
+                url,
+                code,
+                error,
+                attempt,
+                self.transport.retries,
+                bucket,
+                response_headers.get("Retry-After"),
+                timed_out,
+                self.transport.timeout_retries,
+            )
+            print(f"Request failed with {error}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _request(
+        self,
+        url: str,
+        params: dict,
+        headers: dict = None,
+        timeout: int = None,
+        decode=None,
+    ):
+        """
+        Coroutine version of GEO_Client._request().
+        """
+        try:
+            return await self._send(url, params, headers, timeout, decode)
+        except TokenExpired as e:
+            print(f"{e}, re-logging in")
+            params["token"] = await self.refresh_token(params["token"])
+            return await self._send(url, params, headers, timeout, decode)
+
+    async def refresh_token(self, stale_token: str):
+        """
+        Coroutine version of GEO_Client.refresh_token(). The blocking log_in() runs in a thread and only once for all the coroutines holding the expired token.
+
+        Args:
+            stale_token (str): Token that was sent with the failed request, None to log in for the first time.
+
+        Returns:
+            token (str): Valid GEOToken.
+        """
+        async with self._async_token_lock:
+            if self._token == stale_token:
+                await asyncio.to_thread(self.log_in)
+                if self.http is not None:
+                    self.http.cookie_jar.update_cookies(
+                        self.session.cookies.get_dict()
+                    )
+            return self._token
+
+    async def get_available_layers(self):
+        """
+        Get all the layers available from all the Map Services in the API, requesting every Map Service at the same time.
+
+        Returns:
+            self.index_df (pd.DataFrame): DataFrame with MapService / Layers values.
+        """
+
+        async def get_map_service_layers(map_service):
+            try:
+                data, _ = await self._get_metadata(
+                    map_service, None, self._map_service_url(map_service), timeout=30
+                )
+                aux = pd.json_normalize(data["layers"])
+                aux["map_service"] = map_service
+                aux["map_service_name"] = map_service_dict[map_service]
+                return aux
+            except:
+                return pd.DataFrame()
+
+        frames = await asyncio.gather(
+            *[get_map_service_layers(map_service) for map_service in map_service_list]
+        )
+        self.index_df = pd.concat(frames).reset_index(drop=True)
+        self.index_df = self.index_df.merge(self.modified_dates, how="left", on="name")
+
+        return self.index_df
+
+    async def plan_fetches(self):
+        """
+        Coroutine version of GEO_Client.plan_fetches(), requesting the layer definitions at the same time.
+        """
+        if not isinstance(self.index_df, pd.DataFrame):
+            await self.get_available_layers()
+        if "fetch" in self.index_df.columns:
+            return self.index_df
+
+        fingerprints = await asyncio.gather(
+            *[
+                self._layer_fingerprint(map_service_, layer_)
+                for map_service_, layer_ in self.index_df[["map_service", "id"]].values
+            ]
+        )
+        return self._plan(fingerprints)
+
+    async def _layer_definition(
+        self, map_service_: int, layer_: int, revalidate: bool = False
+    ):
+        """
+        Coroutine version of GEO_Client._layer_definition().
+        """
+        url = self._map_service_url(map_service_) + f"{layer_}"
+        layer_json, changed = await self._get_metadata(
+            map_service_, layer_, url, revalidate=revalidate
+        )
+        if changed:
+            self.changed_definitions.add((map_service_, layer_))
+        return layer_json
+
+    async def _layer_fingerprint(self, map_service_: int, layer_: int):
+        """
+        Coroutine version of GEO_Client._layer_fingerprint().
+        """
+        return layer_fingerprint(await self._layer_definition(map_service_, layer_))
+
+    async def _filtered_index(
+        self, variable: str, variable_2: int, variable_3: list, folder: str
+    ):
+        if not isinstance(self.index_df, pd.DataFrame):
+            await self.get_available_layers()
+        return GEO_Client._filtered_index(self, variable, variable_2, variable_3, folder)
+
+    async def _run_layer_jobs(self, job, jobs: list, max_workers: int = 1):
+        """
+        Await job(*args) for every args tuple in jobs, with at most max_workers layers in progress.
+        Failed layers are reported once all the jobs have finished.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def run(args):
+            async with semaphore:
+                await job(*args)
+
+        results = await asyncio.gather(
+            *[run(args) for args in jobs], return_exceptions=True
+        )
+        failed = []
+        for args, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                print(f"Failed {args[1:]}: {result}")
+                failed.append(args[1:])
+        if failed:
+            raise RuntimeError(f"{len(failed)} layers failed: {failed}")
+
+    async def _feature_jobs(
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        """
+        Coroutine version of GEO_Client._feature_jobs().
+        """
+        variable = profile_folder(variable, profile)
+        filtered_index = await self._filtered_index(
+            variable, variable_2, variable_3, "features"
+        )
+        return [
+            (variable, map_service_, layer_, name_, profile, tiled, bbox, fused, raw)
+            for map_service_, layer_, name_ in filtered_index[
+                ["map_service", "id", "name"]
+            ].values
+        ]
+
+    async def fetch_layers_features(
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        max_workers: int = 1,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        province: str = None,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        """
+        Coroutine version of GEO_Client.fetch_layers_features().
+
+        Args:
+            variable (str): Name of the Map Service
+            variable_2 (int): Id of the Map Service
+            variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            tiled (bool, optional): Split the extent of each layer in a quadtree of envelopes queried concurrently. Defaults to False.
+            bbox (tuple, optional): (xmin, ymin, xmax, ymax) in EPSG:4326. Only the features intersecting it are refreshed, upserted into the layer's FeatureStore. Defaults to None.
+            province (str, optional): Same as bbox, with the bounding box of this province. Defaults to None.
+            fused (bool, optional): Build the final tables straight from the pages, without the features files (see FinalWriter). Defaults to False.
+            raw (bool, optional): With fused, also write the features files. Defaults to False.
+        """
+        if province is not None:
+            bbox = await self.province_envelope(province)
+        await self._run_layer_jobs(
+            self._fetch_layer_features,
+            await self._feature_jobs(
+                variable, variable_2, variable_3, profile, tiled, bbox, fused, raw
+            ),
+            max_workers,
+        )
+
+    async def _fetch_layer_features(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        """
+        Coroutine version of GEO_Client._fetch_layer_features(). The pages are written, and committed to the run journal, in a thread.
+        """
+        if self.journal is not None and self.journal.is_done(
+            variable, map_service_, layer_
+        ):
+            print(f"{map_service_}, {layer_}, {name_} already fetched in this run, skipped")
+            return
+
+        await self.open()
+        start = time.perf_counter()
+        key = f"{map_service_}/{layer_}"
+        telemetry.name(key, f"{variable}/{name_}")
+
+        if bbox is not None:
+            await self._refresh_layer_envelope(
+                variable, map_service_, layer_, name_, bbox, profile
+            )
+            if self.journal is not None:
+                self.journal.finish_layer(variable, map_service_, layer_)
+            return
+
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(profile_params(profile, variable, name_))
+        feature_params["f"] = self._query_format(map_service_, layer_)
+
+        journaled = self.journal is not None and not tiled
+
+        writer = self._layer_writer(
+            variable,
+            name_,
+            key,
+            await self._layer_definition(map_service_, layer_) if fused else None,
+            raw,
+        )
+        committed = False
+        try:
+            checkpoint = (
+                await asyncio.to_thread(
+                    self._resume_layer, writer, variable, map_service_, layer_, name_
+                )
+                if journaled
+                else None
+            )
+            if tiled:
+                envelope, wkid = await self._layer_envelope(map_service_, layer_)
+                pages = self.tiled_query_with_paging(
+                    url, map_service_, layer_, feature_params, envelope, wkid
+                )
+            else:
+                pages = self.feature_query_with_paging(
+                    url, map_service_, layer_, feature_params, checkpoint
+                )
+            last_oid = None if checkpoint is None else checkpoint["last_oid"]
+            committed = checkpoint is not None
+            async for page in pages:
+                df = await asyncio.to_thread(writer.write, page)
+                if journaled:
+                    last_oid = await asyncio.to_thread(
+                        self._commit_page,
+                        variable,
+                        map_service_,
+                        layer_,
+                        writer,
+                        df,
+                        page,
+                        last_oid,
+                    )
+                    committed = True
+        except:
+            # Once a page is committed, the file is kept for the checkpoint.
+            writer.abort(keep=journaled and committed)
+            raise
+        await asyncio.to_thread(writer.close)
+        await asyncio.to_thread(
+            self._finish_layer_features,
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            writer,
+            fused,
+            raw,
+            start,
+        )
+
+    async def _layer_envelope(self, map_service_: int, layer_: int):
+        """
+        Coroutine version of GEO_Client._layer_envelope().
+        """
+        layer_json, _ = await self._get_metadata(
+            map_service_, layer_, self._map_service_url(map_service_) + f"{layer_}"
+        )
+        return layer_envelope(layer_json)
+
+    async def _query_count(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Coroutine version of GEO_Client._query_count().
+        """
+        params = {
+            key: value
+            for key, value in params.items()
+            if key not in ("resultOffset", "resultRecordCount")
+        }
+        params["returnCountOnly"] = "true"
+        params["f"] = "json"
+        data = await self._query_page(url, mapservice, layer, params)
+        if data is None:
+            return None
+        return data.get("count")
+
+    async def _quadtree_tiles(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        envelope: tuple,
+        wkid: int,
+    ):
+        """
+        Coroutine version of GEO_Client._quadtree_tiles(): the counts of each level are awaited at the same time, at most self.pages_in_flight in flight.
+        """
+        semaphore = asyncio.Semaphore(max(1, self.pages_in_flight))
+
+        async def count(tile):
+            async with semaphore:
+                return await self._query_count(
+                    url, mapservice, layer, envelope_params(feature_params, tile, wkid)
+                )
+
+        tiles = []
+        level = [(envelope, 0)]
+        while level:
+            counts = await asyncio.gather(*[count(tile) for tile, _ in level])
+            next_level = []
+            for (tile, depth), count_ in zip(level, counts):
+                if not count_:
+                    continue
+                if count_ > TILE_MAX_RECORDS and depth < TILE_MAX_DEPTH:
+                    next_level.extend(
+                        (quadrant, depth + 1) for quadrant in split_envelope(tile)
+                    )
+                else:
+                    tiles.append(tile)
+            level = next_level
+        return tiles
+
+    async def tiled_query_with_paging(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        envelope: tuple,
+        wkid: int,
+    ):
+        """
+        Async generator version of GEO_Client.tiled_query_with_paging(): up to self.pages_in_flight tiles are fetched at a time and yielded back in order.
+
+        Yields:
+            page (dict): Query response with the "features" of the page not seen in previous tiles.
+        """
+        tiles = await self._quadtree_tiles(
+            url, mapservice, layer, feature_params, envelope, wkid
+        )
+        print(f"Querying {len(tiles)} tiles, {mapservice}, {layer}")
+
+        async def tile_pages(tile):
+            return [
+                page
+                async for page in self.feature_query_with_paging(
+                    url, mapservice, layer, envelope_params(feature_params, tile, wkid)
+                )
+            ]
+
+        seen = set()
+        async for pages in ordered_gather(tile_pages, tiles, self.pages_in_flight):
+            for page in pages:
+                yield self._unseen_features(page, seen)
+
+    async def _refresh_layer_envelope(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        bbox: tuple,
+        profile: str = None,
+    ):
+        """
+        Coroutine version of GEO_Client._refresh_layer_envelope(). The FeatureStore is read and written in a thread.
+        """
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(
+            profile_params(profile, variable, name_, out_fields=False)
+        )
+        feature_params["f"] = self._query_format(map_service_, layer_)
+
+        changes = pd.json_normalize(
+            [
+                feature
+                async for page in self.tiled_query_with_paging(
+                    url, map_service_, layer_, feature_params, tuple(bbox), 4326
+                )
+                for feature in page["features"]
+            ]
+        )
+
+        store = FeatureStore(
+            self._store_path(variable, name_), output_format=self.output_format
+        )
+        oid_field = None
+        if not store.exists():
+            oid_field, _ = await self._query_object_ids(
+                url, map_service_, layer_, dict(feature_params, where="1=0")
+            )
+            if oid_field is None:
+                print(f"{map_service_}, {layer_}, {name_} has no objectIdField, skipped")
+                return
+        await asyncio.to_thread(
+            self._upsert_envelope,
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            bbox,
+            store,
+            changes,
+            oid_field,
+        )
+
+    async def _query_page(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Coroutine version of GEO_Client._query_page().
+        """
+        try:
+            return await self._get_page(url, mapservice, layer, params)
+        except BadRequest as e:
+            print(f"Query skipped, {mapservice}, {layer}: {e}")
+            return None
+        except RequestFailed:
+            if (mapservice, layer) in map_layers_without_features:
+                print("Error captured")
+                return None
+            raise
+
+    async def _get_page(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Coroutine version of GEO_Client._get_page().
+        """
+        sizes = []
+        key = f"{mapservice}/{layer}"
+
+        def decode(content, content_type):
+            sizes.append(len(content))
+            with telemetry.span("decode", key, bytes=len(content)):
+                return self.decode_stats.decode(
+                    content, content_type, params.get("f", "json"), (mapservice, layer)
+                )
+
+        start = time.perf_counter()
+        _, _, data = await self._request(
+            url, params, headers=query_headers, decode=decode
+        )
+        seconds = time.perf_counter() - start
+        rows = len(data.get("features") or [])
+        telemetry.record("request", key, seconds, sizes[-1], rows)
+        if "resultRecordCount" in params and "features" in data:
+            self._page_sizer(mapservice, layer).observe(
+                len(data["features"]), seconds, sizes[-1], params["resultRecordCount"]
+            )
+        return data
+
+    async def _query_object_ids(
+        self, url: str, mapservice: int, layer: int, feature_params: dict
+    ):
+        params = {
+            key: value
+            for key, value in feature_params.items()
+            if key not in ("resultOffset", "resultRecordCount")
+        }
+        params["returnIdsOnly"] = "true"
+        params["f"] = "json"
+        data = await self._query_page(url, mapservice, layer, params)
+        if data is None or "objectIdFieldName" not in data:
+            return None, None
+        return data["objectIdFieldName"], sorted(data.get("objectIds") or [])
+
+    async def _query_id_range(
+        self, url: str, mapservice: int, layer: int, params: dict
+    ):
+        params = dict(params)
+        page = {"features": []}
+        sizer = self._page_sizer(mapservice, layer)
+        while True:
+            try:
+                data = await self._query_page(url, mapservice, layer, params)
+            except RequestFailed as e:
+                if e.code is not None or params["resultRecordCount"] <= sizer.min_size:
+                    raise
+                sizer.timed_out()
+                params["resultRecordCount"] = max(
+                    sizer.min_size, params["resultRecordCount"] // 2
+                )
+                print(
+                    f"{mapservice}, {layer}: page timed out, retrying with {params['resultRecordCount']} features"
+                )
+                continue
+            if data is None or "features" not in data:
+                break
+            page.update({key: value for key, value in data.items() if key != "features"})
+            page["features"].extend(data["features"])
+            if not data.get("exceededTransferLimit") or len(data["features"]) == 0:
+                break
+            params["resultOffset"] += len(data["features"])
+        print(
+            f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(page['features'])} features ({layer})"
+        )
+        return page
+
+    async def feature_query_with_paging(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        checkpoint: dict = None,
+    ):
+        """
+        Async generator version of GEO_Client.feature_query_with_paging(): up to self.pages_in_flight objectId ranges are awaited at a time and yielded back in order.
+
+        Yields:
+            page (dict): Query response with the "features" of the page.
+        """
+        print(f"Querying Features, {mapservice}, {layer}")
+        oid_field, object_ids = await self._query_object_ids(
+            url, mapservice, layer, feature_params
+        )
+        if oid_field is None:
+            if checkpoint is not None:
+                feature_params = dict(
+                    feature_params,
+                    resultOffset=feature_params["resultOffset"] + checkpoint["rows"],
+                )
+            async for page in self._serial_query_with_paging(
+                url, mapservice, layer, feature_params
+            ):
+                yield page
+            return
+
+        if checkpoint is not None and checkpoint["last_oid"] is not None:
+            object_ids = [
+                object_id for object_id in object_ids if object_id > checkpoint["last_oid"]
+            ]
+
+        async for page in self._query_id_ranges(
+            url, mapservice, layer, feature_params, oid_field, object_ids
+        ):
+            yield page
+
+    async def _query_id_ranges(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        oid_field: str,
+        object_ids: list,
+    ):
+        """
+        Fetch the objectId ranges of object_ids, up to self.pages_in_flight at a time, yielding the pages back in order.
+        """
+        async for page in ordered_gather(
+            lambda params: self._query_id_range(url, mapservice, layer, params),
+            self._id_range_pages(
+                feature_params,
+                oid_field,
+                object_ids,
+                self._page_sizer(mapservice, layer),
+            ),
+            self.pages_in_flight,
+        ):
+            yield page
+
+    async def _serial_query_with_paging(
+        self, url: str, mapservice: int, layer: int, feature_params: dict
+    ):
+        params = dict(feature_params)
+        sizer = self._page_sizer(mapservice, layer)
+        while True:
+            params["resultRecordCount"] = sizer.size
+            data = await self._query_page(url, mapservice, layer, params)
+            if data is None or "features" not in data:
+                break
+            yield data
+            print(
+                f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({layer})"
+            )
+            if len(data["features"]) < params["resultRecordCount"]:
+                break
+            params["resultOffset"] += params["resultRecordCount"]
+
+    async def fetch_layers_attributes(
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        max_workers: int = 1,
+    ):
+        """
+        Coroutine version of GEO_Client.fetch_layers_attributes().
+
+        Args:
+            variable (str): Name of the Map Service
+            variable_2 (int): Id of the Map Service
+            variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+        """
+        filtered_index = await self._filtered_index(
+            variable, variable_2, variable_3, "attributes"
+        )
+        jobs = [
+            (variable, map_service_, layer_, name_)
+            for map_service_, layer_, name_ in filtered_index[
+                ["map_service", "id", "name"]
+            ].values
+        ]
+        await self._run_layer_jobs(self._fetch_layer_attributes, jobs, max_workers)
+
+    async def _fetch_layer_attributes(
+        self, variable: str, map_service_: int, layer_: int, name_: str
+    ):
+        url = self._map_service_url(map_service_) + f"{layer_}"
+        layer_json, changed = await self._get_metadata(map_service_, layer_, url)
+        changed = self._definition_changed(map_service_, layer_, changed)
+        if not changed and os.path.exists(self._attributes_path(variable, name_)):
+            print(f"{map_service_}, {layer_}, {name_} unchanged")
+            return
+        await asyncio.to_thread(
+            self._save_layer_attributes,
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            layer_json,
+        )
+
+    async def _get_metadata(
+        self,
+        map_service: int,
+        layer: int,
+        url: str,
+        timeout: int = None,
+        revalidate: bool = False,
+    ):
+        """
+        Coroutine version of GEO_Client._get_metadata().
+        """
+        entry = self.metadata_cache.get(map_service, layer)
+        if not revalidate and self.metadata_cache.is_fresh(entry):
+            return entry["data"], False
+
+        await self.open()
+        params = {"token": self.token, "f": "json"}
+        try:
+            status, headers, data = await self._request(
+                url,
+                params,
+                headers=self.metadata_cache.validators(entry),
+                timeout=timeout,
+            )
+        except BadRequest as e:
+            return {"error": {"code": e.code, "message": str(e)}}, True
+        if status == 304:
+            self.metadata_cache.touch(map_service, layer)
+            return entry["data"], False
+        return data, self.metadata_cache.put(map_service, layer, data, headers)
+
+    async def get_all_attributes(self, max_workers: int = 1):
+        """
+        Getting all Attributes. Layers shared by aliased Map Services are requested once and copied (see plan_fetches()).
+        """
+        await self.plan_fetches()
+        for id, mapserv in map_service_dict.items():
+            await self.fetch_layers_attributes(
+                name_dict[mapserv], id, self._planned_layers(id), max_workers=max_workers
+            )
+        await asyncio.to_thread(self._copy_aliases, "attributes")
+
+    async def get_all_features(
+        self,
+        max_workers: int = 1,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        province: str = None,
+        resume: bool = False,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        """
+        Coroutine version of GEO_Client.get_all_features(). Layers from every MapService share the same max_workers limit.
+        Layers shared by aliased Map Services are fetched once and copied (see plan_fetches()).
+        Pages and layers are checkpointed in the run journal (outputs/journal/) as they are written, which is left on disk until RunJournal().clear().
+
+        Args:
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            tiled (bool, optional): Extract every layer by quadtree tiles of its extent. Defaults to False.
+            bbox (tuple, optional): Only refresh the features intersecting (xmin, ymin, xmax, ymax) in EPSG:4326. Defaults to None.
+            province (str, optional): Only refresh the features intersecting the bounding box of this province. Defaults to None.
+            resume (bool, optional): Continue an interrupted run with the same options from its last committed page per layer. Defaults to False.
+            fused (bool, optional): Build the final tables straight from the pages, so merge_and_parse_files_final() is not needed for them. Defaults to False.
+            raw (bool, optional): With fused, also write the features files. Defaults to False.
+        """
+        if province is not None:
+            bbox = await self.province_envelope(province)
+        await self.get_available_layers()
+        await self.plan_fetches()
+        jobs = []
+        for id, mapserv in map_service_dict.items():
+            jobs.extend(
+                await self._feature_jobs(
+                    name_dict[mapserv],
+                    id,
+                    self._planned_layers(id),
+                    profile=profile,
+                    tiled=tiled,
+                    bbox=bbox,
+                    fused=fused,
+                    raw=raw,
+                )
+            )
+        self.journal = RunJournal()
+        self.journal.start(
+            {
+                "features": "all",
+                "profile": profile,
+                "tiled": tiled,
+                "bbox": None if bbox is None else list(bbox),
+                "fused": fused,
+                "raw": raw,
+            },
+            resume,
+        )
+        try:
+            await self._run_layer_jobs(self._fetch_layer_features, jobs, max_workers)
+        finally:
+            self.journal = None
+        await asyncio.to_thread(self._copy_aliases, "features", profile)
+
+    async def fetch_missing_layers_features(
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        max_workers: int = 1,
+        profile: str = None,
+    ):
+        """
+        Coroutine version of GEO_Client.fetch_missing_layers_features().
+
+        Args:
+            variable (str): Name of the Map Service
+            variable_2 (int): Id of the Map Service
+            variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
+            max_workers (int, optional): Number of layers synced concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+        """
+        variable = profile_folder(variable, profile)
+        filtered_index = await self._filtered_index(
+            variable, variable_2, variable_3, "features"
+        )
+        filtered_index = filtered_index[~filtered_index["date"].isna()]
+        jobs = [
+            (variable, map_service_, layer_, name_, date_, profile)
+            for map_service_, layer_, name_, date_ in filtered_index[
+                ["map_service", "id", "name", "date2"]
+            ].values
+        ]
+        await self._run_layer_jobs(
+            self._fetch_missing_layer_features, jobs, max_workers
+        )
+
+    async def _fetch_missing_layer_features(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        date_: str,
+        profile: str = None,
+    ):
+        """
+        Coroutine version of GEO_Client._fetch_missing_layer_features(). The FeatureStore is read and written in a thread.
+        """
+        if self.journal is not None and self.journal.is_done(
+            variable, map_service_, layer_
+        ):
+            print(f"{map_service_}, {layer_}, {name_} already synced in this run, skipped")
+            return
+
+        await self.open()
+        start = time.perf_counter()
+        key = f"{map_service_}/{layer_}"
+        telemetry.name(key, f"{variable}/{name_}")
+        last_edit_date = layer_last_edit_date(
+            await self._layer_definition(map_service_, layer_, revalidate=True)
+        )
+        if self._unedited(variable, map_service_, layer_, name_, last_edit_date):
+            return
+
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(
+            profile_params(profile, variable, name_, out_fields=False)
+        )
+        feature_params["f"] = self._query_format(map_service_, layer_)
+
+        oid_field, live_ids = await self._query_object_ids(
+            url, map_service_, layer_, feature_params
+        )
+        if oid_field is None:
+            print(f"{map_service_}, {layer_}, {name_} has no objectIdField, skipped")
+            return
+
+        store = FeatureStore(
+            self._store_path(variable, name_), output_format=self.output_format
+        )
+        if not store.exists():
+            features_path = self._features_path(variable, name_)
+            if os.path.exists(features_path):
+                try:
+                    current_file = await asyncio.to_thread(read_table, features_path)
+                except:
+                    return
+            else:
+                print(
+                    f"{map_service_}, {layer_}, {name_} has no features file, fetching the whole layer"
+                )
+                current_file = pd.json_normalize(
+                    [
+                        feature
+                        async for page in self.feature_query_with_paging(
+                            url, map_service_, layer_, feature_params
+                        )
+                        for feature in page["features"]
+                    ]
+                )
+            await asyncio.to_thread(store.create, current_file, oid_field)
+            if os.path.exists(features_path):
+                os.remove(features_path)
+
+        stored_ids = await asyncio.to_thread(store.object_ids)
+
+        # Rows edited since the last sync, plus new OBJECTIDs in case they were created without a later DATEMODIFIED.
+        pages = [
+            page
+            async for page in self.feature_query_with_paging(
+                url,
+                map_service_,
+                layer_,
+                dict(feature_params, where=f"(DATEMODIFIED > DATE '{date_}')"),
+            )
+        ]
+        new_ids = np.setdiff1d(live_ids, stored_ids).tolist()
+        pages += [
+            page
+            async for page in self._query_id_ranges(
+                url, map_service_, layer_, feature_params, oid_field, new_ids
+            )
+        ]
+        await asyncio.to_thread(
+            self._sync_store,
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            store,
+            pages,
+            live_ids,
+            start,
+            last_edit_date,
+        )
+
+    async def get_new_features(
+        self, max_workers: int = 1, profile: str = None, resume: bool = False
+    ):
+        """
+        Coroutine version of GEO_Client.get_new_features(). Layers shared by aliased Map Services are synced once and copied (see plan_fetches()).
+
+        Args:
+            max_workers (int, optional): Number of layers synced concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            resume (bool, optional): Continue an interrupted run, skipping the layers it already synced. Defaults to False.
+        """
+        self.journal = RunJournal()
+        await self.plan_fetches()
+        self.journal.start({"features": "new", "profile": profile}, resume)
+        try:
+            for id, mapserv in map_service_dict.items():
+                await self.fetch_missing_layers_features(
+                    name_dict[mapserv],
+                    id,
+                    self._planned_layers(id),
+                    max_workers=max_workers,
+                    profile=profile,
+                )
+        finally:
+            self.journal = None
+        await asyncio.to_thread(self._copy_aliases, "features", profile)
+
+    async def province_envelope(self, province: str):
+        """
+        Coroutine version of GEO_Client.province_envelope(), reading the province borders in a thread.
+        """
+        return await asyncio.to_thread(GEO_Client.province_envelope, self, province)
@@ -0,0 +1,81 @@
+import json
+import hashlib
+import pandas as pd
+
+from .tiling import layer_envelope
+
+
+def layer_fingerprint(layer_json: dict):
+    """
+    Fingerprint of the dataset behind a layer definition: its serviceItemId, name, geometry type, fields and extent.
+    Aliased Map Services serving the same dataset give the same fingerprint.
+
+    Args:
+        layer_json (dict): Layer definition returned by the MapServer.
+
+    Returns:
+        fingerprint (str): SHA-1 hex digest, None for error responses.
+    """
+    if not layer_json or "error" in layer_json:
+        return None
+    envelope, wkid = layer_envelope(layer_json)
+    identity = {
+        "serviceItemId": layer_json.get("serviceItemId"),
+        "name": layer_json.get("name"),
+        "geometryType": layer_json.get("geometryType"),
+        "fields": [
+            (field.get("name"), field.get("type"))
+            for field in layer_json.get("fields") or []
+        ],
+        "extent": [round(value, 6) for value in envelope] + [wkid],
+    }
+    return hashlib.sha1(
+        json.dumps(identity, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def layer_last_edit_date(layer_json: dict):
+    """
+    editingInfo.lastEditDate of a layer definition: epoch milliseconds of the last edit, addition or deletion of its features,
+    None for error responses and layers without editor tracking.
+    """
+    if not layer_json or "error" in layer_json:
+        return None
+    return (layer_json.get("editingInfo") or {}).get("lastEditDate")
+
+
+def plan_fetches(index_df: pd.DataFrame):
+    """
+    Choose a single copy of every dataset to fetch.
+    Rows sharing a fingerprint, or saved to the same folder under the same name, are served by the first of them (in Map Service order),
+    the others are aliases whose outputs are copied from it.
+
+    Args:
+        index_df (pd.DataFrame): Layers with their map_service, id, name, folder and fingerprint.
+
+    Returns:
+        index_df (pd.DataFrame): Copy with primary_map_service and primary_id (the row that is fetched for each one) and fetch (True for the rows that are fetched).
+    """
+    by_fingerprint = {}
+    by_path = {}
+    primaries = []
+    for map_service_, layer_, folder, name_, fingerprint in index_df[
+        ["map_service", "id", "folder", "name", "fingerprint"]
+    ].values:
+        primary = by_path.get((folder, name_))
+        if primary is None and pd.notna(fingerprint):
+            primary = by_fingerprint.get(fingerprint)
+        if primary is None:
+            primary = (int(map_service_), int(layer_))
+        by_path.setdefault((folder, name_), primary)
+        if pd.notna(fingerprint):
+            by_fingerprint.setdefault(fingerprint, primary)
+        primaries.append(primary)
+
+    index_df = index_df.copy()
+    index_df["primary_map_service"] = [primary[0] for primary in primaries]
+    index_df["primary_id"] = [primary[1] for primary in primaries]
+    index_df["fetch"] = (index_df["primary_map_service"] == index_df["map_service"]) & (
+        index_df["primary_id"] == index_df["id"]
+    )
+    return index_df
@@ -0,0 +1,111 @@
+import json
+import time
+import threading
+import pandas as pd
+
+from .pbf import decode_feature_collection
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Compressed transfer encodings accepted for every query.
+query_headers = {"Accept-Encoding": "gzip, deflate"}
+
+
+def decode_response(content: bytes, content_type: str = ""):
+    """
+    Decode the body of a MapServer response exactly once: protobuf for f=pbf answers, JSON (orjson when installed) otherwise.
+    Errors are always returned as JSON, even for f=pbf requests.
+
+    Args:
+        content (bytes): Body of the response, already decompressed.
+        content_type (str, optional): Content-Type header of the response. Defaults to "".
+
+    Returns:
+        data (dict): Decoded response.
+    """
+    if "protobuf" in content_type or (
+        "json" not in content_type and content.lstrip()[:1] not in (b"{", b"[")
+    ):
+        return decode_feature_collection(content)
+    return loads(content)
+
+
+class DecodeStats:
+    """
+    Pages, bytes and time spent decoding the responses, per format (json / pbf) and layer.
+
+    Usage:
+        stats = DecodeStats()
+        data = stats.decode(content, content_type, "json", (map_service, layer))
+        stats.report()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def decode(self, content: bytes, content_type: str, query_format: str, key: tuple):
+        """
+        decode_response() the body and record how long it took.
+
+        Args:
+            content (bytes): Body of the response.
+            content_type (str): Content-Type header of the response.
+            query_format (str): Format that was requested (the f parameter).
+            key (tuple): (map service, layer) the response belongs to.
+
+        Returns:
+            data (dict): Decoded response.
+        """
+        start = time.perf_counter()
+        data = decode_response(content, content_type)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            pages, size, total = self.stats.get((query_format, *key), (0, 0, 0.0))
+            self.stats[(query_format, *key)] = (
+                pages + 1,
+                size + len(content),
+                total + seconds,
+            )
+        return data
+
+    def summary(self, map_service: int, layer: int):
+        """
+        One line with the decoding figures of a layer, e.g. "json: 12 pages, 3.1 MB, 4.2 ms/page".
+        """
+        with self._lock:
+            items = [
+                (query_format, values)
+                for (query_format, *key), values in self.stats.items()
+                if tuple(key) == (map_service, layer)
+            ]
+        return ", ".join(
+            f"{query_format}: {pages} pages, {size / 1e6:.1f} MB, {1e3 * seconds / pages:.1f} ms/page"
+            for query_format, (pages, size, seconds) in items
+        )
+
+    def report(self):
+        """
+        Returns:
+            report (pd.DataFrame): format, map_service, layer, pages, bytes, seconds and ms_per_page, to compare formats on the same layers.
+        """
+        with self._lock:
+            rows = [
+                (query_format, map_service, layer, pages, size, seconds)
+                for (query_format, map_service, layer), (
+                    pages,
+                    size,
+                    seconds,
+                ) in self.stats.items()
+            ]
+        report = pd.DataFrame(
+            rows,
+            columns=["format", "map_service", "layer", "pages", "bytes", "seconds"],
+        )
+        report["ms_per_page"] = 1e3 * report["seconds"] / report["pages"]
+        return report
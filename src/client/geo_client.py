@@ -4,15 +4,53 @@ from requests_ntlm import HttpNtlmAuth
 import re
 import json
 import pandas as pd
+import numpy as np
 import datetime
 import os
-from collections import defaultdict
+import shutil
+import threading
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import warnings
 
 warnings.filterwarnings("ignore")
 
-from ..config import OUTPUTS_DIR
+from ..config import (
+    OUTPUTS_DIR,
+    PAGES_IN_FLIGHT,
+    OUTPUT_FORMAT,
+    QUERY_FORMAT,
+    PAGE_SIZE,
+    TILE_MAX_RECORDS,
+    TILE_MAX_DEPTH,
+    PROVINCES_LAYER,
+)
 from ..utils import get_last_mod_date_files
+from ..domains import DomainDecoder
+from .metadata_cache import MetadataCache
+from .session_cache import SessionCache
+from .decoding import DecodeStats, query_headers
+from .http import HttpClient, RequestFailed, TokenExpired, BadRequest, backoff_delay
+from .paging import PageSizer
+from .tiling import split_envelope, envelope_params, layer_envelope
+from .catalog import layer_fingerprint, layer_last_edit_date, plan_fetches
+from ..manifest import SyncManifest
+from ..journal import RunJournal
+from ..telemetry import telemetry
+from ..profiles import profile_params, profile_folder
+from ..store import FeatureStore
+from ..final_tables import FinalWriter
+from ..spatial import spatial_index_path
+from ..lod import lod_path
+from ..writers import (
+    FeatureWriter,
+    read_table,
+    write_table,
+    table_extension,
+    max_date_modified,
+)
 
 pattern = re.compile(r'window\["_csrf_"\] = "([^"]+)"')
 map_service_list = [0, 1, 2, 3, 6, 7, 8]
@@ -48,6 +86,8 @@ def retry(retries=4):
                 except Exception as e:
                     print(f"Attempt {attempt + 1} failed: {e}")
                     last_exception = e
+                    if attempt + 1 < retries:
+                        time.sleep(backoff_delay(attempt))
             raise last_exception
 
         return wrapper
@@ -55,6 +95,22 @@ def retry(retries=4):
     return decorator_retry
 
 
+def ordered_map(func, items, max_in_flight: int):
+    """
+    Yield func(item) for every item in the same order as items, keeping at most max_in_flight calls running at a time.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque(
+            executor.submit(func, item) for item in islice(items, max_in_flight)
+        )
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+
+
 class GEO_Client:
 
     def __init__(
@@ -73,10 +129,33 @@ class GEO_Client:
         self.url = url
         self.login_url = login_url
         self.auth = HttpNtlmAuth(username, password)
-        self.all_features = defaultdict(list)
-        self.log_in()
+        self._token_lock = threading.Lock()
+        self.pages_in_flight = PAGES_IN_FLIGHT
+        self.output_format = OUTPUT_FORMAT
+        self.query_format = QUERY_FORMAT
+        self.decode_stats = DecodeStats()
+        # PageSizer of every (map service, layer) fetched, tuning its resultRecordCount.
+        self.page_sizers = {}
+        self.metadata_cache = MetadataCache()
+        self.session_cache = SessionCache()
+        self.session = requests.Session()
+        # Every metadata and query request goes through the pooled, rate limited and retrying request layer.
+        self.transport = HttpClient()
+        self._token = None
+        # Reuse the GEOToken of a previous run if it is still valid, otherwise log in on the first request.
+        self._load_session()
         self.index_df = None
-        self.modified_dates = get_last_mod_date_files()
+        # Layer definitions found changed by plan_fetches(), so fetch_layers_attributes() still rewrites their attributes.
+        self.changed_definitions = set()
+        # Run journal of get_all_features() / get_new_features(), None outside of them.
+        self.journal = None
+        self.manifest = SyncManifest()
+        # The manifest is read in milliseconds, the final tables are only scanned for the layers it has no date for
+        # (e.g. every layer before the first manifest, or layers fetched before it existed).
+        manifest_dates = self.manifest.modified_dates()
+        manifest_dates = manifest_dates[~manifest_dates["date"].isna()]
+        final_dates = get_last_mod_date_files(skip_names=set(manifest_dates["name"]))
+        self.modified_dates = pd.concat([manifest_dates, final_dates], ignore_index=True)
 
     @retry(retries=3)
     def log_in(self):
@@ -96,52 +175,194 @@ class GEO_Client:
         self.session = requests.Session()
         self.payload = {"username": self.username, "password": self.password}
 
-        self.response = self.session.get(self.home_url, auth=self.auth, verify=False)
-        self.soup_1 = BeautifulSoup(self.response.content, "html.parser")
+        with telemetry.span("login.ntlm"):
+            self.response = self.session.get(
+                self.home_url, auth=self.auth, verify=False
+            )
+            self.soup_1 = BeautifulSoup(self.response.content, "html.parser")
+
+            self.form = self.soup_1.find("form", {"id": "Form1"})
+            self.viewstate = self.form.find("input", {"name": "__VIEWSTATE"})["value"]
+            self.viewstate_gen = self.form.find(
+                "input", {"name": "__VIEWSTATEGENERATOR"}
+            )["value"]
+            self.eventvalidation = self.form.find(
+                "input", {"name": "__EVENTVALIDATION"}
+            )["value"]
+
+        with telemetry.span("login.form"):
+            self.payload = {
+                "__VIEWSTATE": self.viewstate,
+                "__VIEWSTATEGENERATOR": self.viewstate_gen,
+                "__EVENTVALIDATION": self.eventvalidation,
+            }
 
-        self.form = self.soup_1.find("form", {"id": "Form1"})
-        self.viewstate = self.form.find("input", {"name": "__VIEWSTATE"})["value"]
-        self.viewstate_gen = self.form.find("input", {"name": "__VIEWSTATEGENERATOR"})[
-            "value"
-        ]
-        self.eventvalidation = self.form.find("input", {"name": "__EVENTVALIDATION"})[
-            "value"
-        ]
+            self.form_action_url = self.home_url + self.form["action"]
+            self.form_response = self.session.post(
+                self.form_action_url, data=self.payload, auth=self.auth, verify=False
+            )
+            self.form_soup = BeautifulSoup(self.form_response.content, "html.parser")
 
-        self.payload = {
-            "__VIEWSTATE": self.viewstate,
-            "__VIEWSTATEGENERATOR": self.viewstate_gen,
-            "__EVENTVALIDATION": self.eventvalidation,
-        }
+        with telemetry.span("login.oauth"):
+            self.response_2 = self.session.get(self.url, verify=False)
+            self.soup_2 = BeautifulSoup(self.response_2.content, "html.parser")
 
-        self.form_action_url = self.home_url + self.form["action"]
-        self.form_response = self.session.post(
-            self.form_action_url, data=self.payload, auth=self.auth, verify=False
-        )
-        self.form_soup = BeautifulSoup(self.form_response.content, "html.parser")
+            self.input_string = self.soup_2.find_all("script")[2].string
+            vals = re.search(
+                r"var oAuthInfo = ({.*?})\r\n", self.input_string, re.DOTALL
+            )
+            self.auth_data = json.loads(vals.group(1))
+
+        with telemetry.span("login.signin"):
+            self.payload = {
+                "oauth_state": self.auth_data["oauth_state"],
+                "authorize": "true",
+                "username": self.username_2,
+                "password": self.password,
+            }
 
-        self.response_2 = self.session.get(self.url, verify=False)
-        self.soup_2 = BeautifulSoup(self.response_2.content, "html.parser")
+            self.response_signin = self.session.post(
+                self.login_url, data=self.payload, verify=False
+            )
+            self.soup_signin = BeautifulSoup(
+                self.response_signin.content, "html.parser"
+            )
 
-        self.input_string = self.soup_2.find_all("script")[2].string
-        vals = re.search(r"var oAuthInfo = ({.*?})\r\n", self.input_string, re.DOTALL)
-        self.auth_data = json.loads(vals.group(1))
+            token_re = re.search(r"gcx-(.*)", self.soup_signin.find("form")["action"])
+            self.token = token_re.group(1)
+        print("Logged in and retrieved GEOToken")
+        try:
+            self.session_cache.save(self._secret(), self.token, self.session.cookies)
+        except OSError as e:
+            print(f"Could not cache the session: {e}")
 
-        self.payload = {
-            "oauth_state": self.auth_data["oauth_state"],
-            "authorize": "true",
-            "username": self.username_2,
-            "password": self.password,
-        }
+    @property
+    def token(self):
+        """
+        GEOToken of the session. Logging in is deferred until it is first needed.
+        """
+        if self._token is None:
+            self.refresh_token(None)
+        return self._token
 
-        self.response_signin = self.session.post(
-            self.login_url, data=self.payload, verify=False
-        )
-        self.soup_signin = BeautifulSoup(self.response_signin.content, "html.parser")
+    @token.setter
+    def token(self, value: str):
+        self._token = value
 
-        token_re = re.search(r"gcx-(.*)", self.soup_signin.find("form")["action"])
-        self.token = token_re.group(1)
-        print("Logged in and retrieved GEOToken")
+    def _secret(self):
+        return f"{self.username}:{self.username_2}:{self.password}:{self.url}"
+
+    def _load_session(self):
+        """
+        Restore the GEOToken and cookies cached by a previous log in, if they have not expired.
+
+        Returns:
+            loaded (bool): True if a cached session was restored.
+        """
+        token, cookies = self.session_cache.load(self._secret())
+        if token is None:
+            return False
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+            )
+        self._token = token
+        print("Reusing cached GEOToken")
+        return True
+
+    def refresh_token(self, stale_token: str):
+        """
+        Re-log-in after a request failed with an expired GEOToken.
+        Workers that hit the same expired token wait for the first one to log in and reuse its new token, so only one log_in() is made.
+
+        Args:
+            stale_token (str): Token that was sent with the failed request, None to log in for the first time.
+
+        Returns:
+            token (str): Valid GEOToken.
+        """
+        with self._token_lock:
+            if self._token == stale_token:
+                self.log_in()
+            return self._token
+
+    def _request(
+        self,
+        url: str,
+        params: dict,
+        headers: dict = None,
+        timeout: int = None,
+        decode=None,
+    ):
+        """
+        GET through self.transport, sending the cookies of the logged in (or restored) self.session along, e.g. the Geocortex ones.
+        If the GEOToken has expired, log in again (once for all the threads holding it), update params["token"] and repeat the request.
+
+        Returns:
+            response (requests.Response): Response of the server.
+            data (dict): Decoded body, None for a 304 Not Modified.
+        """
+        try:
+            return self.transport.get(
+                url, params, headers, timeout, decode, self.session.cookies
+            )
+        except TokenExpired as e:
+            print(f"{e}, re-logging in")
+            params["token"] = self.refresh_token(params["token"])
+            return self.transport.get(
+                url, params, headers, timeout, decode, self.session.cookies
+            )
+
+    def _map_service_url(self, map_service: int):
+        return f"{self.url}Essentials/REST/sites/SIN/map/mapservices/{map_service}/rest/services/x/MapServer/"
+
+    def _filtered_index(self, variable: str, variable_2: int, variable_3: list, folder: str):
+        """
+        Get the rows of self.index_df for the given MapService (variable_2) and layers (variable_3), making sure the output folder exists.
+        """
+        if isinstance(self.index_df, pd.DataFrame):
+            pass
+        else:
+            self.get_available_layers()
+
+        os.makedirs(os.path.join(OUTPUTS_DIR, variable, folder), exist_ok=True)
+
+        if variable_3 == None:
+            return self.index_df[self.index_df["map_service"] == variable_2]
+        return self.index_df[
+            (self.index_df["map_service"] == variable_2)
+            & (self.index_df["id"].isin(variable_3))
+        ]
+
+    def _run_layer_jobs(self, job, jobs: list, max_workers: int = 1):
+        """
+        Run job(*args) for every args tuple in jobs, either serially or across a pool of max_workers threads.
+        Failed layers do not stop the rest of the pool; they are reported once all jobs have finished.
+
+        Args:
+            job (callable): Method processing a single layer.
+            jobs (list): List of argument tuples, one per layer.
+            max_workers (int, optional): Number of layers processed at the same time. Defaults to 1.
+        """
+        if max_workers <= 1:
+            for args in jobs:
+                job(*args)
+            return
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(job, *args): args for args in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed {futures[future][1:]}: {e}")
+                    failed.append(futures[future][1:])
+        if failed:
+            raise RuntimeError(f"{len(failed)} layers failed: {failed}")
 
     def get_available_layers(self):
         """
@@ -154,14 +375,11 @@ class GEO_Client:
 
         for map_service in map_service_list:
             try:
-                url = f"https://arcgis.coess.io/Geocortex/Essentials/REST/sites/SIN/map/mapservices/{map_service}/rest/services/x/MapServer/"
-                # Append the token to the request parameters
-                self.index_params = {"f": "json", "token": f"{self.token}"}
-                # Make the request for seeing the available layers to extract data from.
-                self.index_response = requests.get(
-                    url, verify=False, params=self.index_params, timeout=30
+                # The MapServer index comes from the metadata cache while it is fresh.
+                index_json, _ = self._get_metadata(
+                    map_service, None, self._map_service_url(map_service), timeout=30
                 )
-                aux = pd.json_normalize(self.index_response.json()["layers"])
+                aux = pd.json_normalize(index_json["layers"])
                 aux["map_service"] = map_service
                 aux["map_service_name"] = map_service_dict[map_service]
                 self.index_df = pd.concat([self.index_df, aux])
@@ -173,8 +391,205 @@ class GEO_Client:
 
         return self.index_df
 
+    def _layer_definition(self, map_service_: int, layer_: int, revalidate: bool = False):
+        """
+        Definition of a layer through the metadata cache, outside of fetch_layers_attributes().
+        If it changed, it is recorded in self.changed_definitions so its attributes are still rewritten.
+        With revalidate, the cached definition is revalidated even if it has not expired.
+        """
+        url = self._map_service_url(map_service_) + f"{layer_}"
+        layer_json, changed = self._get_metadata(
+            map_service_, layer_, url, revalidate=revalidate
+        )
+        if changed:
+            self.changed_definitions.add((map_service_, layer_))
+        return layer_json
+
+    def _layer_fingerprint(self, map_service_: int, layer_: int):
+        """
+        Fingerprint of a layer from its definition.
+        """
+        return layer_fingerprint(self._layer_definition(map_service_, layer_))
+
+    def plan_fetches(self):
+        """
+        Fingerprint every layer of self.index_df and plan a single fetch per dataset.
+        Aliased Map Services (0 and 8 are both "capital", 1 and 7 both "provincia") list the same layers, which are then only fetched from the first one,
+        and layers saved to the same folder under the same name are only fetched once. The outputs of the aliases are copied by _copy_aliases().
+
+        Returns:
+            self.index_df (pd.DataFrame): With the folder, fingerprint, primary_map_service, primary_id and fetch columns.
+        """
+        if not isinstance(self.index_df, pd.DataFrame):
+            self.get_available_layers()
+        if "fetch" in self.index_df.columns:
+            return self.index_df
+
+        with ThreadPoolExecutor(max_workers=max(1, self.pages_in_flight)) as executor:
+            fingerprints = list(
+                executor.map(
+                    lambda row: self._layer_fingerprint(*row),
+                    self.index_df[["map_service", "id"]].values.tolist(),
+                )
+            )
+        return self._plan(fingerprints)
+
+    def _plan(self, fingerprints: list):
+        index_df = self.index_df.copy()
+        index_df["folder"] = index_df["map_service_name"].map(name_dict)
+        index_df["fingerprint"] = fingerprints
+        self.index_df = plan_fetches(index_df)
+
+        fingerprint_of = self.index_df.set_index(["map_service", "id"])["fingerprint"]
+        aliases = self.index_df[~self.index_df["fetch"]]
+        for alias in aliases.itertuples():
+            primary_fingerprint = fingerprint_of[
+                (alias.primary_map_service, alias.primary_id)
+            ]
+            if primary_fingerprint != alias.fingerprint:
+                print(
+                    f"{alias.map_service}, {alias.id}, {alias.name} differs from {alias.primary_map_service}, {alias.primary_id} but is saved to the same {alias.folder}/{alias.name}, only the latter is fetched"
+                )
+        print(
+            f"{len(self.index_df) - len(aliases)} layers to fetch, {len(aliases)} aliased layers served by them"
+        )
+        return self.index_df
+
+    def _planned_layers(self, map_service: int):
+        """
+        Layers of a Map Service fetched by the plan of plan_fetches().
+        """
+        planned = self.index_df[
+            (self.index_df["map_service"] == map_service) & self.index_df["fetch"]
+        ]
+        return planned["id"].tolist()
+
+    def _definition_changed(self, map_service_: int, layer_: int, changed: bool):
+        """
+        changed, or True if the definition was found changed while planning the fetches.
+        """
+        if (map_service_, layer_) in self.changed_definitions:
+            self.changed_definitions.discard((map_service_, layer_))
+            return True
+        return changed
+
+    def _copy_aliases(self, folder: str, profile: str = "full"):
+        """
+        Copy the attributes ("attributes") or features ("features") of every fetched layer to its aliases saved to another folder or under another name,
+        so every Map Service folder keeps its own copy of the layers. The manifest entry of the features is copied along.
+        The features of a profile other than "full" are copied between its profile folders (see profiles.profile_folder()).
+        """
+        primaries = self.index_df.set_index(["map_service", "id"])
+        aliases = self.index_df[~self.index_df["fetch"]]
+        for alias in aliases.itertuples():
+            map_service_, layer_, name_, variable = (
+                alias.map_service,
+                alias.id,
+                alias.name,
+                profile_folder(alias.folder, profile),
+            )
+            primary = primaries.loc[
+                (alias.primary_map_service, alias.primary_id)
+            ].copy()
+            primary["folder"] = profile_folder(primary["folder"], profile)
+            if (primary["folder"], primary["name"]) == (variable, name_):
+                continue
+            os.makedirs(os.path.join(OUTPUTS_DIR, variable, folder), exist_ok=True)
+            os.makedirs(os.path.join(OUTPUTS_DIR, variable, "final"), exist_ok=True)
+            if folder == "attributes":
+                outputs = [
+                    (
+                        os.path.join(
+                            OUTPUTS_DIR, primary["folder"], folder, primary["name"]
+                        ),
+                        os.path.join(OUTPUTS_DIR, variable, folder, name_),
+                    ),
+                    (
+                        self._attributes_path(primary["folder"], primary["name"]),
+                        self._attributes_path(variable, name_),
+                    ),
+                ]
+            else:
+                outputs = [
+                    (
+                        self._store_path(primary["folder"], primary["name"]),
+                        self._store_path(variable, name_),
+                    ),
+                    (
+                        self._features_path(primary["folder"], primary["name"]),
+                        self._features_path(variable, name_),
+                    ),
+                    # Final tables, spatial indexes and LOD pyramids built by the fused pipeline, rebuilt from the features otherwise.
+                    (
+                        self._final_path(primary["folder"], primary["name"]),
+                        self._final_path(variable, name_),
+                    ),
+                    (
+                        spatial_index_path(primary["folder"], primary["name"]),
+                        spatial_index_path(variable, name_),
+                    ),
+                    (
+                        lod_path(primary["folder"], primary["name"]),
+                        lod_path(variable, name_),
+                    ),
+                ]
+            for source, target in outputs:
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif os.path.exists(target):
+                    os.remove(target)
+                if os.path.isdir(source):
+                    shutil.copytree(source, target)
+                elif os.path.exists(source):
+                    shutil.copy2(source, target)
+            if folder == "features":
+                synced = self.manifest.get(primary["folder"], primary["name"])
+                if synced is not None:
+                    self.manifest.update(
+                        variable,
+                        map_service_,
+                        layer_,
+                        name_,
+                        synced["high_water_mark"],
+                        synced["rows"],
+                    )
+            print(
+                f"{map_service_}, {layer_}, {name_} {folder} copied from {alias.primary_map_service}, {alias.primary_id}"
+            )
+
+    def _feature_jobs(
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        # Profiles other than "full" are saved to their own folder.
+        variable = profile_folder(variable, profile)
+        filtered_index = self._filtered_index(variable, variable_2, variable_3, "features")
+        return [
+            (variable, map_service_, layer_, name_, profile, tiled, bbox, fused, raw)
+            for map_service_, layer_, name_ in filtered_index[
+                ["map_service", "id", "name"]
+            ].values
+        ]
+
     def fetch_layers_features(
-        self, variable: str, variable_2: int, variable_3: list = None
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        max_workers: int = 1,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        province: str = None,
+        fused: bool = False,
+        raw: bool = False,
     ):
         """
         Send petition to fetch the features from the given MapService (variable: name, variable_2: ID) and the list of layers from that MapService to be retrieved (variable_3).
@@ -184,91 +599,721 @@ class GEO_Client:
             variable (str): Name of the Map Service
             variable_2 (int): Id of the Map Service
             variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile (fields, geometry) from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            tiled (bool, optional): Split the extent of each layer in a quadtree of envelopes queried in parallel. Defaults to False.
+            bbox (tuple, optional): (xmin, ymin, xmax, ymax) in EPSG:4326. Only the features intersecting it are refreshed, upserted into the layer's FeatureStore. Defaults to None.
+            province (str, optional): Same as bbox, with the bounding box of this province. Defaults to None.
+            fused (bool, optional): Build the final tables straight from the pages, without the features files (see FinalWriter). Defaults to False.
+            raw (bool, optional): With fused, also write the features files. Defaults to False.
         """
+        if province is not None:
+            bbox = self.province_envelope(province)
+        self._run_layer_jobs(
+            self._fetch_layer_features,
+            self._feature_jobs(
+                variable, variable_2, variable_3, profile, tiled, bbox, fused, raw
+            ),
+            max_workers,
+        )
 
-        if isinstance(self.index_df, pd.DataFrame):
-            pass
-        else:
-            self.get_available_layers()
+    def _fetch_layer_features(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        fused: bool = False,
+        raw: bool = False,
+    ):
+        """
+        Fetch all the features of a single layer and save them in outputs/{variable}/features/.
+        With fused, every page is turned into final table rows as it arrives and the final table is saved in outputs/{variable}/final/ instead,
+        along with the features file only if raw.
+        All the state of the layer is local, so this can run from several threads at once.
+        Inside a journaled run, layers already done are skipped and every page is committed to the journal as it is written,
+        so an interrupted layer continues its file from the last committed page (tiled layers, deduplicated across tiles, start again from scratch).
+        """
+        if self.journal is not None and self.journal.is_done(
+            variable, map_service_, layer_
+        ):
+            print(f"{map_service_}, {layer_}, {name_} already fetched in this run, skipped")
+            return
+
+        start = time.perf_counter()
+        key = f"{map_service_}/{layer_}"
+        telemetry.name(key, f"{variable}/{name_}")
+
+        if bbox is not None:
+            self._refresh_layer_envelope(
+                variable, map_service_, layer_, name_, bbox, profile
+            )
+            if self.journal is not None:
+                self.journal.finish_layer(variable, map_service_, layer_)
+            return
 
-        if variable not in os.listdir(OUTPUTS_DIR):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable))
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
 
-        if "features" not in os.listdir(os.path.join(OUTPUTS_DIR, variable)):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable, "features"))
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(profile_params(profile, variable, name_))
+        feature_params["f"] = self._query_format(map_service_, layer_)
 
-        if variable_3 == None:
-            filtered_index = self.index_df[self.index_df["map_service"] == variable_2]
-        else:
-            filtered_index = self.index_df[
-                (self.index_df["map_service"] == variable_2)
-                & (self.index_df["id"].isin(variable_3))
+        journaled = self.journal is not None and not tiled
+
+        # Make the request, writing every page to disk as it arrives.
+        writer = self._layer_writer(
+            variable,
+            name_,
+            key,
+            self._layer_definition(map_service_, layer_) if fused else None,
+            raw,
+        )
+        committed = False
+        try:
+            checkpoint = (
+                self._resume_layer(writer, variable, map_service_, layer_, name_)
+                if journaled
+                else None
+            )
+            if tiled:
+                envelope, wkid = self._layer_envelope(map_service_, layer_)
+                pages = self.tiled_query_with_paging(
+                    url, map_service_, layer_, feature_params, envelope, wkid
+                )
+            else:
+                pages = self.feature_query_with_paging(
+                    url, map_service_, layer_, feature_params, checkpoint
+                )
+            last_oid = None if checkpoint is None else checkpoint["last_oid"]
+            committed = checkpoint is not None
+            for page in pages:
+                df = writer.write(page)
+                if journaled:
+                    last_oid = self._commit_page(
+                        variable, map_service_, layer_, writer, df, page, last_oid
+                    )
+                    committed = True
+        except:
+            # Once a page is committed, the file is kept for the checkpoint.
+            writer.abort(keep=journaled and committed)
+            raise
+        writer.close()
+        self._finish_layer_features(
+            variable, map_service_, layer_, name_, writer, fused, raw, start
+        )
+
+    def _layer_writer(
+        self, variable: str, name_: str, key: str, layer_json: dict = None, raw: bool = False
+    ):
+        """
+        Writer of the pages of a layer: a FinalWriter when the definition of the layer is given (fused), a FeatureWriter otherwise.
+        """
+        if layer_json is not None:
+            return FinalWriter(
+                self._final_path(variable, name_),
+                DomainDecoder.from_layer_json(layer_json),
+                key,
+                self._features_path(variable, name_) if raw else None,
+            )
+        return FeatureWriter(self._features_path(variable, name_), key)
+
+    def _resume_layer(
+        self, writer, variable: str, map_service_: int, layer_: int, name_: str
+    ):
+        """
+        Continue the file the interrupted run was writing for the layer from its last committed page, the query of the layer then only asks for the rest.
+
+        Returns:
+            checkpoint (dict): Journal state of the layer, None if it starts from scratch.
+        """
+        checkpoint = self.journal.layer(variable, map_service_, layer_)
+        if checkpoint is None:
+            return None
+        if not writer.resumable(checkpoint["writer"]):
+            print(
+                f"{map_service_}, {layer_}, {name_} file of the interrupted run is gone, fetched from scratch"
+            )
+            return None
+        writer.resume(checkpoint["writer"])
+        print(
+            f"{map_service_}, {layer_}, {name_} resumed from {checkpoint['rows']} features"
+        )
+        return checkpoint
+
+    def _commit_page(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        writer,
+        df: pd.DataFrame,
+        page: dict,
+        last_oid: int = None,
+    ):
+        """
+        Commit the page just written by writer to the run journal.
+
+        Returns:
+            last_oid (int): Highest objectId committed for the layer.
+        """
+        oid_column = f"attributes.{self._page_oid_field(page)}"
+        if oid_column in df.columns and len(df):
+            last_oid = max(df[oid_column].max(), last_oid or 0)
+        with telemetry.span("checkpoint", f"{map_service_}/{layer_}", rows=len(df)):
+            self.journal.commit_page(
+                variable, map_service_, layer_, writer.checkpoint(), last_oid
+            )
+        return last_oid
+
+    def _finish_layer_features(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        writer,
+        fused: bool,
+        raw: bool,
+        start: float,
+    ):
+        """
+        Once the writer of a layer is closed, drop the files its snapshot supersedes and record the layer in the manifest and the run journal.
+        """
+        key = f"{map_service_}/{layer_}"
+        if fused and not raw and os.path.exists(self._features_path(variable, name_)):
+            # A features file of a previous run would be merged over the fused final table.
+            os.remove(self._features_path(variable, name_))
+        # The full snapshot supersedes the incremental store of the layer.
+        if os.path.isdir(self._store_path(variable, name_)):
+            shutil.rmtree(self._store_path(variable, name_))
+        self.manifest.update(
+            variable, map_service_, layer_, name_, writer.high_water_mark, writer.rows
+        )
+        if self.journal is not None:
+            self.journal.finish_layer(variable, map_service_, layer_, writer.rows)
+        telemetry.record("layer", key, time.perf_counter() - start, rows=writer.rows)
+        print(f"{map_service_}, {layer_}, {name_} saved")
+        print(
+            f"{map_service_}, {layer_}, {name_} decoded: {self.decode_stats.summary(map_service_, layer_)}"
+        )
+        print(
+            f"{map_service_}, {layer_}, {name_} paging: {self._page_sizer(map_service_, layer_).summary()}"
+        )
+
+    def _layer_envelope(self, map_service_: int, layer_: int):
+        """
+        Extent of a layer as (envelope, wkid), from its (cached) definition.
+        """
+        layer_json, _ = self._get_metadata(
+            map_service_, layer_, self._map_service_url(map_service_) + f"{layer_}"
+        )
+        return layer_envelope(layer_json)
+
+    def _query_count(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Number of features matching the query (returnCountOnly), None if the layer cannot answer.
+        """
+        params = {
+            key: value
+            for key, value in params.items()
+            if key not in ("resultOffset", "resultRecordCount")
+        }
+        params["returnCountOnly"] = "true"
+        params["f"] = "json"
+        data = self._query_page(url, mapservice, layer, params)
+        if data is None:
+            return None
+        return data.get("count")
+
+    def _quadtree_tiles(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        envelope: tuple,
+        wkid: int,
+    ):
+        """
+        Split envelope in a quadtree until every tile has at most TILE_MAX_RECORDS features (or is TILE_MAX_DEPTH levels deep).
+        The counts of each level are requested in parallel, empty tiles are dropped.
+
+        Returns:
+            tiles (list): Envelopes of the leaves.
+        """
+        tiles = []
+        level = [(envelope, 0)]
+        with ThreadPoolExecutor(max_workers=max(1, self.pages_in_flight)) as executor:
+            while level:
+                counts = executor.map(
+                    lambda tile: self._query_count(
+                        url,
+                        mapservice,
+                        layer,
+                        envelope_params(feature_params, tile[0], wkid),
+                    ),
+                    level,
+                )
+                next_level = []
+                for (tile, depth), count in zip(level, counts):
+                    if not count:
+                        continue
+                    if count > TILE_MAX_RECORDS and depth < TILE_MAX_DEPTH:
+                        next_level.extend(
+                            (quadrant, depth + 1) for quadrant in split_envelope(tile)
+                        )
+                    else:
+                        tiles.append(tile)
+                level = next_level
+        return tiles
+
+    def tiled_query_with_paging(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        envelope: tuple,
+        wkid: int,
+    ):
+        """
+        Query the features of envelope tile by tile: the tiles of the quadtree are fetched in parallel (each one paged by objectId ranges)
+        and features on the border of several tiles are only yielded once.
+
+        Args:
+            url (str): url for requests.get()
+            mapservice (int): Id of the Map Service.
+            layer (int): Id of the layer.
+            feature_params (dict): Query parameters.
+            envelope (tuple): (xmin, ymin, xmax, ymax) to extract.
+            wkid (int): Spatial reference of envelope.
+
+        Yields:
+            page (dict): Query response with the "features" of the page not seen in previous tiles.
+        """
+        tiles = self._quadtree_tiles(
+            url, mapservice, layer, feature_params, envelope, wkid
+        )
+        print(f"Querying {len(tiles)} tiles, {mapservice}, {layer}")
+        seen = set()
+        for pages in ordered_map(
+            lambda tile: list(
+                self.feature_query_with_paging(
+                    url, mapservice, layer, envelope_params(feature_params, tile, wkid)
+                )
+            ),
+            tiles,
+            max(1, self.pages_in_flight),
+        ):
+            for page in pages:
+                yield self._unseen_features(page, seen)
+
+    @classmethod
+    def _unseen_features(cls, page: dict, seen: set):
+        """
+        page without the features whose objectId is in seen, which is updated with the objectIds of the page.
+        """
+        oid_field = cls._page_oid_field(page)
+        if oid_field is None:
+            return page
+        features = []
+        for feature in page["features"]:
+            object_id = feature["attributes"].get(oid_field)
+            if object_id not in seen:
+                seen.add(object_id)
+                features.append(feature)
+        return dict(page, features=features)
+
+    @staticmethod
+    def _page_oid_field(page: dict):
+        """
+        Name of the objectId field of a query response, None if it does not have one.
+        """
+        return page.get("objectIdFieldName") or next(
+            (
+                field["name"]
+                for field in page.get("fields") or []
+                if field.get("type") == "esriFieldTypeOID"
+            ),
+            None,
+        )
+
+    def _refresh_layer_envelope(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        bbox: tuple,
+        profile: str = None,
+    ):
+        """
+        Partial refresh: upsert the features intersecting bbox (EPSG:4326) into the FeatureStore of the layer.
+        Deletions are not detected, and the DATEMODIFIED high-water mark is left as it was since the rest of the layer was not synced.
+        """
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(
+            profile_params(profile, variable, name_, out_fields=False)
+        )
+        feature_params["f"] = self._query_format(map_service_, layer_)
+
+        changes = pd.json_normalize(
+            [
+                feature
+                for page in self.tiled_query_with_paging(
+                    url, map_service_, layer_, feature_params, tuple(bbox), 4326
+                )
+                for feature in page["features"]
             ]
+        )
 
-        for map_service_, layer_, name_ in filtered_index[
-            ["map_service", "id", "name"]
-        ].values:
+        store = FeatureStore(
+            self._store_path(variable, name_), output_format=self.output_format
+        )
+        oid_field = None
+        if not store.exists():
+            oid_field, _ = self._query_object_ids(
+                url, map_service_, layer_, dict(feature_params, where="1=0")
+            )
+            if oid_field is None:
+                print(f"{map_service_}, {layer_}, {name_} has no objectIdField, skipped")
+                return
+        self._upsert_envelope(
+            variable, map_service_, layer_, name_, bbox, store, changes, oid_field
+        )
 
-            url = f"https://arcgis.coess.io/Geocortex/Essentials/REST/sites/SIN/map/mapservices/{map_service_}/rest/services/x/MapServer/{layer_}/query"
-
-            # Append the token to the request parameters
-            self.feature_params = {
-                "token": f"{self.token}",  # Token form the webpage after signing in.
-                "f": "json",  # Fromat we want.
-                "returnGeometry": "true",  # We want the coordinates.
-                "where": "('1' = '1')",  # We want to query everything within the ID we have selected.
-                "spatialRel": "esriSpatialRelIntersects",
-                "outFields": "*",  # All
-                "outSR": "4326",  # We want the normal coordinates used in the world.
-                "resultOffset": 0,  # Starting at the first record
-                "resultRecordCount": 1000,  # Number of records to fetch per request
-            }
+    def _upsert_envelope(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        bbox: tuple,
+        store: FeatureStore,
+        changes: pd.DataFrame,
+        oid_field: str = None,
+    ):
+        """
+        Upsert the features refreshed in bbox into the FeatureStore of a layer, which is built from its features file first if it does not exist yet.
+        """
+        if not store.exists():
+            try:
+                current_file = read_table(self._features_path(variable, name_))
+            except:
+                current_file = pd.DataFrame(columns=[f"attributes.{oid_field}"])
+            store.create(current_file, oid_field)
+            if os.path.exists(self._features_path(variable, name_)):
+                os.remove(self._features_path(variable, name_))
+
+        written = store.upsert(changes)
+        synced = self.manifest.get(variable, name_) or {}
+        self.manifest.update(
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            synced.get("high_water_mark"),
+            len(store.object_ids()),
+        )
+        print(
+            f"{map_service_}, {layer_}, {name_} refreshed in {bbox}: {len(changes)} upserted, {len(written)} partitions written"
+        )
+
+    def province_envelope(self, province: str):
+        """
+        Bounding box of a province, from the final table with the province borders (config.PROVINCES_LAYER).
+
+        Args:
+            province (str): Value of any text column of that table (case insensitive), e.g. the name of the province.
+
+        Returns:
+            bbox (tuple): (xmin, ymin, xmax, ymax) in EPSG:4326.
+        """
+        variable, name_ = PROVINCES_LAYER
+        path = os.path.join(
+            OUTPUTS_DIR, variable, "final", f"{name_}{table_extension(self.output_format)}"
+        )
+        borders = read_table(path)
+        match = pd.Series(False, index=borders.index)
+        for col in borders.columns:
+            if borders[col].dtype == object or isinstance(
+                borders[col].dtype, pd.CategoricalDtype
+            ):
+                match |= (
+                    borders[col].astype(str).str.strip().str.upper()
+                    == province.strip().upper()
+                )
+        rows = borders[match]
+        if len(rows) == 0:
+            raise ValueError(f"Province {province} not found in {path}")
+        return (
+            float(rows["xmin"].min()),
+            float(rows["ymin"].min()),
+            float(rows["xmax"].max()),
+            float(rows["ymax"].max()),
+        )
+
+    def _feature_params(self, where: str):
+        """
+        Query parameters for fetching the features matching the where clause.
+        """
+        # Append the token to the request parameters
+        return {
+            "token": f"{self.token}",  # Token form the webpage after signing in.
+            "f": "json",  # Fromat we want.
+            "returnGeometry": "true",  # We want the coordinates.
+            "where": where,  # We want to query everything within the ID we have selected.
+            "spatialRel": "esriSpatialRelIntersects",
+            "outFields": "*",  # All
+            "outSR": "4326",  # We want the normal coordinates used in the world.
+            "resultOffset": 0,  # Starting at the first record
+            "resultRecordCount": PAGE_SIZE,  # Number of records to fetch per request, tuned per layer by its PageSizer
+        }
+
+    def _features_path(self, variable: str, name_: str):
+        return os.path.join(
+            OUTPUTS_DIR,
+            variable,
+            "features",
+            f"{name_}{table_extension(self.output_format)}",
+        )
+
+    def _final_path(self, variable: str, name_: str):
+        return os.path.join(
+            OUTPUTS_DIR,
+            variable,
+            "final",
+            f"{name_}{table_extension(self.output_format)}",
+        )
+
+    def _query_page(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Request a single page of features. Retries, backoff and re-logging in are handled by the request layer.
+
+        Returns:
+            data (dict): JSON response, or None if the server rejected the query (400) or for layers known to have no features.
+        """
+        try:
+            return self._get_page(url, mapservice, layer, params)
+        except BadRequest as e:
+            print(f"Query skipped, {mapservice}, {layer}: {e}")
+            return None
+        except RequestFailed:
+            if (mapservice, layer) in map_layers_without_features:
+                print("Error captured")
+                return None
+            raise
+
+    def _get_page(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        GET a query (gzip accepted) and decode its body once, recording the decode time in self.decode_stats.
+        The time and size of feature pages are fed to the PageSizer of the layer.
+        """
+        sizes = []
+        key = f"{mapservice}/{layer}"
+
+        def decode(response):
+            sizes.append(len(response.content))
+            with telemetry.span("decode", key, bytes=len(response.content)):
+                return self.decode_stats.decode(
+                    response.content,
+                    response.headers.get("Content-Type", ""),
+                    params.get("f", "json"),
+                    (mapservice, layer),
+                )
 
-            # Make the request
-            self.feature_query_with_paging(url, map_service_, layer_)
-            pd.json_normalize(self.all_features[layer_]).to_csv(
-                os.path.join(OUTPUTS_DIR, variable, "features", f"{name_}.csv"),
-                index=False,
+        start = time.perf_counter()
+        _, data = self._request(url, params, headers=query_headers, decode=decode)
+        seconds = time.perf_counter() - start
+        rows = len(data.get("features") or [])
+        telemetry.record("request", key, seconds, sizes[-1], rows)
+        if "resultRecordCount" in params and "features" in data:
+            self._page_sizer(mapservice, layer).observe(
+                len(data["features"]), seconds, sizes[-1], params["resultRecordCount"]
+            )
+        return data
+
+    def _page_sizer(self, map_service_: int, layer_: int):
+        """
+        PageSizer of a layer, capped by the maxRecordCount of its cached definition.
+        """
+        key = (map_service_, layer_)
+        if key not in self.page_sizers:
+            entry = self.metadata_cache.get(map_service_, layer_) or {}
+            # setdefault is atomic, threads racing on a new layer all get the same sizer.
+            self.page_sizers.setdefault(
+                key, PageSizer((entry.get("data") or {}).get("maxRecordCount"))
+            )
+        return self.page_sizers[key]
+
+    def _query_format(self, map_service_: int, layer_: int):
+        """
+        f parameter of the feature queries of a layer: "pbf" when configured and listed in the supportedQueryFormats of its cached definition, "json" otherwise.
+        """
+        if self.query_format != "pbf":
+            return "json"
+        entry = self.metadata_cache.get(map_service_, layer_) or {}
+        supported = (entry.get("data") or {}).get("supportedQueryFormats") or ""
+        return "pbf" if "PBF" in supported.upper() else "json"
+
+    def _query_object_ids(self, url: str, mapservice: int, layer: int, feature_params: dict):
+        """
+        Ask the MapServer for the objectIds matching the query instead of the features themselves.
+
+        Returns:
+            (oid_field, object_ids) (tuple): Name of the objectId field and the sorted list of objectIds, or (None, None) if the layer cannot answer.
+        """
+        params = {
+            key: value
+            for key, value in feature_params.items()
+            if key not in ("resultOffset", "resultRecordCount")
+        }
+        params["returnIdsOnly"] = "true"
+        params["f"] = "json"
+        data = self._query_page(url, mapservice, layer, params)
+        if data is None or "objectIdFieldName" not in data:
+            return None, None
+        return data["objectIdFieldName"], sorted(data.get("objectIds") or [])
+
+    @staticmethod
+    def _id_range_pages(
+        feature_params: dict, oid_field: str, object_ids: list, sizer: PageSizer = None
+    ):
+        """
+        Split the sorted objectIds into query parameters for ranges of resultRecordCount ids.
+        With a sizer, ranges are generated lazily and each one takes the page size of the sizer at the time, so the pages adapt as the layer is fetched.
+        """
+        where = feature_params["where"]
+        # The objectIdField is kept in the rows even when a profile returns a subset of the fields.
+        out_fields = feature_params.get("outFields", "*")
+        if out_fields != "*" and oid_field not in out_fields.split(","):
+            feature_params = dict(feature_params, outFields=f"{out_fields},{oid_field}")
+        i = 0
+        while i < len(object_ids):
+            page_size = (
+                feature_params["resultRecordCount"] if sizer is None else sizer.size
+            )
+            params = dict(feature_params, resultRecordCount=page_size)
+            params["where"] = (
+                f"{where} AND ({oid_field} >= {object_ids[i]})"
+                f" AND ({oid_field} <= {object_ids[min(i + page_size, len(object_ids)) - 1]})"
             )
-            print(f"{map_service_}, {layer_}, {name_} saved")
+            yield params
+            i += page_size
 
-    def feature_query_with_paging(self, url: str, mapservice: str, layer: str):
+    def _query_id_range(self, url: str, mapservice: int, layer: int, params: dict):
+        """
+        Fetch the features of one objectId range. If the server caps the page below resultRecordCount (exceededTransferLimit), page through the rest of the range with resultOffset.
+        If a page keeps timing out, the range is paged with half the resultRecordCount instead, down to the minimum page size of the layer.
+
+        Returns:
+            page (dict): Query response with the "features" of the whole range.
+        """
+        params = dict(params)
+        page = {"features": []}
+        sizer = self._page_sizer(mapservice, layer)
+        while True:
+            try:
+                data = self._query_page(url, mapservice, layer, params)
+            except RequestFailed as e:
+                # Network errors and timeouts have no code: the page is too heavy for the server.
+                if e.code is not None or params["resultRecordCount"] <= sizer.min_size:
+                    raise
+                sizer.timed_out()
+                params["resultRecordCount"] = max(
+                    sizer.min_size, params["resultRecordCount"] // 2
+                )
+                print(
+                    f"{mapservice}, {layer}: page timed out, retrying with {params['resultRecordCount']} features"
+                )
+                continue
+            if data is None or "features" not in data:
+                break
+            page.update({key: value for key, value in data.items() if key != "features"})
+            page["features"].extend(data["features"])
+            if not data.get("exceededTransferLimit") or len(data["features"]) == 0:
+                break
+            params["resultOffset"] += len(data["features"])
+        print(
+            f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(page['features'])} features ({layer})"
+        )
+        return page
+
+    def feature_query_with_paging(
+        self,
+        url: str,
+        mapservice: int,
+        layer: int,
+        feature_params: dict,
+        checkpoint: dict = None,
+    ):
         """
         Querying features using requests from fetch_layers_features() method.
+        The objectIds of the layer are requested first and split into ranges of resultRecordCount ids, which are fetched with up to self.pages_in_flight requests at a time and yielded back in order.
+        Layers that cannot return their objectIds are paged serially with resultOffset.
+        Pages are yielded as they arrive so the caller can write them out without holding the whole layer in memory.
 
         Args:
             url (str): url for requests.get()
-            layer (str): layer that is being queried.
+            mapservice (int): MapService that is being queried.
+            layer (int): layer that is being queried.
+            feature_params (dict): Query parameters, the paging ones are updated on a copy.
+            checkpoint (dict, optional): Journal state of an interrupted fetch of the layer (see RunJournal), the features it committed are not requested again. Defaults to None.
 
-        Returns:
-            all_features (dict): Dictionary with features' data for the MapServices / layers.
+        Yields:
+            page (dict): Query response with the "features" of the page.
         """
         print(f"Querying Features, {mapservice}, {layer}")
+        oid_field, object_ids = self._query_object_ids(
+            url, mapservice, layer, feature_params
+        )
+        if oid_field is None:
+            if checkpoint is not None:
+                feature_params = dict(
+                    feature_params,
+                    resultOffset=feature_params["resultOffset"] + checkpoint["rows"],
+                )
+            yield from self._serial_query_with_paging(
+                url, mapservice, layer, feature_params
+            )
+            return
+
+        if checkpoint is not None and checkpoint["last_oid"] is not None:
+            object_ids = [
+                object_id for object_id in object_ids if object_id > checkpoint["last_oid"]
+            ]
+
+        yield from ordered_map(
+            lambda params: self._query_id_range(url, mapservice, layer, params),
+            self._id_range_pages(
+                feature_params,
+                oid_field,
+                object_ids,
+                self._page_sizer(mapservice, layer),
+            ),
+            max(1, self.pages_in_flight),
+        )
+
+    def _serial_query_with_paging(
+        self, url: str, mapservice: int, layer: int, feature_params: dict
+    ):
+        params = dict(feature_params)
+        sizer = self._page_sizer(mapservice, layer)
         while True:
 
-            # Make the request
-            self.feature_response = requests.get(
-                url, verify=False, params=self.feature_params
-            )
-            if [x for x in json.loads(self.feature_response.text).keys()][0] == "error":
-                print("Error in querying.")
-                if (mapservice, layer) in map_layers_without_features:
-                    print("Error captured")
-                    self.all_features[layer] = {}
-                    break
-                print(f"Attempting to re-log-in {mapservice}, {layer}")
-                self.log_in()
-                self.feature_params["token"] = self.token
-                self.feature_response = requests.get(
-                    url, verify=False, params=self.feature_params
-                )
-            else:
-                pass
-            data = self.feature_response.json()
+            # Make the request, with the page size tuned by the previous ones
+            params["resultRecordCount"] = sizer.size
+            data = self._query_page(url, mapservice, layer, params)
+            if data is None:
+                break
 
-            # Add features to the list
+            # Hand the page over to the caller
             if "features" in data:
-                self.all_features[layer].extend(data["features"])
+                yield data
                 print(
                     f"{datetime.datetime.now().strftime('%H:%M:%S')}: Retrieved {len(data['features'])} features ({layer})"
                 )
@@ -276,15 +1321,11 @@ class GEO_Client:
                 break
 
             # Check if the number of records fetched is less than the limit
-            if len(data["features"]) < self.feature_params["resultRecordCount"]:
+            if len(data["features"]) < params["resultRecordCount"]:
                 break
 
             # Update the offset for the next query
-            self.feature_params["resultOffset"] += self.feature_params[
-                "resultRecordCount"
-            ]
-
-        return self.all_features
+            params["resultOffset"] += params["resultRecordCount"]
 
     def fetch_layers_attributes(
         self, variable: str, variable_2: int, variable_3: list = None
@@ -298,121 +1339,106 @@ class GEO_Client:
             variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
         """
 
-        if isinstance(self.index_df, pd.DataFrame):
-            pass
-        else:
-            self.get_available_layers()
-
-        if variable not in os.listdir(OUTPUTS_DIR):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable))
-
-        if "attributes" not in os.listdir(os.path.join(OUTPUTS_DIR, variable)):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable, "attributes"))
-
-        if variable_3 == None:
-            filtered_index = self.index_df[self.index_df["map_service"] == variable_2]
-        else:
-            filtered_index = self.index_df[
-                (self.index_df["map_service"] == variable_2)
-                & (self.index_df["id"].isin(variable_3))
-            ]
+        filtered_index = self._filtered_index(
+            variable, variable_2, variable_3, "attributes"
+        )
 
         for map_service_, layer_, name_ in filtered_index[
             ["map_service", "id", "name"]
         ].values:
 
-            url = f"https://arcgis.coess.io/Geocortex/Essentials/REST/sites/SIN/map/mapservices/{map_service_}/rest/services/x/MapServer/{layer_}"
-
-            # Append the token to the request parameters
-            self.attributes_params = {
-                "token": self.token,  # Token form the webpage after signing in.
-                "f": "json",  # Fromat we want.
-                "returnGeometry": "true",  # We want the coordinates.
-                "where": "('1' = '1')",  # We want to query everything within the ID we have selected.
-                "spatialRel": "esriSpatialRelIntersects",
-                "outFields": "*",  # All
-                "outSR": "4326",  # We want the normal coordinates used in the world.
-            }
+            url = self._map_service_url(map_service_) + f"{layer_}"
+            layer_json, changed = self._get_metadata(map_service_, layer_, url)
+            changed = self._definition_changed(map_service_, layer_, changed)
+
+            # Schema and domains rarely change: the attributes are only rewritten when the layer definition did.
+            if not changed and os.path.exists(
+                self._attributes_path(variable, name_)
+            ):
+                print(f"{map_service_}, {layer_}, {name_} unchanged")
+                continue
 
-            self.attributes_response = requests.get(
-                url, verify=False, params=self.attributes_params
+            self._save_layer_attributes(
+                variable, map_service_, layer_, name_, layer_json
             )
 
-            # Make the request
-            if [x for x in json.loads(self.attributes_response.text).keys()][
-                0
-            ] == "error":
-                self.log_in()
-                self.attributes_params["token"] = self.token
-                self.attributes_response = requests.get(
-                    url, verify=False, params=self.attributes_params
-                )
-            else:
-                pass
+    def _attributes_path(self, variable: str, name_: str):
+        return os.path.join(
+            OUTPUTS_DIR,
+            variable,
+            "attributes",
+            f"{name_}{table_extension(self.output_format)}",
+        )
 
-            with open(
-                os.path.join(OUTPUTS_DIR, variable, "attributes", name_), "w"
-            ) as json_file:
-                json.dump(self.attributes_response.json(), json_file, indent=4)
+    def _get_metadata(
+        self,
+        map_service: int,
+        layer: int,
+        url: str,
+        timeout: int = None,
+        revalidate: bool = False,
+    ):
+        """
+        Get the MapServer index (layer None) or a layer definition through the metadata cache.
+        Fresh entries are returned without a request, expired ones are revalidated with their ETag / Last-Modified.
 
-            ## Getting the substitution dictionary for the ID column
-            try:
-                types_df = pd.json_normalize(self.attributes_response.json()["types"])[
-                    ["id", "name"]
-                ]
-                types_df["column"] = self.attributes_response.json()["typeIdField"]
-            except:
-                types_df = pd.DataFrame()
-
-            ## Getting all the fields for substitution
-            attributes = pd.json_normalize(self.attributes_response.json()["fields"])
-            self.attributes_df = pd.DataFrame()
-            if ("domain.codedValues" in attributes.columns) == True:
-                attributes = attributes[~attributes["domain.codedValues"].isna()]
-                for col in attributes["name"]:
-                    if (
-                        len(
-                            pd.json_normalize(
-                                attributes[attributes["name"] == col][
-                                    "domain.codedValues"
-                                ].values[0]
-                            )
-                        )
-                        == 0
-                    ):
-                        continue
-                    attributes_dict = (
-                        pd.json_normalize(
-                            attributes[attributes["name"] == col][
-                                "domain.codedValues"
-                            ].values[0]
-                        )
-                        .set_index("code")
-                        .iloc[:, 0]
-                        .to_dict()
-                    )
-                    aux = (
-                        pd.DataFrame.from_dict(
-                            attributes_dict, orient="index", columns=["name"]
-                        )
-                        .reset_index()
-                        .rename(columns={"index": "id"})
-                    )
-                    aux["column"] = col
-                    self.attributes_df = pd.concat([self.attributes_df, aux])
+        Args:
+            map_service (int): Id of the Map Service.
+            layer (int): Id of the layer, None for the MapServer index.
+            url (str): URL of the resource.
+            timeout (int, optional): Timeout of the request. Defaults to None.
+            revalidate (bool, optional): Revalidate the cached entry even if it has not expired. Defaults to False.
 
-            self.attributes_df = pd.concat([self.attributes_df, types_df]).reset_index(
-                drop=True
-            )
+        Returns:
+            data (dict): JSON response.
+            changed (bool): True if the content is new or different from the cached one.
+        """
+        entry = self.metadata_cache.get(map_service, layer)
+        if not revalidate and self.metadata_cache.is_fresh(entry):
+            return entry["data"], False
+
+        params = {"token": self.token, "f": "json"}
+        try:
+            key = None if layer is None else f"{map_service}/{layer}"
+            with telemetry.span("metadata", key) as span:
+                response, data = self._request(
+                    url,
+                    params,
+                    headers=self.metadata_cache.validators(entry),
+                    timeout=timeout,
+                )
+                span["bytes"] = len(response.content)
+        except BadRequest as e:
+            return {"error": {"code": e.code, "message": str(e)}}, True
+        if response.status_code == 304:
+            self.metadata_cache.touch(map_service, layer)
+            return entry["data"], False
+        return data, self.metadata_cache.put(map_service, layer, data, response.headers)
+
+    def _save_layer_attributes(
+        self, variable: str, map_service_: int, layer_: int, name_: str, layer_json: dict
+    ):
+        """
+        Save the layer definition and its substitution table (coded values and types) in outputs/{variable}/attributes/.
+        """
+        with open(
+            os.path.join(OUTPUTS_DIR, variable, "attributes", name_), "w"
+        ) as json_file:
+            json.dump(layer_json, json_file, indent=4)
 
-            self.attributes_df.to_csv(
-                os.path.join(OUTPUTS_DIR, variable, "attributes", f"{name_}.csv"),
-                index=False,
-            )
-            print(f"{map_service_}, {layer_}, {name_} saved")
+        ## Coded values of every field and the types of the typeIdField, in a single pass over the layer definition
+        attributes_df = DomainDecoder.from_layer_json(layer_json).to_table()
+
+        write_table(attributes_df, self._attributes_path(variable, name_))
+        print(f"{map_service_}, {layer_}, {name_} saved")
 
     def fetch_missing_layers_features(
-        self, variable: str, variable_2: int, variable_3: list = None
+        self,
+        variable: str,
+        variable_2: int,
+        variable_3: list = None,
+        max_workers: int = 1,
+        profile: str = None,
     ):
         """
         Send petition to fetch the features from the given MapService (variable: name, variable_2: ID) and the list of layers from that MapService to be retrieved (variable_3).
@@ -422,92 +1448,330 @@ class GEO_Client:
             variable (str): Name of the Map Service
             variable_2 (int): Id of the Map Service
             variable_3 (list, optional): List of layers to be retrieved. Defaults to None.
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py, without its field subsets so the stored rows stay complete. Defaults to config.EXTRACTION_PROFILE.
         """
+        # Profiles other than "full" are synced in their own folder.
+        variable = profile_folder(variable, profile)
+        filtered_index = self._filtered_index(
+            variable, variable_2, variable_3, "features"
+        )
 
-        if isinstance(self.index_df, pd.DataFrame):
-            pass
-        else:
-            self.get_available_layers()
+        filtered_index = filtered_index[~filtered_index["date"].isna()]
+        print(f"Filtered index for MapService {variable_2}")
+        print(filtered_index)
 
-        if variable not in os.listdir(OUTPUTS_DIR):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable))
+        jobs = [
+            (variable, map_service_, layer_, name_, date_, profile)
+            for map_service_, layer_, name_, date_ in filtered_index[
+                ["map_service", "id", "name", "date2"]
+            ].values
+        ]
+        self._run_layer_jobs(self._fetch_missing_layer_features, jobs, max_workers)
 
-        if "features" not in os.listdir(os.path.join(OUTPUTS_DIR, variable)):
-            os.mkdir(os.path.join(OUTPUTS_DIR, variable, "features"))
+    def _store_path(self, variable: str, name_: str):
+        return os.path.join(OUTPUTS_DIR, variable, "features", name_)
 
-        if variable_3 == None:
-            filtered_index = self.index_df[self.index_df["map_service"] == variable_2]
-        else:
-            filtered_index = self.index_df[
-                (self.index_df["map_service"] == variable_2)
-                & (self.index_df["id"].isin(variable_3))
-            ]
+    def _fetch_missing_layer_features(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        date_: str,
+        profile: str = None,
+    ):
+        """
+        Sync a layer into its FeatureStore (outputs/{variable}/features/{name_}/): rows modified after date_ and new OBJECTIDs are upserted,
+        OBJECTIDs that are no longer on the server are deleted. Only the partitions holding those rows are rewritten.
+        The first sync of a layer builds the store from its features file.
+        Inside a journaled run, layers already synced are skipped.
+        """
+        if self.journal is not None and self.journal.is_done(
+            variable, map_service_, layer_
+        ):
+            print(f"{map_service_}, {layer_}, {name_} already synced in this run, skipped")
+            return
+
+        start = time.perf_counter()
+        key = f"{map_service_}/{layer_}"
+        telemetry.name(key, f"{variable}/{name_}")
+        # A conditional request for the definition, answered with a 304 while nothing changed, saves every query of a layer with no edits.
+        last_edit_date = layer_last_edit_date(
+            self._layer_definition(map_service_, layer_, revalidate=True)
+        )
+        if self._unedited(variable, map_service_, layer_, name_, last_edit_date):
+            return
 
-        filtered_index = filtered_index[~filtered_index["date"].isna()]
-        print(f"Filtered index for MapService {variable_2}")
-        print(filtered_index)
+        url = self._map_service_url(map_service_) + f"{layer_}/query"
+        feature_params = self._feature_params("('1' = '1')")
+        feature_params.update(
+            profile_params(profile, variable, name_, out_fields=False)
+        )
+        feature_params["f"] = self._query_format(map_service_, layer_)
 
-        for map_service_, layer_, name_, date_ in filtered_index[
-            ["map_service", "id", "name", "date2"]
-        ].values:
+        oid_field, live_ids = self._query_object_ids(
+            url, map_service_, layer_, feature_params
+        )
+        if oid_field is None:
+            print(f"{map_service_}, {layer_}, {name_} has no objectIdField, skipped")
+            return
 
-            url = f"https://arcgis.coess.io/Geocortex/Essentials/REST/sites/SIN/map/mapservices/{map_service_}/rest/services/x/MapServer/{layer_}/query"
-
-            # Append the token to the request parameters
-            self.feature_params = {
-                "token": f"{self.token}",  # Token form the webpage after signing in.
-                "f": "json",  # Fromat we want.
-                "returnGeometry": "true",  # We want the coordinates.
-                "where": f"(DATEMODIFIED > DATE '{date_}')",  # We want to query everything within the ID we have selected.
-                "spatialRel": "esriSpatialRelIntersects",
-                "outFields": "*",  # All
-                "outSR": "4326",  # We want the normal coordinates used in the world.
-                "resultOffset": 0,  # Starting at the first record
-                "resultRecordCount": 1000,  # Number of records to fetch per request
-            }
+        store = FeatureStore(
+            self._store_path(variable, name_), output_format=self.output_format
+        )
+        if not store.exists():
+            features_path = self._features_path(variable, name_)
+            if os.path.exists(features_path):
+                try:
+                    current_file = read_table(features_path)
+                except:
+                    return
+            else:
+                # Fetched by the fused pipeline without its features file: the store starts from a full fetch of the layer.
+                print(
+                    f"{map_service_}, {layer_}, {name_} has no features file, fetching the whole layer"
+                )
+                current_file = pd.json_normalize(
+                    [
+                        feature
+                        for page in self.feature_query_with_paging(
+                            url, map_service_, layer_, feature_params
+                        )
+                        for feature in page["features"]
+                    ]
+                )
+            store.create(current_file, oid_field)
+            if os.path.exists(features_path):
+                os.remove(features_path)
+
+        stored_ids = store.object_ids()
+
+        # Rows edited since the last sync, plus new OBJECTIDs in case they were created without a later DATEMODIFIED.
+        pages = list(
+            self.feature_query_with_paging(
+                url,
+                map_service_,
+                layer_,
+                dict(
+                    feature_params, where=f"(DATEMODIFIED > DATE '{date_}')"
+                ),
+            )
+        )
+        new_ids = np.setdiff1d(live_ids, stored_ids).tolist()
+        pages += list(
+            ordered_map(
+                lambda params: self._query_id_range(url, map_service_, layer_, params),
+                self._id_range_pages(
+                    feature_params,
+                    oid_field,
+                    new_ids,
+                    self._page_sizer(map_service_, layer_),
+                ),
+                max(1, self.pages_in_flight),
+            )
+        )
+        self._sync_store(
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            store,
+            pages,
+            live_ids,
+            start,
+            last_edit_date,
+        )
+
+    def _unedited(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        last_edit_date: int = None,
+    ):
+        """
+        Skip a layer whose lastEditDate is the one recorded in the manifest by its last sync, it has no edits, additions or deletions since.
 
+        Returns:
+            unedited (bool): True if the layer was skipped.
+        """
+        synced = self.manifest.get(variable, name_)
+        if (
+            last_edit_date is None
+            or synced is None
+            or synced.get("last_edit_date") != last_edit_date
+        ):
+            return False
+        print(f"{map_service_}, {layer_}, {name_} has no edits since its last sync, skipped")
+        if self.journal is not None:
+            self.journal.finish_layer(variable, map_service_, layer_)
+        return True
+
+    def _sync_store(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        store: FeatureStore,
+        pages: list,
+        live_ids: list,
+        start: float,
+        last_edit_date: int = None,
+    ):
+        """
+        Upsert the features of pages into the FeatureStore of a layer and delete the OBJECTIDs that are no longer in live_ids,
+        then record the sync (and the lastEditDate of the layer before it) in the manifest and the run journal.
+        """
+        key = f"{map_service_}/{layer_}"
+        stored_ids = store.object_ids()
+        live_ids = np.asarray(live_ids, dtype=np.int64)
+        with telemetry.span("normalize", key) as span:
+            changes = pd.json_normalize(
+                [feature for page in pages for feature in page["features"]]
+            )
+            span["rows"] = len(changes)
+
+        with telemetry.span("store.upsert", key, rows=len(changes)):
+            written = store.upsert(changes)
+        deleted_ids = np.setdiff1d(stored_ids, live_ids)
+        with telemetry.span("store.delete", key, rows=len(deleted_ids)):
+            written += store.delete(deleted_ids)
+
+        synced = self.manifest.get(variable, name_)
+        if synced is not None and synced["high_water_mark"] is not None:
+            high_water_mark = synced["high_water_mark"]
+        else:
             try:
-                current_file = pd.recsv(
-                    os.path.join(OUTPUTS_DIR, variable, "features", f"{name_}.csv")
+                high_water_mark = max_date_modified(
+                    store.read(columns=["attributes.DATEMODIFIED"])[
+                        "attributes.DATEMODIFIED"
+                    ]
                 )
             except:
-                continue
-
-            # Make the request
-            self.feature_query_with_paging(url, map_service_, layer_)
-            new_inputs = pd.json_normalize(self.all_features[layer_])
-            output = pd.concat([current_file, new_inputs])
-            for_dropping = []
-            for col in output.columns:
-                if any(isinstance(i, list) for i in output[col]):
-                    pass
-                else:
-                    for_dropping.append(col)
-            output = output.drop_duplicates(subset=for_dropping)
-            output.to_csv(
-                os.path.join(OUTPUTS_DIR, variable, "features", f"{name_}.csv"),
-                index=False,
+                high_water_mark = None
+        if "attributes.DATEMODIFIED" in changes.columns:
+            high_water_mark = max_date_modified(
+                changes["attributes.DATEMODIFIED"], high_water_mark
+            )
+        self.manifest.update(
+            variable,
+            map_service_,
+            layer_,
+            name_,
+            high_water_mark,
+            len(store.object_ids()),
+            last_edit_date,
+        )
+        if self.journal is not None:
+            self.journal.finish_layer(
+                variable, map_service_, layer_, len(store.object_ids())
             )
-            print(f"{map_service_}, {layer_}, {name_} saved")
+        telemetry.record("layer", key, time.perf_counter() - start, rows=len(changes))
+        print(
+            f"{map_service_}, {layer_}, {name_} synced: {len(changes)} upserted, {len(deleted_ids)} deleted, {len(set(written))} partitions written"
+        )
+        print(
+            f"{map_service_}, {layer_}, {name_} paging: {self._page_sizer(map_service_, layer_).summary()}"
+        )
 
     def get_all_attributes(self):
         """
-        Getting all Attributes
+        Getting all Attributes. Layers shared by aliased Map Services are requested once and copied (see plan_fetches()).
         """
+        self.plan_fetches()
         for id, mapserv in map_service_dict.items():
-            self.fetch_layers_attributes(name_dict[mapserv], id)
+            self.fetch_layers_attributes(name_dict[mapserv], id, self._planned_layers(id))
+        self._copy_aliases("attributes")
 
-    def get_new_features(self):
+    def get_new_features(
+        self, max_workers: int = 1, profile: str = None, resume: bool = False
+    ):
         """
-        Getting new features
+        Getting new features. Layers shared by aliased Map Services are synced once and copied (see plan_fetches()).
+        The layers synced are recorded in the run journal (outputs/journal/), which is left on disk.
+
+        Args:
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            resume (bool, optional): Continue an interrupted run, skipping the layers it already synced. Defaults to False.
         """
-        for id, mapserv in map_service_dict.items():
-            self.fetch_missing_layers_features(name_dict[mapserv], id)
+        self.journal = RunJournal()
+        self.plan_fetches()
+        self.journal.start({"features": "new", "profile": profile}, resume)
+        try:
+            for id, mapserv in map_service_dict.items():
+                self.fetch_missing_layers_features(
+                    name_dict[mapserv],
+                    id,
+                    self._planned_layers(id),
+                    max_workers=max_workers,
+                    profile=profile,
+                )
+        finally:
+            self.journal = None
+        self._copy_aliases("features", profile)
 
-    def get_all_features(self):
+    def get_all_features(
+        self,
+        max_workers: int = 1,
+        profile: str = None,
+        tiled: bool = False,
+        bbox: tuple = None,
+        province: str = None,
+        resume: bool = False,
+        fused: bool = False,
+        raw: bool = False,
+    ):
         """
-        Getting all features
+        Getting all features. Layers from every MapService share a single pool of max_workers threads.
+        Layers shared by aliased Map Services are fetched once and copied (see plan_fetches()).
+        Pages and layers are checkpointed in the run journal (outputs/journal/) as they are written, which is left on disk until RunJournal().clear().
+
+        Args:
+            max_workers (int, optional): Number of layers fetched concurrently. Defaults to 1.
+            profile (str, optional): Extraction profile from src/profiles.py. Defaults to config.EXTRACTION_PROFILE.
+            tiled (bool, optional): Extract every layer by quadtree tiles of its extent. Defaults to False.
+            bbox (tuple, optional): Only refresh the features intersecting (xmin, ymin, xmax, ymax) in EPSG:4326. Defaults to None.
+            province (str, optional): Only refresh the features intersecting the bounding box of this province. Defaults to None.
+            resume (bool, optional): Continue an interrupted run with the same options from its last committed page per layer. Defaults to False.
+            fused (bool, optional): Build the final tables straight from the pages, so merge_and_parse_files_final() is not needed for them. Defaults to False.
+            raw (bool, optional): With fused, also write the features files. Defaults to False.
         """
+        if province is not None:
+            bbox = self.province_envelope(province)
         self.get_available_layers()
+        self.plan_fetches()
+        jobs = []
         for id, mapserv in map_service_dict.items():
-            self.fetch_layers_features(name_dict[mapserv], id)
+            jobs.extend(
+                self._feature_jobs(
+                    name_dict[mapserv],
+                    id,
+                    self._planned_layers(id),
+                    profile=profile,
+                    tiled=tiled,
+                    bbox=bbox,
+                    fused=fused,
+                    raw=raw,
+                )
+            )
+        self.journal = RunJournal()
+        self.journal.start(
+            {
+                "features": "all",
+                "profile": profile,
+                "tiled": tiled,
+                "bbox": None if bbox is None else list(bbox),
+                "fused": fused,
+                "raw": raw,
+            },
+            resume,
+        )
+        try:
+            self._run_layer_jobs(self._fetch_layer_features, jobs, max_workers)
+        finally:
+            self.journal = None
+        self._copy_aliases("features", profile)
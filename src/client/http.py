@@ -0,0 +1,321 @@
+import json
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..config import (
+    HTTP_RETRIES,
+    HTTP_BACKOFF,
+    HTTP_MAX_BACKOFF,
+    HTTP_TIMEOUT,
+    HTTP_TIMEOUT_RETRIES,
+    HTTP_MAX_PER_HOST,
+    HTTP_RATE_LIMIT,
+)
+
+# ArcGIS error codes, sent either as the HTTP status or inside an {"error": {"code": ...}} payload.
+token_codes = {401, 498, 499}  # Invalid or expired GEOToken: log in again.
+# Permission denied, retrying will not help. Some ArcGIS Servers also answer an invalid token with a 403, told apart by its message.
+permission_codes = {403}
+throttle_codes = {429, 503}  # The server is throttling: retry, slowing the host down.
+skip_codes = {400, 404}  # Invalid query for this layer: retrying will not help.
+
+
+class RequestFailed(Exception):
+    """
+    A request that could not be completed, with the error code of the server (None for network errors).
+    """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+class TokenExpired(RequestFailed):
+    pass
+
+
+class BadRequest(RequestFailed):
+    pass
+
+
+class RequestTimeout(RequestFailed):
+    pass
+
+
+def classify(code: int, message: str = ""):
+    """
+    What to do with an error code: "token" (log in again), "throttle" / "retry" (back off and retry) or "skip" (give up on the request).
+    A 403 is only a token error when its message says so.
+    """
+    if code in token_codes:
+        return "token"
+    if code in permission_codes and "token" in (message or "").lower():
+        return "token"
+    if code in throttle_codes:
+        return "throttle"
+    if code in skip_codes:
+        return "skip"
+    if code is None or code >= 500:
+        return "retry"
+    return "skip"
+
+
+def payload_error(data):
+    """
+    Error code of an {"error": ...} payload, None if the response is not an error.
+    """
+    if not isinstance(data, dict) or "error" not in data:
+        return None
+    error = data["error"] if isinstance(data["error"], dict) else {}
+    try:
+        return int(error.get("code"))
+    except (TypeError, ValueError):
+        return 500
+
+
+def error_message(data):
+    """
+    Message and details of an {"error": ...} payload, "" if there are none.
+    """
+    error = data.get("error") if isinstance(data, dict) else None
+    if not isinstance(error, dict):
+        return ""
+    details = error.get("details") or []
+    if not isinstance(details, list):
+        details = [details]
+    return " ".join(str(text) for text in [error.get("message")] + details if text)
+
+
+def body_message(content: bytes):
+    """
+    Error message of the body of an HTTP error response: the ArcGIS error payload if it is JSON, the start of the text otherwise.
+    """
+    try:
+        return error_message(json.loads(content))
+    except ValueError:
+        return content[:200].decode("utf-8", errors="replace")
+
+
+def backoff_delay(attempt: int, base: float = HTTP_BACKOFF, cap: float = HTTP_MAX_BACKOFF):
+    """
+    Seconds to wait before retry number attempt (from 0): a random time of up to base * 2 ** attempt ("full jitter"),
+    so threads that failed together do not retry together.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry_delay(
+    url: str,
+    code: int,
+    error: str,
+    attempt: int,
+    retries: int,
+    bucket,
+    retry_after: str = None,
+    timed_out: bool = False,
+    timeout_retries: int = HTTP_TIMEOUT_RETRIES,
+):
+    """
+    Handle a failed attempt: raise if the request should not be retried, otherwise return how long to wait before the next attempt.
+    Throttling responses also slow the host down (bucket.throttle()) and their Retry-After header is honoured.
+    Timeouts are only retried timeout_retries times, so the caller can ask for less (e.g. a smaller page) instead of waiting for every retry.
+
+    Raises:
+        TokenExpired, BadRequest: The error is not worth retrying.
+        RequestTimeout: The request timed out again after timeout_retries retries.
+        RequestFailed: That was the last attempt.
+    """
+    action = classify(code, error)
+    if action == "token":
+        raise TokenExpired(f"GEOToken rejected ({error})", code)
+    if action == "skip":
+        raise BadRequest(f"{url} failed with {error}", code)
+    if action == "throttle":
+        bucket.throttle()
+    if timed_out and attempt >= min(retries, timeout_retries):
+        raise RequestTimeout(f"{url} timed out after {attempt + 1} attempts ({error})")
+    if attempt >= retries:
+        raise RequestFailed(f"{url} failed after {retries} retries ({error})", code)
+    delay = backoff_delay(attempt)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, min(HTTP_MAX_BACKOFF, int(retry_after)))
+    return delay
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing rate requests per second with bursts of up to capacity.
+    The rate adapts to the server: throttle() halves it and every recover() gives back a tenth of what is missing up to max_rate.
+
+    Usage:
+        bucket = TokenBucket(20)
+        time.sleep(bucket.reserve())  # or await asyncio.sleep(bucket.reserve())
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, going into debt if there is none.
+
+        Returns:
+            delay (float): Seconds to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + (self.max_rate - self.rate) / 10)
+
+
+class HttpClient:
+    """
+    Request layer shared by every GET of GEO_Client:
+        - A pooled requests.Session with keep-alive connections.
+        - At most max_per_host requests in flight and a TokenBucket of rate requests per second per host.
+        - Error classification: network errors, timeouts and 5xx are retried with exponential backoff and jitter, throttling (429 / 503) also slows the host down,
+          expired tokens raise TokenExpired for the caller to log in again and invalid queries (400 / 404) and permission errors (403) raise BadRequest.
+          Timeouts are retried timeout_retries times only and then raise RequestTimeout.
+
+    Usage:
+        http = HttpClient()
+        response, data = http.get(url, params=params)
+    """
+
+    def __init__(
+        self,
+        retries: int = HTTP_RETRIES,
+        timeout: float = HTTP_TIMEOUT,
+        max_per_host: int = HTTP_MAX_PER_HOST,
+        rate: float = HTTP_RATE_LIMIT,
+        timeout_retries: int = HTTP_TIMEOUT_RETRIES,
+    ):
+        self.retries = retries
+        self.timeout = timeout
+        self.timeout_retries = timeout_retries
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_per_host)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url: str):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (
+                    threading.BoundedSemaphore(self.max_per_host),
+                    TokenBucket(self.rate),
+                )
+            return self._hosts[host]
+
+    def bucket(self, url: str):
+        """
+        TokenBucket of the host of url, shared with the asyncio client.
+        """
+        return self._host(url)[1]
+
+    def get(
+        self,
+        url: str,
+        params: dict = None,
+        headers: dict = None,
+        timeout: float = None,
+        decode=None,
+        cookies=None,
+    ):
+        """
+        GET url, retrying until it succeeds or the error is not worth retrying.
+
+        Args:
+            url (str): URL of the request.
+            params (dict, optional): Query parameters. Defaults to None.
+            headers (dict, optional): Request headers. Defaults to None.
+            timeout (float, optional): Seconds to wait for the server. Defaults to self.timeout.
+            decode (callable, optional): Function decoding the response, response.json() by default.
+            cookies (CookieJar, optional): Cookies sent along with those of self.session, e.g. the ones of a logged in session. Defaults to None.
+
+        Returns:
+            response (requests.Response): Last response.
+            data (dict): Decoded body, None for a 304 Not Modified.
+
+        Raises:
+            TokenExpired: The GEOToken is not valid anymore.
+            BadRequest: The server rejected the query.
+            RequestTimeout: Still timing out after self.timeout_retries retries.
+            RequestFailed: Still failing after self.retries retries.
+        """
+        semaphore, bucket = self._host(url)
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.retries + 1):
+            time.sleep(bucket.reserve())
+            response = None
+            timed_out = False
+            try:
+                with semaphore:
+                    response = self.session.get(
+                        url,
+                        params=params,
+                        headers=headers,
+                        cookies=cookies,
+                        timeout=timeout,
+                        verify=False,
+                    )
+                if response.status_code >= 400:
+                    code = response.status_code
+                    error = f"HTTP {code} {body_message(response.content)}".strip()
+                elif response.status_code == 304:
+                    bucket.recover()
+                    return response, None
+                else:
+                    data = decode(response) if decode is not None else response.json()
+                    code = payload_error(data)
+                    if code is None:
+                        bucket.recover()
+                        return response, data
+                    error = f"error {code} {error_message(data)}".strip()
+            except requests.Timeout as e:
+                code, error, timed_out = None, f"{type(e).__name__}: {e}", True
+            except requests.ConnectionError as e:
+                code, error = None, f"{type(e).__name__}: {e}"
+            except (ValueError, IndexError) as e:  # Truncated or garbled body.
+                code, error = None, f"undecodable response: {e}"
+
+            delay = retry_delay(
+                url,
+                code,
+                error,
+                attempt,
+                self.retries,
+                bucket,
+                response.headers.get("Retry-After") if response is not None else None,
+                timed_out,
+                self.timeout_retries,
+            )
+            print(f"Request failed with {error}, retrying in {delay:.1f}s")
+            time.sleep(delay)
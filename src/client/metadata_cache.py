@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from ..config import METADATA_CACHE_DIR, METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES
+
+
+class MetadataCache:
+    """
+    On-disk cache of the MapServer metadata, one JSON file per (map service, layer) in cache_dir (layer None is the MapServer index).
+    Every entry keeps the response, its HTTP validators (ETag / Last-Modified), the editingInfo.lastEditDate of the layer and a hash of the content:
+        - While an entry is younger than ttl seconds it is used without any request.
+        - Once it expires, it is revalidated with a conditional request (304 Not Modified keeps it).
+        - A full response only counts as changed when its content hash differs from the cached one. editingInfo is left out of the hash,
+          as it changes with every edit of the features and not of the definition. The incremental sync compares last_edit_date instead.
+    When there are more than max_entries files, the least recently validated ones are evicted.
+
+    Usage:
+        cache = MetadataCache()
+        entry = cache.get(map_service, layer)
+        if cache.is_fresh(entry):
+            data = entry["data"]
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = METADATA_CACHE_DIR,
+        ttl: float = METADATA_CACHE_TTL,
+        max_entries: int = METADATA_CACHE_MAX_ENTRIES,
+    ):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, map_service: int, layer: int = None):
+        name = f"{map_service}" if layer is None else f"{map_service}_{layer}"
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def get(self, map_service: int, layer: int = None):
+        """
+        Returns:
+            entry (dict): Cached entry (data, etag, last_modified, last_edit_date, hash, validated_at), None if there is none.
+        """
+        try:
+            with open(self._path(map_service, layer)) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: dict):
+        return entry is not None and time.time() - entry["validated_at"] < self.ttl
+
+    @staticmethod
+    def validators(entry: dict):
+        """
+        Conditional request headers for revalidating entry.
+        """
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, map_service: int, layer: int, data: dict, headers: dict = None):
+        """
+        Store a full response.
+
+        Args:
+            map_service (int): Id of the Map Service.
+            layer (int): Id of the layer, None for the MapServer index.
+            data (dict): JSON response.
+            headers (dict, optional): Response headers, for the ETag / Last-Modified validators.
+
+        Returns:
+            changed (bool): False if the cached content was the same.
+        """
+        headers = headers or {}
+        previous = self.get(map_service, layer)
+        entry = {
+            "data": data,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "last_edit_date": (data.get("editingInfo") or {}).get("lastEditDate"),
+            "hash": hashlib.sha256(
+                json.dumps(
+                    {key: value for key, value in data.items() if key != "editingInfo"},
+                    sort_keys=True,
+                ).encode()
+            ).hexdigest(),
+            "validated_at": time.time(),
+        }
+        self._write(map_service, layer, entry)
+        self.evict()
+        return previous is None or previous["hash"] != entry["hash"]
+
+    def touch(self, map_service: int, layer: int = None):
+        """
+        Mark an entry as validated now (after a 304 Not Modified).
+        """
+        entry = self.get(map_service, layer)
+        if entry is not None:
+            entry["validated_at"] = time.time()
+            self._write(map_service, layer, entry)
+
+    def _write(self, map_service: int, layer: int, entry: dict):
+        path = self._path(map_service, layer)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(entry, json_file)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """
+        Remove the least recently validated entries beyond max_entries.
+        """
+        with self._lock:
+            paths = [
+                os.path.join(self.cache_dir, file)
+                for file in os.listdir(self.cache_dir)
+                if file.endswith(".json")
+            ]
+            if len(paths) <= self.max_entries:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[: len(paths) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for file in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, file))
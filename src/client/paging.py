@@ -0,0 +1,95 @@
+import threading
+
+from ..config import (
+    PAGE_SIZE,
+    PAGE_MIN_SIZE,
+    PAGE_TARGET_SECONDS,
+    PAGE_TARGET_BYTES,
+)
+
+
+class PageSizer:
+    """
+    resultRecordCount of the pages of one layer, tuned from the pages already fetched:
+        - Every full page gives the seconds and bytes per feature of the layer, the next pages are sized to take target_seconds and target_bytes.
+        - The size at most doubles from one page to the next and never goes over the maxRecordCount of the layer or under min_size.
+        - A page that timed out halves the size straight away.
+    Shared by all the threads fetching the layer.
+
+    Usage:
+        sizer = PageSizer(layer_json.get("maxRecordCount"))
+        params["resultRecordCount"] = sizer.size
+        sizer.observe(len(data["features"]), seconds, len(content), params["resultRecordCount"])
+        print(sizer.summary())
+    """
+
+    def __init__(
+        self,
+        max_record_count: int = None,
+        size: int = PAGE_SIZE,
+        min_size: int = PAGE_MIN_SIZE,
+        target_seconds: float = PAGE_TARGET_SECONDS,
+        target_bytes: float = PAGE_TARGET_BYTES,
+    ):
+        self.max_size = int(max_record_count or PAGE_SIZE)
+        self.min_size = min(min_size, self.max_size)
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.size = max(self.min_size, min(size, self.max_size))
+        self.initial_size = self.size
+        self.pages = 0
+        self.records = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def observe(self, records: int, seconds: float, size: int, requested: int):
+        """
+        Record a page and resize the next ones.
+
+        Args:
+            records (int): Features returned.
+            seconds (float): Time taken to request and download the page.
+            size (int): Bytes of the response.
+            requested (int): resultRecordCount of the request.
+        """
+        with self._lock:
+            self.pages += 1
+            self.records += records
+            self.bytes += size
+            self.seconds += seconds
+            # Short pages (the end of a range or of the layer) are mostly latency and say little about the cost per feature.
+            if records == 0 or records < requested / 2:
+                return
+            desired = min(
+                self.target_seconds * records / max(seconds, 1e-3),
+                self.target_bytes * records / max(size, 1),
+            )
+            self.size = int(
+                max(self.min_size, min(self.max_size, 2 * self.size, desired))
+            )
+
+    def timed_out(self):
+        """
+        Halve the page size after a page timed out.
+
+        Returns:
+            size (int): New page size.
+        """
+        with self._lock:
+            self.timeouts += 1
+            self.size = max(self.min_size, self.size // 2)
+            return self.size
+
+    def summary(self):
+        """
+        One line with the page sizes and throughput of the layer, e.g. "page size 1000 -> 4000 (max 5000), 12 pages, 5200 features/s, 2.1 MB/page".
+        """
+        with self._lock:
+            line = f"page size {self.initial_size} -> {self.size} (max {self.max_size}), {self.pages} pages"
+            if self.pages and self.seconds:
+                line += f", {self.records / self.seconds:.0f} features/s, {self.bytes / self.pages / 1e6:.1f} MB/page"
+            if self.timeouts:
+                line += f", {self.timeouts} timeouts"
+            return line
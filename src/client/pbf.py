@@ -0,0 +1,269 @@
+import numpy as np
+
+# Decoder for the esriPBuffer.FeatureCollectionPBuffer messages returned by query?f=pbf.
+# Messages are walked with a small protobuf wire-format reader, the packed coordinates of the geometries are decoded with NumPy,
+# and the result has the same layout as the f=json response (fields, features with attributes / geometry, objectIdFieldName...).
+
+geometry_types = {
+    0: "esriGeometryPoint",
+    1: "esriGeometryMultipoint",
+    2: "esriGeometryPolyline",
+    3: "esriGeometryPolygon",
+    4: "esriGeometryMultiPatch",
+}
+
+field_types = {
+    0: "esriFieldTypeSmallInteger",
+    1: "esriFieldTypeInteger",
+    2: "esriFieldTypeSingle",
+    3: "esriFieldTypeDouble",
+    4: "esriFieldTypeString",
+    5: "esriFieldTypeDate",
+    6: "esriFieldTypeOID",
+    7: "esriFieldTypeGeometry",
+    8: "esriFieldTypeBlob",
+    9: "esriFieldTypeRaster",
+    10: "esriFieldTypeGUID",
+    11: "esriFieldTypeGlobalID",
+    12: "esriFieldTypeXML",
+}
+
+
+def _varint(buf: bytes, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value: int):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(buf: bytes):
+    """
+    Yield (field number, wire type, value) for every field of a message. Length-delimited values are memoryviews.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 1:
+            value = buf[pos : pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos : pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = buf[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def _packed_varints(buf):
+    """
+    Decode a packed repeated varint field in one vectorised pass.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    parts = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    # The 7-bit groups do not overlap, so adding them is the same as or-ing them.
+    return np.add.reduceat(parts, starts)
+
+
+def _packed_sint64(buf):
+    values = _packed_varints(buf)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(
+        np.int64
+    )
+
+
+def _double(buf):
+    return float(np.frombuffer(buf, dtype="<f8")[0])
+
+
+def _float(buf):
+    return float(np.frombuffer(buf, dtype="<f4")[0])
+
+
+def _string(buf):
+    return bytes(buf).decode("utf-8")
+
+
+def _value(buf):
+    for number, wire_type, value in _fields(buf):
+        if number == 1:
+            return _string(value)
+        if number == 2:
+            return _float(value)
+        if number == 3:
+            return _double(value)
+        if number in (4, 8):
+            return _zigzag(value)
+        if number == 6:
+            # int64: negative values are sent as their two's complement.
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if number in (5, 7):
+            return value
+        if number == 9:
+            return bool(value)
+    return None
+
+
+def _transform(buf):
+    transform = {"upper_left": True, "scale": [1.0, 1.0], "translate": [0.0, 0.0]}
+    for number, _, value in _fields(buf):
+        if number == 1:
+            transform["upper_left"] = value == 0
+        elif number in (2, 3):
+            xy = [0.0, 0.0]
+            for sub_number, _, sub_value in _fields(value):
+                if sub_number in (1, 2):
+                    xy[sub_number - 1] = _double(sub_value)
+            transform["scale" if number == 2 else "translate"] = xy
+    return transform
+
+
+def _geometry(buf, geometry_type: str, dimensions: int, transform: dict):
+    lengths = []
+    coords = np.empty(0, dtype=np.int64)
+    for number, wire_type, value in _fields(buf):
+        if number == 2:
+            lengths.extend(
+                _packed_varints(value).tolist() if wire_type == 2 else [value]
+            )
+        elif number == 3:
+            coords = _packed_sint64(value)
+
+    # Coordinates are deltas from the previous vertex, quantized with the transform of the result.
+    points = np.cumsum(coords.reshape(-1, dimensions)[:, :2], axis=0).astype(float)
+    scale, translate = transform["scale"], transform["translate"]
+    points[:, 0] = points[:, 0] * scale[0] + translate[0]
+    if transform["upper_left"]:
+        points[:, 1] = translate[1] - points[:, 1] * scale[1]
+    else:
+        points[:, 1] = points[:, 1] * scale[1] + translate[1]
+
+    if geometry_type == "esriGeometryPoint":
+        if len(points) == 0:
+            return None
+        return {"x": points[0, 0], "y": points[0, 1]}
+    if geometry_type == "esriGeometryMultipoint":
+        return {"points": points.tolist()}
+    offsets = np.cumsum([0] + lengths)
+    parts = [points[offsets[i] : offsets[i + 1]].tolist() for i in range(len(lengths))]
+    if geometry_type == "esriGeometryPolyline":
+        return {"paths": parts}
+    return {"rings": parts}
+
+
+def _feature_result(buf):
+    result = {"fields": [], "features": []}
+    geometry_type = None
+    dimensions = 2
+    transform = {"upper_left": True, "scale": [1.0, 1.0], "translate": [0.0, 0.0]}
+    features = []
+    for number, _, value in _fields(buf):
+        if number == 1:
+            result["objectIdFieldName"] = _string(value)
+        elif number == 3:
+            result["globalIdFieldName"] = _string(value)
+        elif number == 7:
+            geometry_type = geometry_types.get(value)
+            if geometry_type is not None:
+                result["geometryType"] = geometry_type
+        elif number == 8:
+            result["spatialReference"] = {
+                "wkid": sub_value
+                for sub_number, _, sub_value in _fields(value)
+                if sub_number == 1
+            }
+        elif number == 9:
+            result["exceededTransferLimit"] = bool(value)
+        elif number in (10, 11):
+            dimensions += bool(value)
+        elif number == 12:
+            transform = _transform(value)
+        elif number == 13:
+            field = {}
+            for sub_number, _, sub_value in _fields(value):
+                if sub_number == 1:
+                    field["name"] = _string(sub_value)
+                elif sub_number == 2:
+                    field["type"] = field_types.get(sub_value)
+                elif sub_number == 3:
+                    field["alias"] = _string(sub_value)
+            result["fields"].append(field)
+        elif number == 15:
+            features.append(value)
+
+    names = [field["name"] for field in result["fields"]]
+    for buf_feature in features:
+        values = []
+        feature = {}
+        for number, _, value in _fields(buf_feature):
+            if number == 1:
+                values.append(_value(value))
+            elif number == 2 and geometry_type is not None:
+                feature["geometry"] = _geometry(
+                    value, geometry_type, dimensions, transform
+                )
+        feature["attributes"] = dict(zip(names, values))
+        result["features"].append(feature)
+    return result
+
+
+def _ids_result(buf):
+    result = {"objectIds": []}
+    for number, wire_type, value in _fields(buf):
+        if number == 1:
+            result["objectIdFieldName"] = _string(value)
+        elif number == 3:
+            if wire_type == 2:
+                result["objectIds"].extend(_packed_varints(value).tolist())
+            else:
+                result["objectIds"].append(value)
+    return result
+
+
+def decode_feature_collection(content: bytes):
+    """
+    Decode a query?f=pbf response into the layout of the f=json one.
+
+    Args:
+        content (bytes): Body of the response.
+
+    Returns:
+        data (dict): fields, features (attributes and geometry), objectIdFieldName, geometryType, exceededTransferLimit...
+    """
+    buf = memoryview(content)
+    for number, _, value in _fields(buf):
+        if number != 2:
+            continue
+        for result_number, _, result in _fields(value):
+            if result_number == 1:
+                return _feature_result(result)
+            if result_number == 2:
+                return {
+                    "count": next(
+                        (count for n, _, count in _fields(result) if n == 1), 0
+                    )
+                }
+            if result_number == 3:
+                return _ids_result(result)
+    return {"features": []}
@@ -0,0 +1,87 @@
+import os
+import json
+import base64
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from ..config import SESSION_CACHE_PATH, SESSION_CACHE_TTL
+
+
+class SessionCache:
+    """
+    GEOToken and session cookies of the last log in, stored on disk encrypted with a key derived from the credentials (PBKDF2 + Fernet).
+    The file is only readable by its owner, and entries older than ttl seconds (or saved with other credentials) are ignored.
+
+    Usage:
+        cache = SessionCache()
+        cache.save(secret, token, session.cookies)
+        token, cookies = cache.load(secret)
+    """
+
+    iterations = 200_000
+
+    def __init__(self, path: str = SESSION_CACHE_PATH, ttl: int = SESSION_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _fernet(self, secret: str, salt: bytes):
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(), length=32, salt=salt, iterations=self.iterations
+        )
+        return Fernet(base64.urlsafe_b64encode(kdf.derive(secret.encode())))
+
+    def load(self, secret: str):
+        """
+        Args:
+            secret (str): Credentials the entry was saved with.
+
+        Returns:
+            token (str): Cached GEOToken, None if there is no valid entry.
+            cookies (list): Cookies of the session, as dicts with name, value, domain and path.
+        """
+        try:
+            with open(self.path) as cache_file:
+                entry = json.load(cache_file)
+            fernet = self._fernet(secret, base64.b64decode(entry["salt"]))
+            data = json.loads(fernet.decrypt(entry["data"].encode(), ttl=self.ttl))
+        except (OSError, ValueError, KeyError, InvalidToken):
+            return None, None
+        return data["token"], data["cookies"]
+
+    def save(self, secret: str, token: str, cookies):
+        """
+        Args:
+            secret (str): Credentials the entry is encrypted with.
+            token (str): GEOToken.
+            cookies (RequestsCookieJar): Cookies of the logged in session.
+        """
+        salt = os.urandom(16)
+        data = {
+            "token": token,
+            "cookies": [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                }
+                for cookie in cookies
+            ],
+        }
+        entry = {
+            "salt": base64.b64encode(salt).decode(),
+            "data": self._fernet(secret, salt)
+            .encrypt(json.dumps(data).encode())
+            .decode(),
+        }
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
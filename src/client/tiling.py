@@ -0,0 +1,54 @@
+# Envelopes are (xmin, ymin, xmax, ymax) tuples in the spatial reference given by their wkid.
+
+WORLD_ENVELOPE = (-180.0, -90.0, 180.0, 90.0)
+
+
+def split_envelope(envelope: tuple):
+    """
+    Split an envelope in its four quadrants.
+    """
+    xmin, ymin, xmax, ymax = envelope
+    xmid = (xmin + xmax) / 2
+    ymid = (ymin + ymax) / 2
+    return [
+        (xmin, ymin, xmid, ymid),
+        (xmid, ymin, xmax, ymid),
+        (xmin, ymid, xmid, ymax),
+        (xmid, ymid, xmax, ymax),
+    ]
+
+
+def envelope_params(feature_params: dict, envelope: tuple, wkid: int):
+    """
+    Copy of the query parameters restricted to the features intersecting envelope.
+    """
+    params = dict(feature_params)
+    params.update(
+        {
+            "geometry": ",".join(str(value) for value in envelope),
+            "geometryType": "esriGeometryEnvelope",
+            "inSR": str(wkid),
+            "spatialRel": "esriSpatialRelIntersects",
+        }
+    )
+    return params
+
+
+def layer_envelope(layer_json: dict):
+    """
+    Extent of a layer definition as (envelope, wkid), the whole world in EPSG:4326 if it has none.
+    """
+    extent = layer_json.get("extent") or {}
+    try:
+        envelope = tuple(
+            float(extent[key]) for key in ("xmin", "ymin", "xmax", "ymax")
+        )
+    except (KeyError, TypeError, ValueError):
+        return WORLD_ENVELOPE, 4326
+    if any(value != value for value in envelope):  # NaN extent of an empty layer
+        return WORLD_ENVELOPE, 4326
+    spatial_reference = extent.get("spatialReference") or {}
+    wkid = spatial_reference.get("latestWkid") or spatial_reference.get("wkid")
+    if wkid is None:
+        return WORLD_ENVELOPE, 4326
+    return envelope, wkid
@@ -1,5 +1,95 @@
 import os
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
-OUTPUTS_DIR = os.path.join(BASE_DIR, 'outputs')
+# GEO_OUTPUTS_DIR points the clients and the merge to another outputs folder, e.g. the temporary one of scripts/benchmark_etl.py.
+OUTPUTS_DIR = os.environ.get("GEO_OUTPUTS_DIR", os.path.join(BASE_DIR, 'outputs'))
 NOTEBOOKS_DIR = os.path.join(BASE_DIR, 'notebooks')
+
+# Number of layers fetched at the same time by the ETL scripts.
+MAX_WORKERS = 4
+
+# Number of pages of a single layer requested at the same time.
+PAGES_IN_FLIGHT = 4
+
+# Format of the features, attributes and final tables: "csv" or "parquet".
+OUTPUT_FORMAT = "csv"
+
+# Timezone the epoch-millisecond DATE fields are converted to in the final tables (stored as naive wall-clock times).
+# UTC matches how the server compares DATE '...' literals in the incremental DATEMODIFIED queries.
+TIMEZONE = "UTC"
+
+# Layer metadata (MapServer index and layer definitions) is cached here and not requested again for METADATA_CACHE_TTL seconds.
+METADATA_CACHE_DIR = os.path.join(OUTPUTS_DIR, "metadata")
+METADATA_CACHE_TTL = 24 * 60 * 60
+METADATA_CACHE_MAX_ENTRIES = 2000
+
+# The GEOToken and session cookies are cached encrypted here, and reused on start-up for SESSION_CACHE_TTL seconds.
+SESSION_CACHE_PATH = os.path.join(BASE_DIR, ".geo_session")
+SESSION_CACHE_TTL = 60 * 60
+
+# Rows per OBJECTID partition of the incremental feature stores (outputs/{variable}/features/{layer}/).
+STORE_PARTITION_SIZE = 50000
+
+# Per-layer sync state (DATEMODIFIED high-water mark, rows, last sync), read at start-up instead of scanning the final tables.
+MANIFEST_PATH = os.path.join(OUTPUTS_DIR, "manifest.json")
+
+# Extraction profile used for the feature queries when none is given (see src/profiles.py).
+EXTRACTION_PROFILE = "full"
+
+# Format of the feature queries: "json", or "pbf" for the layers whose supportedQueryFormats include it.
+QUERY_FORMAT = "json"
+
+# Tiled extraction: envelopes with more features than TILE_MAX_RECORDS are split in four, down to TILE_MAX_DEPTH levels.
+TILE_MAX_RECORDS = 10000
+TILE_MAX_DEPTH = 8
+
+# Final table ({variable}, {layer}) with the province borders, used to restrict extractions to a province.
+PROVINCES_LAYER = ("landbase", "bordes")
+
+# Run journal of the extraction scripts: pages and layers already fetched, so a run restarted with --resume skips them.
+JOURNAL_DIR = os.path.join(OUTPUTS_DIR, "journal")
+
+# Request layer (src/client/http.py): failed requests are retried HTTP_RETRIES times, waiting a random time of up to
+# HTTP_BACKOFF * 2 ** attempt seconds (capped at HTTP_MAX_BACKOFF) between attempts. Requests time out after HTTP_TIMEOUT seconds.
+# A request that times out is only retried HTTP_TIMEOUT_RETRIES times: a page that keeps timing out is then split in half instead.
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 0.5
+HTTP_MAX_BACKOFF = 30
+HTTP_TIMEOUT = 120
+HTTP_TIMEOUT_RETRIES = 1
+
+# Requests open at the same time and requests per second sent to a host. The rate is halved whenever the server throttles (429 / 503)
+# and grows back towards HTTP_RATE_LIMIT with every successful request.
+HTTP_MAX_PER_HOST = 8
+HTTP_RATE_LIMIT = 20
+
+# Adaptive page sizing (src/client/paging.py): pages start at PAGE_SIZE features (capped by the maxRecordCount of the layer)
+# and are resized after every page to take about PAGE_TARGET_SECONDS and PAGE_TARGET_BYTES, never below PAGE_MIN_SIZE.
+PAGE_SIZE = 1000
+PAGE_MIN_SIZE = 50
+PAGE_TARGET_SECONDS = 8
+PAGE_TARGET_BYTES = 16 * 1024 * 1024
+
+# Run reports of the ETL scripts (timing, bytes and rows per login stage, request, parse and write step, and throughput per layer).
+REPORTS_DIR = os.path.join(OUTPUTS_DIR, "reports")
+
+# Stages profiled with cProfile, matched by prefix (e.g. ["merge.geometry"], or ["merge"] for every step of the merge).
+# One .prof file per outermost profiled span is dumped to REPORTS_DIR/profiles/, spans nested in it are not profiled again.
+PROFILE_STAGES = []
+
+# Final tables built at the same time by merge_and_parse_files_final(), one process per layer (1 merges them in this process).
+MERGE_WORKERS = os.cpu_count() or 1
+
+# Address space limit in bytes of every merge process (Unix only), so a layer that does not fit fails alone with a MemoryError. None for no limit.
+MERGE_MEMORY_LIMIT = None
+
+# Spatial index of every final table (outputs/{variable}/spatial/{layer}.npz, see src/spatial.py): a grid with about SPATIAL_CELL_ROWS
+# rows per cell. Point-in-polygon and nearest lookups test at most SPATIAL_QUERY_CHUNK (point, segment) pairs at a time.
+SPATIAL_CELL_ROWS = 16
+SPATIAL_QUERY_CHUNK = 1000000
+
+# Level of detail pyramid of every rings / paths final table (outputs/{variable}/lod/{layer}.npz, see src/lod.py): the geometries simplified
+# to LOD_PIXEL_TOLERANCE pixels at each of the LOD_ZOOMS web map zoom levels. Maps are assumed LOD_VIEWPORT_WIDTH pixels wide when no zoom is given.
+LOD_ZOOMS = [4, 6, 8, 10, 12, 14]
+LOD_PIXEL_TOLERANCE = 1
+LOD_VIEWPORT_WIDTH = 1000
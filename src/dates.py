@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from .config import TIMEZONE
+
+# Epoch milliseconds above this are treated as invalid dates (placeholders far in the future).
+MAX_EPOCH_MS = 2647813300000
+
+
+def epoch_ms_to_datetime(values: pd.Series, tz: str = TIMEZONE):
+    """
+    Convert a DATE column to datetimes in a single vectorised pass.
+    Numbers are epoch milliseconds (as returned by the API). Negative, above MAX_EPOCH_MS or unparsable values become NaT.
+    Text that is not a number is parsed as an already formatted date (e.g. a final table read back from CSV), in which case tz is not applied.
+
+    Args:
+        values (pd.Series): DATE column of a features or final table.
+        tz (str, optional): Timezone the instants are expressed in. Defaults to config.TIMEZONE.
+
+    Returns:
+        dates (pd.Series): datetime64[ns] Series (naive, wall-clock time in tz) with the same index as values.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        if getattr(values.dt, "tz", None) is not None:
+            return values.dt.tz_convert(tz).dt.tz_localize(None)
+        return values
+
+    ms = pd.to_numeric(values, errors="coerce").astype(float)
+    ms[(ms < 0) | (ms > MAX_EPOCH_MS)] = np.nan
+    dates = pd.Series(
+        pd.DatetimeIndex(pd.to_datetime(ms, unit="ms", utc=True))
+        .tz_convert(tz)
+        .tz_localize(None),
+        index=values.index,
+    )
+
+    text = values.map(lambda x: isinstance(x, str)).astype(bool) & ms.isna()
+    if text.any():
+        dates[text] = pd.to_datetime(values[text], errors="coerce")
+    return dates
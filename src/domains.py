@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+
+def _normalise_codes(values):
+    """
+    Codes as text, so numeric codes match whatever type they were read back with (1, 1.0 and "1" are all "1").
+    """
+    normalised = []
+    for value in values:
+        if isinstance(value, (float, np.floating)) and float(value).is_integer():
+            value = int(value)
+        normalised.append(str(value))
+    return pd.Index(normalised, dtype=object)
+
+
+class DomainDecoder:
+    """
+    Coded-value domains and typeIdField types of a layer, compiled once into lookup tables:
+        - codes: Index with the normalised codes of the column.
+        - categories: Index with the unique names the codes are substituted by.
+        - positions: array with the position in categories of the name of every code.
+    Decoding a column factorizes it, looks its unique values up in codes and returns a pd.Categorical, without a python call per row.
+
+    Usage:
+        decoder = DomainDecoder.from_layer_json(layer_json)
+        df = decoder.decode(df)
+    """
+
+    def __init__(self, substitutions: pd.DataFrame):
+        """
+        Args:
+            substitutions (pd.DataFrame): Table with the id (code), name and column of every substitution. Later rows win for repeated codes.
+        """
+        self.lookups = {}
+        if len(substitutions) == 0:
+            return
+        substitutions = substitutions.dropna(subset=["id", "column"])
+        for column, group in substitutions.groupby(
+            substitutions["column"].astype(str).str.upper(), sort=False
+        ):
+            codes = _normalise_codes(group["id"])
+            keep = ~codes.duplicated(keep="last")
+            codes = codes[keep]
+            names = group["name"].to_numpy()[keep]
+            positions, categories = pd.factorize(names)
+            self.lookups[column] = (codes, categories, positions)
+
+    def __len__(self):
+        return len(self.lookups)
+
+    @classmethod
+    def from_layer_json(cls, layer_json: dict):
+        """
+        Decoder from the layer definition returned by the MapServer (fields[].domain.codedValues, typeIdField and types).
+        """
+        rows = []
+        for field in layer_json.get("fields") or []:
+            domain = field.get("domain") or {}
+            for coded_value in domain.get("codedValues") or []:
+                rows.append((coded_value["code"], coded_value["name"], field["name"]))
+        if layer_json.get("typeIdField"):
+            for type_ in layer_json.get("types") or []:
+                rows.append((type_["id"], type_["name"], layer_json["typeIdField"]))
+        return cls(pd.DataFrame(rows, columns=["id", "name", "column"]))
+
+    @classmethod
+    def from_table(cls, attributes: pd.DataFrame):
+        """
+        Decoder from an attributes table (id, name, column) saved by GEO_Client.
+        """
+        if len(attributes) == 0:
+            return cls(pd.DataFrame(columns=["id", "name", "column"]))
+        return cls(attributes)
+
+    def to_table(self):
+        """
+        Substitutions as an attributes table (id, name, column), with the codes as text.
+        """
+        frames = [
+            pd.DataFrame(
+                {
+                    "id": codes,
+                    "name": np.asarray(categories)[positions],
+                    "column": column,
+                }
+            )
+            for column, (codes, categories, positions) in self.lookups.items()
+        ]
+        if not frames:
+            return pd.DataFrame(columns=["id", "name", "column"])
+        return pd.concat(frames).reset_index(drop=True)
+
+    def decode_column(self, values: pd.Series, column: str):
+        """
+        Substitute the codes of a column by their names. Missing and unknown codes become NaN.
+
+        Args:
+            values (pd.Series): Column of a features table.
+            column (str): Name of the column, compared in upper case.
+
+        Returns:
+            decoded (pd.Series): Categorical Series with the same index as values.
+        """
+        codes, categories, positions = self.lookups[column.upper()]
+        value_codes, uniques = pd.factorize(values)
+        found = codes.get_indexer(_normalise_codes(uniques))
+        unique_positions = np.where(found >= 0, positions[found], -1)
+        category_codes = np.where(value_codes >= 0, unique_positions[value_codes], -1)
+        return pd.Series(
+            pd.Categorical.from_codes(category_codes, categories), index=values.index
+        )
+
+    def decode(self, df: pd.DataFrame):
+        """
+        Apply every substitution of the layer to the columns of df that have one.
+
+        Returns:
+            df (pd.DataFrame): df with the decoded columns as Categoricals.
+        """
+        for col in df.columns:
+            if col.upper() not in self.lookups:
+                continue
+            try:
+                df[col] = self.decode_column(df[col], col)
+            except TypeError:  # Columns with unhashable values (some layers, e.g. Shunt Reactor) are left as they are.
+                pass
+        return df
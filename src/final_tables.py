@@ -0,0 +1,489 @@
+import os
+import glob
+import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import warnings
+
+warnings.filterwarnings("ignore")
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the merge processes run without a memory limit.
+    resource = None
+
+from .config import OUTPUTS_DIR, OUTPUT_FORMAT, MERGE_WORKERS, MERGE_MEMORY_LIMIT
+from .domains import DomainDecoder
+from .dates import epoch_ms_to_datetime
+from .geometry import (
+    GeometryArray,
+    add_geometry_columns,
+    concat_geometries,
+    decode_geometries,
+)
+from .spatial import spatial_index_path, write_spatial_index
+from .lod import lod_path, write_lod
+from .profiles import profile_variable
+from .store import read_features
+from .writers import (
+    FeatureWriter,
+    TableSink,
+    read_table,
+    write_table,
+    arrow_table,
+    table_extension,
+    feature_columns,
+    feature_schema,
+    max_date_modified,
+)
+from .telemetry import telemetry
+
+
+def merge_and_parse_files_final(
+    features_files: list = None,
+    attributes_files: list = None,
+    max_workers: int = MERGE_WORKERS,
+    memory_limit: int = MERGE_MEMORY_LIMIT,
+    output_format: str = OUTPUT_FORMAT,
+):
+    """
+    Merging features and attributes for each layer in each MapService.
+    Saving these files in URI outputs/final/
+    Every layer is an independent job, run across a pool of max_workers processes (largest layers first).
+    Failed layers do not stop the rest; they are reported once all the layers have been merged.
+
+    Args:
+        features_files (list, optional): Features files (or FeatureStore directories) to merge. Defaults to every outputs/**/features/ file of output_format and every store.
+        attributes_files (list, optional): Attributes files to look the substitutions up in. Defaults to every outputs/**/attributes/ file.
+        max_workers (int, optional): Number of layers merged at the same time, 1 to merge them in this process. Defaults to config.MERGE_WORKERS.
+        memory_limit (int, optional): Address space limit in bytes of every merge process. Defaults to config.MERGE_MEMORY_LIMIT.
+        output_format (str, optional): Format of the features files and final tables, e.g. GEO_Client().output_format. Defaults to config.OUTPUT_FORMAT.
+    """
+    if features_files is None:
+        features_files = glob.glob(
+            OUTPUTS_DIR + f"/**/features/*{table_extension(output_format)}"
+        )
+        # Layers synced incrementally are FeatureStore directories.
+        features_files += [
+            os.path.dirname(x)
+            for x in glob.glob(OUTPUTS_DIR + f"/**/features/*/store.json")
+        ]
+    if attributes_files is None:
+        attributes_files = glob.glob(OUTPUTS_DIR + f"/**/attributes/*")
+    features_files = sorted(features_files, key=_layer_size, reverse=True)
+
+    failed = []
+    if max_workers <= 1 or len(features_files) <= 1:
+        for file in features_files:
+            try:
+                merge_layer_final(file, attributes_files, output_format)
+            except Exception as e:
+                print(f"Failed merging {file}: {e!r}")
+                failed.append(file)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(features_files)),
+            initializer=_init_merge_process,
+            initargs=(memory_limit, telemetry.profile_stages),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _merge_layer_job, file, attributes_files, output_format
+                ): file
+                for file in features_files
+            }
+            for future in as_completed(futures):
+                try:
+                    telemetry.extend(future.result())
+                except Exception as e:
+                    print(f"Failed merging {futures[future]}: {e!r}")
+                    failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"{len(failed)} layers failed to merge: {failed}")
+
+
+def _layer_size(file: str):
+    """
+    Bytes of a features file or FeatureStore directory, to schedule the largest layers first.
+    """
+    if os.path.isdir(file):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(file)
+            for name in names
+        )
+    return os.path.getsize(file)
+
+
+def _init_merge_process(memory_limit: int, profile_stages: list):
+    """
+    Set up a merge process: the stages profiled in this run and its memory limit.
+    """
+    telemetry.profile_stages = list(profile_stages)
+    if memory_limit is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _merge_layer_job(file: str, attributes_files: list, output_format: str):
+    """
+    merge_layer_final() in a merge process.
+
+    Returns:
+        spans (list): Telemetry spans recorded by the job, added to the run report by the parent process.
+    """
+    start = len(telemetry.spans)
+    merge_layer_final(file, attributes_files, output_format)
+    return telemetry.spans[start:]
+
+
+def merge_layer_final(
+    file: str, attributes_files: list, output_format: str = OUTPUT_FORMAT
+):
+    """
+    Merge the features of a single layer with its attributes (coded values and types), decode its dates and geometries and save it in outputs/{variable}/final/,
+    with its spatial index and level of detail pyramid (write_layer_indexes()).
+
+    Args:
+        file (str): Features file or FeatureStore directory of the layer.
+        attributes_files (list): Attributes files to look the substitutions up in.
+        output_format (str, optional): Format of the final table. Defaults to config.OUTPUT_FORMAT.
+    """
+    variable = os.path.basename(os.path.dirname(os.path.dirname(file)))
+    os.makedirs(os.path.join(OUTPUTS_DIR, f"{variable}", "final"), exist_ok=True)
+
+    if os.path.isdir(file):
+        name_ = os.path.basename(file) + table_extension(output_format)
+    else:
+        name_ = os.path.basename(file)
+    key = f"{variable}/{os.path.splitext(name_)[0]}"
+    try:
+        with telemetry.span("merge.read", key) as span:
+            df = read_features(file)
+            span["rows"] = len(df)
+    except MemoryError:
+        # Over the memory limit of the merge process, the layer is reported as failed.
+        raise
+    except:
+        return
+    if len(df) == 0:
+        return
+
+    attributes_file = [
+        x
+        for x in attributes_files
+        if os.path.basename(os.path.dirname(os.path.dirname(x)))
+        == profile_variable(variable)
+        and os.path.basename(x) == name_
+    ]
+    assert len(attributes_file) == 1, f"{len(attributes_file)} attributes files for {key}"
+    try:
+        attributes = read_table(attributes_file[0])
+    except:
+        attributes = pd.DataFrame()
+
+    df, geometry_array = parse_final(
+        df, DomainDecoder.from_table(attributes), key, output_format
+    )
+
+    name_ = os.path.splitext(name_)[0] + table_extension(output_format)
+    path = os.path.join(OUTPUTS_DIR, f"{variable}", "final", name_)
+    with telemetry.span("merge.write", key, rows=len(df)) as span:
+        write_table(df, path)
+        span["bytes"] = os.path.getsize(path)
+    write_layer_indexes(df, variable, os.path.splitext(name_)[0], key, geometry_array)
+    print(f"Saved final: {variable} {name_}")
+
+
+def write_layer_indexes(
+    df: pd.DataFrame,
+    variable: str,
+    name_: str,
+    key: str = None,
+    geometry_array: GeometryArray = None,
+    geometry_type: str = None,
+):
+    """
+    Save the spatial index (outputs/{variable}/spatial/) and the level of detail pyramid (outputs/{variable}/lod/) of a final table.
+    Both are built from geometry_array, the rings / paths decoded by parse_final(), which are only decoded again when it is not given.
+    Point layers only get the index.
+    """
+    index = write_spatial_index(
+        df, spatial_index_path(variable, name_), geometry_array, key, geometry_type
+    )
+    if index is not None and index.geometry_array is not None:
+        write_lod(
+            index.geometry_array, index.geometry_type, lod_path(variable, name_), key
+        )
+
+
+def parse_final(
+    df: pd.DataFrame,
+    decoder: DomainDecoder,
+    key: str = None,
+    output_format: str = OUTPUT_FORMAT,
+):
+    """
+    Turn normalised features into final table rows: strip the attributes. / geometry. prefixes, convert the DATE columns,
+    substitute the coded values and types, and add the centroid and bounding box of the rings / paths.
+
+    Args:
+        df (pd.DataFrame): Normalised features of a layer (or of a page of it), modified in place.
+        decoder (DomainDecoder): Coded values and types of the layer.
+        key (str, optional): Layer key the spans are recorded under. Defaults to None.
+        output_format (str, optional): Format the rows are written in, Parquet stores the rings / paths as nested lists. Defaults to config.OUTPUT_FORMAT.
+
+    Returns:
+        df (pd.DataFrame): Final table rows.
+        geometry_array (GeometryArray): Decoded rings / paths, None for point layers.
+    """
+    df.columns = df.columns.str.replace("attributes.", "")
+    df.columns = df.columns.str.replace("geometry.", "")
+
+    with telemetry.span("merge.dates", key, rows=len(df)):
+        for col in df.columns:
+            if "DATE" in col:
+                df[col] = epoch_ms_to_datetime(df[col])
+
+    # Coded values and types are substituted through lookup tables built once per layer.
+    with telemetry.span("merge.domains", key, rows=len(df)):
+        decoder.decode(df)
+
+    # Rings and paths are parsed once into flat coordinate arrays, from which the
+    # centroid of the first part (x, y) and the bounding box are computed in batch.
+    geometry_array = None
+    with telemetry.span("merge.geometry", key, rows=len(df)):
+        for geometry_col in ["rings", "paths"]:
+            if geometry_col in df.columns:
+                geometry_array = add_geometry_columns(
+                    df, geometry_col, nested=output_format == "parquet"
+                )
+    return df, geometry_array
+
+
+class FinalWriter:
+    """
+    Fused pipeline: build the final table of a layer straight from its query pages.
+    Every page is normalised, parsed (parse_final()) and appended to the final table as it arrives, instead of writing the features file and reading it back in merge_and_parse_files_final().
+    Like FeatureWriter, only one page is held in memory at a time and the table is written aside and swapped in on close().
+    Only the OBJECTIDs and decoded geometries are kept, to build the spatial index and level of detail pyramid on close().
+    The raw features are only written when raw_path is given. The format (CSV or Parquet) is taken from the extension of path. Same interface as FeatureWriter,
+    a resumed writer decodes the OBJECTIDs and geometries back from the rows written before the checkpoint.
+
+    Usage:
+        writer = FinalWriter(path, DomainDecoder.from_layer_json(layer_json), key)
+        for page in pages:
+            writer.write(page)
+        writer.close()
+    """
+
+    def __init__(
+        self, path: str, decoder: DomainDecoder, key: str = None, raw_path: str = None
+    ):
+        """
+        Args:
+            path (str): Path of the final table.
+            decoder (DomainDecoder): Coded values and types of the layer.
+            key (str, optional): Layer key the spans are recorded under. Defaults to None.
+            raw_path (str, optional): Also write the raw features to this features file. Defaults to None.
+        """
+        self.path = path
+        self.decoder = decoder
+        self.key = key
+        self.raw = None if raw_path is None else FeatureWriter(raw_path, key)
+        self.sink = TableSink(path)
+        self.parquet = self.sink.parquet
+        self.columns = None
+        self.schema = None
+        self.written = 0
+        self.index_frames = []
+        self.geometry_arrays = []
+        self.geometry_type = None
+        self.rows = 0
+        self.high_water_mark = None
+
+    def write(self, page: dict):
+        """
+        Normalise, parse and append the features of a query response.
+
+        Returns:
+            df (pd.DataFrame): Normalised features of the page, with the columns of a features file.
+        """
+        with telemetry.span("normalize", self.key) as span:
+            df = pd.json_normalize(page["features"])
+            span["rows"] = len(df)
+        return self.write_frame(df, page)
+
+    def write_frame(self, df: pd.DataFrame, page: dict):
+        """
+        Parse and append features that are already normalised.
+
+        Returns:
+            df (pd.DataFrame): df with the columns of the layer.
+        """
+        if self.raw is not None:
+            df = self.raw.write_frame(df, page)
+        else:
+            if self.columns is None:
+                self.columns = list(df.columns) + [
+                    column for column in feature_columns(page) if column not in df.columns
+                ]
+            df = df.reindex(columns=self.columns)
+        self.rows += len(df)
+        if "attributes.DATEMODIFIED" in df.columns:
+            self.high_water_mark = max_date_modified(
+                df["attributes.DATEMODIFIED"], self.high_water_mark
+            )
+        if len(df):
+            self._append(df, page)
+        return df
+
+    def _append(self, df: pd.DataFrame, page: dict):
+        final, geometry_array = parse_final(
+            df.copy(), self.decoder, self.key, "parquet" if self.parquet else "csv"
+        )
+        with telemetry.span("merge.write", self.key, rows=len(final)):
+            if self.parquet:
+                table = arrow_table(final)
+                if self.schema is None:
+                    self.schema = _final_schema(table.schema, feature_schema(page, df))
+                self.sink.append(_conform(table, self.schema))
+            else:
+                self.sink.append(final)
+        self.written += len(final)
+
+        if geometry_array is not None:
+            self.geometry_type = "rings" if "rings" in final.columns else "paths"
+        self._index(final, geometry_array)
+
+    def _index(self, final: pd.DataFrame, geometry_array: GeometryArray = None):
+        """
+        Keep the OBJECTIDs and geometries of final rows for the spatial index and the level of detail pyramid.
+        """
+        if geometry_array is not None:
+            self.geometry_arrays.append(geometry_array)
+            index_columns = ["OBJECTID"]
+        else:
+            index_columns = ["OBJECTID", "x", "y"]
+        self.index_frames.append(
+            final[[column for column in index_columns if column in final.columns]]
+        )
+
+    def checkpoint(self):
+        """
+        State of the writer after the pages written so far, see FeatureWriter.checkpoint().
+        """
+        raw = None if self.raw is None else self.raw.checkpoint()
+        return dict(
+            self.sink.checkpoint(),
+            raw=raw,
+            columns=self.columns,
+            written=self.written,
+            geometry_type=self.geometry_type,
+            rows=self.rows,
+            high_water_mark=(
+                None if self.high_water_mark is None else float(self.high_water_mark)
+            ),
+            tmp_paths=[self.sink.tmp_path] + ([] if raw is None else raw["tmp_paths"]),
+        )
+
+    def resumable(self, state: dict):
+        if (self.raw is None) != (state["raw"] is None):
+            return False
+        return TableSink.resumable(state) and (
+            self.raw is None or self.raw.resumable(state["raw"])
+        )
+
+    def resume(self, state: dict):
+        """
+        Continue the final table (and features file) of an interrupted run from its checkpoint(), see resumable().
+        """
+        if self.raw is not None:
+            self.raw.resume(state["raw"])
+        self.sink.resume(state)
+        self.schema = self.sink.schema
+        self.columns = state["columns"]
+        self.written = state["written"]
+        self.geometry_type = state["geometry_type"]
+        self.rows = state["rows"]
+        self.high_water_mark = state["high_water_mark"]
+        if self.written:
+            final = self.sink.read()
+            self._index(
+                final,
+                None
+                if self.geometry_type is None
+                else decode_geometries(final[self.geometry_type]),
+            )
+
+    def close(self):
+        """
+        Swap the final table in and write its spatial index and level of detail pyramid. Like merge_and_parse_files_final(), layers without features get none.
+        """
+        if self.raw is not None:
+            self.raw.close()
+        if self.written == 0:
+            self.sink.abort()
+            return
+        self.sink.close()
+        telemetry.record("merge.write", self.key, bytes=os.path.getsize(self.path))
+        write_layer_indexes(
+            pd.concat(self.index_frames, ignore_index=True),
+            os.path.basename(os.path.dirname(os.path.dirname(self.path))),
+            os.path.splitext(os.path.basename(self.path))[0],
+            self.key,
+            concat_geometries(self.geometry_arrays) if self.geometry_arrays else None,
+            self.geometry_type,
+        )
+        self.index_frames = []
+        self.geometry_arrays = []
+
+    def abort(self, keep: bool = False):
+        if self.raw is not None:
+            self.raw.abort(keep)
+        self.sink.abort(keep)
+        self.index_frames = []
+        self.geometry_arrays = []
+
+
+def _final_schema(schema: pa.Schema, feature_schema: pa.Schema):
+    """
+    Schema of a final table streamed by FinalWriter, from its first page.
+    Plain columns are typed from the esri field types of the layer (feature_schema()), as a single page may hold only integers in a double field or only nulls.
+    Dates, decoded domains and geometries keep the types parse_final() gave them.
+    """
+    types = {
+        field.name.replace("attributes.", "").replace("geometry.", ""): field.type
+        for field in feature_schema
+    }
+    fields = []
+    for field in schema:
+        type_ = field.type
+        plain = (
+            pa.types.is_integer(type_)
+            or pa.types.is_floating(type_)
+            or pa.types.is_string(type_)
+            or pa.types.is_null(type_)
+        )
+        if plain and field.name in types and not pa.types.is_list(types[field.name]):
+            type_ = types[field.name]
+        if pa.types.is_null(type_):
+            type_ = pa.string()
+        fields.append(pa.field(field.name, type_))
+    return pa.schema(fields)
+
+
+def _conform(table: pa.Table, schema: pa.Schema):
+    """
+    Cast the columns of a page to the schema of the final table, with nulls for the columns it does not have.
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            if column.type != field.type:
+                column = column.cast(field.type)
+        else:
+            column = pa.nulls(len(table), field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
@@ -0,0 +1,312 @@
+import ast
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def expand_ranges(counts):
+    """
+    For ranges of the given lengths, the range every element belongs to and its position within it.
+
+    Returns:
+        (owner, position) (tuple): Two (counts.sum(),) arrays.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return owner, np.arange(len(owner)) - starts[owner]
+
+
+class GeometryArray:
+    """
+    Geometries of a column (rings or paths) flattened into NumPy arrays:
+        - coords: (n_vertices, 2) array with the x, y of every vertex.
+        - part_offsets: (n_parts + 1,) array, the vertices of part j are coords[part_offsets[j]:part_offsets[j + 1]].
+        - geom_offsets: (n_geometries + 1,) array, the parts of geometry i are part_offsets[geom_offsets[i]:geom_offsets[i + 1]].
+        - valid: (n_geometries,) boolean array, False where the geometry is missing.
+    """
+
+    def __init__(self, coords, part_offsets, geom_offsets, valid=None):
+        self.coords = coords
+        self.part_offsets = part_offsets
+        self.geom_offsets = geom_offsets
+        if valid is None:
+            valid = np.ones(len(geom_offsets) - 1, dtype=bool)
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.geom_offsets) - 1
+
+    @property
+    def part_lengths(self):
+        return np.diff(self.part_offsets)
+
+    @property
+    def geom_lengths(self):
+        return np.diff(self.geom_offsets)
+
+    def vertex_offsets(self):
+        """
+        (n_geometries + 1,) array, the vertices of geometry i are coords[vertex_offsets[i]:vertex_offsets[i + 1]].
+        """
+        return self.part_offsets[self.geom_offsets]
+
+    def first_part_centroids(self):
+        """
+        Mean x, y of the vertices of the first part of every geometry (NaN for empty geometries).
+
+        Returns:
+            (x, y) (tuple): Two (n_geometries,) arrays.
+        """
+        x = np.full(len(self), np.nan)
+        y = np.full(len(self), np.nan)
+        lengths = self.part_lengths
+        rows = np.flatnonzero(self.geom_lengths > 0)
+        first_part = self.geom_offsets[:-1][rows]
+        keep = lengths[first_part] > 0
+        rows, first_part = rows[keep], first_part[keep]
+        if len(rows) == 0:
+            return x, y
+        # Sums over each first part as differences of the cumulative sum of the vertices.
+        cumsum = np.vstack([np.zeros((1, 2)), np.cumsum(self.coords, axis=0)])
+        sums = (
+            cumsum[self.part_offsets[first_part + 1]]
+            - cumsum[self.part_offsets[first_part]]
+        )
+        means = sums / lengths[first_part][:, None]
+        x[rows] = means[:, 0]
+        y[rows] = means[:, 1]
+        return x, y
+
+    def bounds(self):
+        """
+        Bounding box of every geometry (NaN for empty geometries).
+
+        Returns:
+            bounds (np.ndarray): (n_geometries, 4) array with xmin, ymin, xmax, ymax.
+        """
+        bounds = np.full((len(self), 4), np.nan)
+        vertex_offsets = self.vertex_offsets()
+        rows = np.flatnonzero(np.diff(vertex_offsets) > 0)
+        if len(rows) == 0:
+            return bounds
+        starts = vertex_offsets[rows]
+        # Empty geometries have no vertices, so each reduceat slice ends where the geometry does.
+        bounds[rows, :2] = np.minimum.reduceat(self.coords, starts, axis=0)
+        bounds[rows, 2:] = np.maximum.reduceat(self.coords, starts, axis=0)
+        return bounds
+
+    def to_arrow(self):
+        """
+        Nested list<list<list<double>>> arrow array with the geometries, built straight from the offsets.
+        """
+        vertices = pa.ListArray.from_arrays(
+            pa.array(np.arange(0, 2 * len(self.coords) + 1, 2), pa.int32()),
+            pa.array(self.coords.ravel()),
+        )
+        parts = pa.ListArray.from_arrays(
+            pa.array(self.part_offsets, pa.int32()), vertices
+        )
+        return pa.ListArray.from_arrays(
+            pa.array(self.geom_offsets, pa.int32()),
+            parts,
+            mask=pa.array(~self.valid),
+        )
+
+
+def concat_geometries(geometry_arrays: list):
+    """
+    Single GeometryArray with the geometries of geometry_arrays one after the other, e.g. of the pages of a layer.
+    """
+    coords = [np.empty((0, 2))] + [g.coords for g in geometry_arrays]
+    part_offsets = [np.zeros(1, dtype=np.int64)]
+    geom_offsets = [np.zeros(1, dtype=np.int64)]
+    vertices = parts = 0
+    for geometry_array in geometry_arrays:
+        part_offsets.append(
+            np.asarray(geometry_array.part_offsets[1:], dtype=np.int64) + vertices
+        )
+        geom_offsets.append(
+            np.asarray(geometry_array.geom_offsets[1:], dtype=np.int64) + parts
+        )
+        vertices += len(geometry_array.coords)
+        parts += len(geometry_array.part_offsets) - 1
+    return GeometryArray(
+        np.concatenate(coords),
+        np.concatenate(part_offsets),
+        np.concatenate(geom_offsets),
+        np.concatenate([np.ones(0, dtype=bool)] + [g.valid for g in geometry_arrays]),
+    )
+
+
+def _from_arrow(array):
+    """
+    GeometryArray from a list<list<list<double>>> arrow array, reusing its offsets.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    array = array.cast(pa.list_(pa.list_(pa.list_(pa.float64()))))
+    valid = array.is_valid().to_numpy(zero_copy_only=False)
+    # Offsets of null entries are not meaningful, so rebuild them from the lengths.
+    geom_lengths = array.value_lengths().fill_null(0).to_numpy()
+    parts = array.flatten()
+    part_lengths = parts.value_lengths().fill_null(0).to_numpy()
+    vertices = parts.flatten()
+    vertex_lengths = vertices.value_lengths().fill_null(0).to_numpy()
+    values = vertices.flatten().to_numpy(zero_copy_only=False)
+    if len(vertex_lengths) == 0:
+        coords = np.empty((0, 2))
+    elif (vertex_lengths == vertex_lengths[0]).all():
+        coords = values.reshape(len(vertex_lengths), -1)[:, :2]
+    else:
+        starts = np.concatenate([[0], np.cumsum(vertex_lengths)[:-1]])
+        coords = np.c_[values[starts], values[starts + 1]]
+    return GeometryArray(
+        coords.astype(np.float64),
+        np.concatenate([[0], np.cumsum(part_lengths)]).astype(np.int64),
+        np.concatenate([[0], np.cumsum(geom_lengths)]).astype(np.int64),
+        valid,
+    )
+
+
+def _from_strings(strings: list):
+    """
+    GeometryArray from stringified geometries ("[[[x, y], ...], ...]"), all present and non empty.
+    The structure comes from the depth of every bracket and the coordinates from a single numeric parse of the whole text.
+    Returns None when the text does not have that regular structure.
+    """
+    text = ",".join(strings)
+    chars = np.frombuffer(text.encode(), dtype=np.uint8)
+    brackets = np.flatnonzero((chars == ord("[")) | (chars == ord("]")))
+    opens = chars[brackets] == ord("[")
+    depth = np.cumsum(np.where(opens, 1, -1))
+
+    geom_open = opens & (depth == 1)
+    part_open = opens & (depth == 2)
+    vertex_open = opens & (depth == 3)
+    if geom_open.sum() != len(strings) or depth.max() != 3 or depth[-1] != 0:
+        return None
+
+    part_geom = np.cumsum(geom_open)[part_open] - 1
+    vertex_part = np.cumsum(part_open)[vertex_open] - 1
+    geom_lengths = np.bincount(part_geom, minlength=len(strings))
+    part_lengths = np.bincount(vertex_part, minlength=int(part_open.sum()))
+
+    if (part_lengths == 0).any():
+        return None
+    try:
+        numbers = np.fromstring(text.translate(str.maketrans("", "", "[]")), sep=",")
+    except ValueError:
+        return None
+    n_vertices = int(vertex_open.sum())
+    if len(numbers) % n_vertices != 0:
+        return None
+    coords = numbers.reshape(n_vertices, -1)[:, :2]
+
+    return GeometryArray(
+        coords,
+        np.concatenate([[0], np.cumsum(part_lengths)]),
+        np.concatenate([[0], np.cumsum(geom_lengths)]),
+    )
+
+
+def _parse_string(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def _nested_list(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype != object:
+            return value.tolist()
+        value = list(value)
+    return [_nested_list(item) for item in value] if isinstance(value, list) else value
+
+
+def decode_geometries(values: pd.Series):
+    """
+    Parse a column of rings / paths once into a GeometryArray.
+    Stringified lists (CSV) are parsed in a single pass over the whole column, nested lists (Parquet) through arrow.
+
+    Args:
+        values (pd.Series): Geometries of the column, NaN / None when missing.
+
+    Returns:
+        geometry_array (GeometryArray): Geometries in the same order as values.
+    """
+    if isinstance(values.dtype, pd.ArrowDtype):
+        return _from_arrow(values.array._pa_array)
+
+    values = list(values)
+    strings = np.array([isinstance(value, str) for value in values], dtype=bool)
+    if strings.any():
+        rows = [i for i in np.flatnonzero(strings) if values[i].strip() != "[]"]
+        if rows:
+            decoded = _from_strings([values[i] for i in rows])
+        else:
+            decoded = GeometryArray(
+                np.empty((0, 2)), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+            )
+        if decoded is not None:
+            geom_lengths = np.zeros(len(values), dtype=np.int64)
+            geom_lengths[rows] = decoded.geom_lengths
+            return GeometryArray(
+                decoded.coords,
+                decoded.part_offsets,
+                np.concatenate([[0], np.cumsum(geom_lengths)]),
+                strings,
+            )
+        # Irregular text (empty parts, mixed dimensions...): parse row by row.
+        values = [
+            _parse_string(value) if is_string else value
+            for value, is_string in zip(values, strings)
+        ]
+
+    geometry_type = pa.list_(pa.list_(pa.list_(pa.float64())))
+    # Lists decoded from JSON go to arrow as they are, the numpy arrays read from Parquet are converted first.
+    try:
+        return _from_arrow(
+            pa.array(
+                [
+                    (
+                        value
+                        if isinstance(value, list)
+                        else _nested_list(value) if isinstance(value, np.ndarray) else None
+                    )
+                    for value in values
+                ],
+                type=geometry_type,
+            )
+        )
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        values = [
+            _nested_list(value) if isinstance(value, (list, np.ndarray)) else None
+            for value in values
+        ]
+        return _from_arrow(pa.array(values, type=geometry_type))
+
+
+def add_geometry_columns(df: pd.DataFrame, column: str, nested: bool = False):
+    """
+    Decode df[column] (rings or paths) and add the centroid of its first part (x, y) and its bounding box (xmin, ymin, xmax, ymax).
+
+    Args:
+        df (pd.DataFrame): Final table, modified in place.
+        column (str): "rings" or "paths".
+        nested (bool, optional): Replace df[column] with a nested list column (for Parquet). Otherwise it is left as it is. Defaults to False.
+
+    Returns:
+        geometry_array (GeometryArray): Decoded geometries, in the same order as df.
+    """
+    geometry_array = decode_geometries(df[column])
+    if nested:
+        df[column] = pd.Series(
+            pd.arrays.ArrowExtensionArray(geometry_array.to_arrow()), index=df.index
+        )
+    df["x"], df["y"] = geometry_array.first_part_centroids()
+    bounds = geometry_array.bounds()
+    df["xmin"], df["ymin"], df["xmax"], df["ymax"] = bounds.T
+    return geometry_array
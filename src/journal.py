@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import datetime
+import threading
+
+from .config import JOURNAL_DIR
+
+
+class RunJournal:
+    """
+    Checkpoints of an extraction run, so a run that dies halfway can be resumed without fetching again what was already on disk:
+        - journal.json: options of the run and state of every layer job, keyed by "{variable}/{map_service}/{layer}":
+            status ("running" / "done"), pages and rows committed, last_oid (highest objectId committed)
+            and writer, the checkpoint() of the writer of a running layer: its file written aside and the byte offset of the last committed page.
+    A page is only committed once it is appended to that file, so a resumed layer cuts the file at the offset and appends the rest of the layer to it,
+    and a crash loses at most the pages that were in flight.
+
+    Usage:
+        journal = RunJournal()
+        journal.start(options, resume=True)
+        journal.commit_page(variable, map_service_, layer_, writer.checkpoint(), last_oid)
+        journal.finish_layer(variable, map_service_, layer_)
+        journal.clear()
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path: str = JOURNAL_DIR):
+        self.path = path
+
+    @staticmethod
+    def _key(variable: str, map_service_: int, layer_: int):
+        return f"{variable}/{int(map_service_)}/{int(layer_)}"
+
+    def _journal_path(self):
+        return os.path.join(self.path, "journal.json")
+
+    def load(self):
+        """
+        Returns:
+            journal (dict): options, started and layers of the run, empty if there is none.
+        """
+        try:
+            with open(self._journal_path()) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, journal: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self._journal_path()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(journal, json_file, indent=4)
+        os.replace(tmp_path, self._journal_path())
+
+    def start(self, options: dict, resume: bool = False):
+        """
+        Open the journal of a run. With resume, the journal of an interrupted run with the same options is kept, otherwise a new one is started.
+
+        Args:
+            options (dict): Options of the run (e.g. which features and profile), a journal is only resumed by a run with the same ones.
+            resume (bool, optional): Continue the previous run. Defaults to False.
+
+        Returns:
+            resumed (bool): Whether the previous run is being continued.
+        """
+        journal = self.load()
+        if resume and journal.get("options") == options:
+            done = sum(
+                layer["status"] == "done" for layer in journal["layers"].values()
+            )
+            print(
+                f"Resuming run started at {journal['started']}: {done} layers done, {len(journal['layers']) - done} interrupted"
+            )
+            return True
+        if resume:
+            print("No run to resume with these options, starting a new one")
+        # The files the layers of the previous run were writing are not resumed any more.
+        for layer in journal.get("layers", {}).values():
+            for tmp_path in (layer.get("writer") or {}).get("tmp_paths", []):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.clear()
+        self._save(
+            {
+                "options": options,
+                "started": datetime.datetime.now().strftime("%Y-%m-%d %X"),
+                "layers": {},
+            }
+        )
+        return False
+
+    def layer(self, variable: str, map_service_: int, layer_: int):
+        """
+        Returns:
+            state (dict): Checkpoint of the layer, None if the run has not started it.
+        """
+        return self.load().get("layers", {}).get(
+            self._key(variable, map_service_, layer_)
+        )
+
+    def is_done(self, variable: str, map_service_: int, layer_: int):
+        state = self.layer(variable, map_service_, layer_)
+        return state is not None and state["status"] == "done"
+
+    def commit_page(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        writer: dict,
+        last_oid: int = None,
+    ):
+        """
+        Record a page of a layer as committed, once its writer has appended it.
+
+        Args:
+            variable (str): Name of the Map Service folder.
+            map_service_ (int): Id of the Map Service.
+            layer_ (int): Id of the layer.
+            writer (dict): checkpoint() of the writer of the layer (FeatureWriter / FinalWriter) after the page.
+            last_oid (int, optional): Highest objectId of the pages committed so far. Defaults to None.
+        """
+        state = self.layer(variable, map_service_, layer_) or {
+            "status": "running",
+            "pages": 0,
+        }
+        state["pages"] += 1
+        state["rows"] = writer["rows"]
+        state["last_oid"] = None if last_oid is None else int(last_oid)
+        state["writer"] = writer
+        self._set_layer(variable, map_service_, layer_, state)
+
+    def finish_layer(self, variable: str, map_service_: int, layer_: int, rows: int = None):
+        """
+        Record a layer as done, its file has been swapped in.
+        """
+        state = self.layer(variable, map_service_, layer_) or {"pages": 0, "rows": 0}
+        self._set_layer(
+            variable,
+            map_service_,
+            layer_,
+            {
+                "status": "done",
+                "pages": 0,
+                "rows": state["rows"] if rows is None else int(rows),
+            },
+        )
+
+    def _set_layer(self, variable: str, map_service_: int, layer_: int, state: dict):
+        with self._lock:
+            journal = self.load()
+            journal.setdefault("layers", {})[
+                self._key(variable, map_service_, layer_)
+            ] = state
+            self._save(journal)
+
+    def clear(self):
+        """
+        Remove the journal, once the run it belongs to has finished.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,289 @@
+import os
+import numpy as np
+
+from .config import OUTPUTS_DIR, LOD_ZOOMS, LOD_PIXEL_TOLERANCE, LOD_VIEWPORT_WIDTH
+from .geometry import GeometryArray, expand_ranges
+from .telemetry import telemetry
+
+
+def zoom_tolerance(zoom: float):
+    """
+    Degrees covered by LOD_PIXEL_TOLERANCE pixels at a web map zoom level (256 pixel tiles, at the equator).
+    """
+    return LOD_PIXEL_TOLERANCE * 360 / (256 * 2**zoom)
+
+
+def viewport_zoom(bbox: tuple, width: int = LOD_VIEWPORT_WIDTH):
+    """
+    Web map zoom level at which bbox spans width pixels, e.g. the zoom of a plotly map showing it.
+
+    Args:
+        bbox (tuple): (xmin, ymin, xmax, ymax) in EPSG:4326.
+        width (int, optional): Width of the map in pixels. Defaults to config.LOD_VIEWPORT_WIDTH.
+    """
+    xmin, ymin, xmax, ymax = bbox
+    span = max(xmax - xmin, ymax - ymin, 1e-9)
+    return float(np.log2(360 * width / (256 * span)))
+
+
+def simplify(geometry_array: GeometryArray, tolerance: float, closed: bool):
+    """
+    Douglas-Peucker simplification of every part, run over all the parts at once: every pass splits all the pending
+    vertex ranges at their farthest vertex from the chord, until none is further than tolerance.
+    Parts smaller than tolerance are dropped, as are rings left with fewer than 4 vertices and paths with fewer than 2.
+
+    Args:
+        geometry_array (GeometryArray): Rings or paths.
+        tolerance (float): Maximum distance from the simplified geometries to the original ones, in coordinate units.
+        closed (bool): True for rings.
+
+    Returns:
+        geometry_array (GeometryArray): Simplified geometries, in the same rows.
+    """
+    coords = geometry_array.coords
+    part_offsets = geometry_array.part_offsets
+    lengths = geometry_array.part_lengths
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[part_offsets[:-1][lengths > 0]] = True
+    keep[part_offsets[1:][lengths > 0] - 1] = True
+
+    starts = part_offsets[:-1][lengths > 2]
+    ends = part_offsets[1:][lengths > 2] - 1
+    while len(starts):
+        owner, position = expand_ranges(ends - starts - 1)
+        vertices = starts[owner] + 1 + position
+        a, b, p = coords[starts][owner], coords[ends][owner], coords[vertices]
+        ab = b - a
+        length = (ab**2).sum(axis=1)
+        # Closed rings start and end on the same vertex, the chord is then that point.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.clip(((p - a) * ab).sum(axis=1) / length, 0, 1)
+        t = np.where(length > 0, t, 0)
+        distances = np.hypot(*(a + t[:, None] * ab - p).T)
+
+        # The interior vertices of every range are contiguous and no range is empty.
+        farthest = np.maximum.reduceat(
+            distances, np.concatenate([[0], np.cumsum(ends - starts - 1)[:-1]])
+        )
+        is_farthest = distances == farthest[owner]
+        first = np.ones(is_farthest.sum(), dtype=bool)
+        first[1:] = owner[is_farthest][1:] != owner[is_farthest][:-1]
+        split = np.full(len(starts), -1, dtype=np.int64)
+        split[owner[is_farthest][first]] = vertices[is_farthest][first]
+
+        pending = farthest > tolerance
+        starts, ends, split = starts[pending], ends[pending], split[pending]
+        keep[split] = True
+        starts, ends = np.r_[starts, split], np.r_[split, ends]
+        interior = ends - starts > 1
+        starts, ends = starts[interior], ends[interior]
+
+    part_of_vertex = np.repeat(np.arange(len(lengths)), lengths)
+    kept_lengths = np.bincount(part_of_vertex[keep], minlength=len(lengths))
+    # Parts smaller than the tolerance would be drawn as a single pixel.
+    part_bounds = _part_bounds(coords, part_offsets)
+    size = np.fmax(
+        part_bounds[:, 2] - part_bounds[:, 0], part_bounds[:, 3] - part_bounds[:, 1]
+    )
+    visible = (kept_lengths >= (4 if closed else 2)) & (size >= tolerance)
+    keep &= visible[part_of_vertex]
+    kept_lengths = np.where(visible, kept_lengths, 0)
+
+    part_rows = np.repeat(np.arange(len(geometry_array)), geometry_array.geom_lengths)
+    geom_lengths = np.bincount(part_rows[visible], minlength=len(geometry_array))
+    return GeometryArray(
+        coords[keep],
+        np.concatenate([[0], np.cumsum(kept_lengths[visible])]).astype(np.int64),
+        np.concatenate([[0], np.cumsum(geom_lengths)]).astype(np.int64),
+        geometry_array.valid,
+    )
+
+
+def _part_bounds(coords: np.ndarray, part_offsets: np.ndarray):
+    """
+    (n_parts, 4) array with the xmin, ymin, xmax, ymax of every part (NaN for empty parts).
+    """
+    bounds = np.full((len(part_offsets) - 1, 4), np.nan)
+    parts = np.flatnonzero(np.diff(part_offsets) > 0)
+    if len(parts):
+        bounds[parts, :2] = np.minimum.reduceat(coords, part_offsets[parts], axis=0)
+        bounds[parts, 2:] = np.maximum.reduceat(coords, part_offsets[parts], axis=0)
+    return bounds
+
+
+class LODPyramid:
+    """
+    Level of detail pyramid of a layer: its rings / paths simplified for every zoom level of LOD_ZOOMS, to plot a whole layer as a single trace.
+    The level for zoom z is simplified to zoom_tolerance(z), so it looks the same as the full resolution geometries at that zoom and above.
+
+    Usage:
+        pyramid = LODPyramid.load(lod_path("landbase", "bordes"))
+        trace = pyramid.traces(bbox=(-75, -55, -53, -21), zoom=4)
+        fig.add_trace(go.Scattermapbox(lon=trace["lon"], lat=trace["lat"], fill="toself", mode="lines"))
+    """
+
+    def __init__(self, levels: dict, geometry_type: str):
+        """
+        Args:
+            levels (dict): Simplified GeometryArray of every zoom level.
+            geometry_type (str): "rings" or "paths".
+        """
+        self.levels = dict(sorted(levels.items()))
+        self.geometry_type = geometry_type
+
+    @classmethod
+    def from_geometries(
+        cls, geometry_array: GeometryArray, geometry_type: str, zooms: list = LOD_ZOOMS
+    ):
+        """
+        Simplify the geometries of a final table for every zoom level.
+        Every level is simplified from the next finer one, which has far fewer vertices than the original geometries.
+        The result is the same: the vertices Douglas-Peucker keeps for a tolerance are always kept for any smaller one.
+        """
+        levels = {}
+        for zoom in sorted(zooms, reverse=True):
+            geometry_array = simplify(
+                geometry_array, zoom_tolerance(zoom), geometry_type == "rings"
+            )
+            levels[zoom] = geometry_array
+        return cls(levels, geometry_type)
+
+    def save(self, path: str):
+        """
+        Write the pyramid to a .npz file, swapping it in once it is complete.
+        """
+        arrays = {"geometry_type": np.array(self.geometry_type)}
+        for zoom, level in self.levels.items():
+            arrays[f"{zoom}_coords"] = level.coords
+            arrays[f"{zoom}_part_offsets"] = level.part_offsets
+            arrays[f"{zoom}_geom_offsets"] = level.geom_offsets
+            arrays[f"{zoom}_valid"] = level.valid
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as arrays:
+            zooms = sorted(
+                {
+                    int(name.split("_")[0])
+                    for name in arrays.files
+                    if name != "geometry_type"
+                }
+            )
+            levels = {
+                zoom: GeometryArray(
+                    arrays[f"{zoom}_coords"],
+                    arrays[f"{zoom}_part_offsets"],
+                    arrays[f"{zoom}_geom_offsets"],
+                    arrays[f"{zoom}_valid"],
+                )
+                for zoom in zooms
+            }
+            return cls(levels, str(arrays["geometry_type"]))
+
+    def level(self, zoom: float):
+        """
+        Zoom level of the pyramid to draw at zoom: the coarsest one that is still detailed enough, the finest one beyond it.
+        """
+        zooms = list(self.levels)
+        fitting = [level for level in zooms if level >= zoom]
+        return fitting[0] if fitting else zooms[-1]
+
+    def traces(
+        self,
+        bbox: tuple = None,
+        zoom: float = None,
+        rows=None,
+        width: int = LOD_VIEWPORT_WIDTH,
+    ):
+        """
+        Coordinates of the parts in a viewport merged into a single trace, separated by NaN (a gap in plotly).
+
+        Args:
+            bbox (tuple, optional): (xmin, ymin, xmax, ymax) of the viewport, only the parts intersecting it are returned. Defaults to None (all of them).
+            zoom (float, optional): Zoom level of the map. Defaults to the zoom at which bbox spans width pixels, or the coarsest level without bbox.
+            rows (array-like, optional): Only these rows (positions) of the final table, e.g. the lines of one voltage. Defaults to None (all).
+            width (int, optional): Width of the map in pixels, used when zoom is not given. Defaults to config.LOD_VIEWPORT_WIDTH.
+
+        Returns:
+            trace (dict): "lon" and "lat" arrays, "rows" with the row of every vertex (-1 on the gaps, e.g. to pick its text from the final table)
+            and "zoom", the level they were taken from.
+        """
+        if zoom is None:
+            zoom = viewport_zoom(bbox, width) if bbox is not None else -np.inf
+        level_zoom = self.level(zoom)
+        level = self.levels[level_zoom]
+
+        part_rows = np.repeat(np.arange(len(level)), level.geom_lengths)
+        selected = np.ones(len(part_rows), dtype=bool)
+        if rows is not None:
+            selected &= np.isin(part_rows, np.asarray(rows))
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            part_bounds = _part_bounds(level.coords, level.part_offsets)
+            selected &= (
+                (part_bounds[:, 0] <= xmax)
+                & (part_bounds[:, 2] >= xmin)
+                & (part_bounds[:, 1] <= ymax)
+                & (part_bounds[:, 3] >= ymin)
+            )
+        parts = np.flatnonzero(selected)
+
+        # Every part is followed by a gap vertex.
+        lengths = level.part_lengths[parts] + 1
+        owner, position = expand_ranges(lengths)
+        gap = position == lengths[owner] - 1
+        vertices = level.part_offsets[parts][owner] + np.minimum(
+            position, lengths[owner] - 2
+        )
+        coords = level.coords[vertices]
+        lon = np.where(gap, np.nan, coords[:, 0])
+        lat = np.where(gap, np.nan, coords[:, 1])
+        return {
+            "lon": lon,
+            "lat": lat,
+            "rows": np.where(gap, -1, part_rows[parts][owner]),
+            "zoom": level_zoom,
+        }
+
+
+def lod_path(variable: str, name_: str):
+    """
+    Path of the level of detail pyramid of a final table: outputs/{variable}/lod/{layer}.npz
+    """
+    return os.path.join(OUTPUTS_DIR, variable, "lod", f"{name_}.npz")
+
+
+def write_lod(
+    geometry_array: GeometryArray, geometry_type: str, path: str, key: str = None
+):
+    """
+    Build the level of detail pyramid of a final table and save it to path.
+
+    Args:
+        geometry_array (GeometryArray): Decoded rings / paths of the final table.
+        geometry_type (str): "rings" or "paths".
+        path (str): Path of the pyramid, see lod_path().
+        key (str, optional): Layer key the span is recorded under. Defaults to None.
+    """
+    with telemetry.span("merge.lod", key, rows=len(geometry_array)) as span:
+        LODPyramid.from_geometries(geometry_array, geometry_type).save(path)
+        span["bytes"] = os.path.getsize(path)
+
+
+def get_lod(
+    variable: str,
+    name_: str,
+    bbox: tuple = None,
+    zoom: float = None,
+    rows=None,
+    width: int = LOD_VIEWPORT_WIDTH,
+):
+    """
+    Single trace with the geometries of a layer at the level of detail of a viewport, see LODPyramid.traces().
+    e.g. get_lod("landbase", "bordes", bbox=(-75, -55, -53, -21)) for the whole country.
+    """
+    return LODPyramid.load(lod_path(variable, name_)).traces(bbox, zoom, rows, width)
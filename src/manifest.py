@@ -0,0 +1,113 @@
+import os
+import json
+import datetime
+import threading
+import pandas as pd
+
+from .config import MANIFEST_PATH
+from .dates import epoch_ms_to_datetime
+
+
+class SyncManifest:
+    """
+    JSON sidecar with the sync state of every layer, keyed by "{variable}/{name}":
+        - map_service, layer: Where the layer was fetched from.
+        - high_water_mark: Highest DATEMODIFIED (epoch milliseconds) stored for the layer.
+        - rows: Number of features stored.
+        - last_sync: When the layer was last fetched.
+        - last_edit_date: editingInfo.lastEditDate of the layer definition when it was last synced, None after a full fetch.
+    Every update rewrites the file aside and swaps it in, so a crash never leaves a half written manifest.
+
+    Usage:
+        manifest = SyncManifest()
+        manifest.update(variable, map_service_, layer_, name_, high_water_mark, rows)
+        modified_dates = manifest.modified_dates()
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Returns:
+            layers (dict): Sync state of every layer.
+        """
+        try:
+            with open(self.path) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, variable: str, name_: str):
+        return self.load().get(f"{variable}/{name_}")
+
+    def update(
+        self,
+        variable: str,
+        map_service_: int,
+        layer_: int,
+        name_: str,
+        high_water_mark: int,
+        rows: int,
+        last_edit_date: int = None,
+    ):
+        """
+        Record the state of a layer at the end of its fetch.
+
+        Args:
+            variable (str): Name of the Map Service folder.
+            map_service_ (int): Id of the Map Service.
+            layer_ (int): Id of the layer.
+            name_ (str): Name of the layer.
+            high_water_mark (int): Highest DATEMODIFIED of the layer in epoch milliseconds, None if it has none.
+            rows (int): Number of features stored.
+            last_edit_date (int, optional): editingInfo.lastEditDate of the layer definition before the sync, None if unknown. Defaults to None.
+        """
+        with self._lock:
+            layers = self.load()
+            layers[f"{variable}/{name_}"] = {
+                "map_service": int(map_service_),
+                "layer": int(layer_),
+                "high_water_mark": (
+                    None if pd.isna(high_water_mark) else int(high_water_mark)
+                ),
+                "rows": int(rows),
+                "last_sync": datetime.datetime.now().strftime("%Y-%m-%d %X"),
+                "last_edit_date": last_edit_date,
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as json_file:
+                json.dump(layers, json_file, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def modified_dates(self):
+        """
+        Last DATEMODIFIED of every layer, in the layout of utils.get_last_mod_date_files().
+        Layers with the same name in several Map Service folders take the earliest date, so none of them misses edits.
+
+        Returns:
+            name_date (pd.DataFrame): name, date (datetime) and date2 (text for the DATE '...' queries).
+        """
+        layers = self.load()
+        name_date = pd.DataFrame(
+            {
+                "name": [key.split("/", 1)[1] for key in layers],
+                "date": epoch_ms_to_datetime(
+                    pd.Series(
+                        [layer["high_water_mark"] for layer in layers.values()],
+                        dtype=float,
+                    )
+                ),
+            }
+        )
+        name_date = name_date.groupby("name", as_index=False)["date"].min()
+        name_date["date2"] = name_date["date"].apply(
+            lambda x: None if pd.isna(x) else x.strftime("%Y-%m-%d %X")
+        )
+        return name_date
@@ -0,0 +1,98 @@
+from .config import EXTRACTION_PROFILE
+
+# Per-layer options of the feature queries, by profile. Layers are looked up as "{variable}/{name}", falling back to "*":
+#     - out_fields: Fields to return instead of all of them (required_fields and the objectIdField are always added).
+#     - return_geometry: False for layers whose attributes are all that is needed.
+#     - max_allowable_offset: Generalise the geometry server side, in units of outSR (degrees).
+#     - geometry_precision: Decimals of the returned coordinates.
+profiles = {
+    # Every field and every vertex.
+    "full": {"*": {}},
+    # What the plotting notebook draws: provinces, substations and lines at map scale.
+    "map": {
+        "*": {"max_allowable_offset": 0.0001, "geometry_precision": 5},
+        "landbase/bordes": {"max_allowable_offset": 0.001, "geometry_precision": 4},
+        "sin/sobrelineas": {
+            "out_fields": ["ESTADO", "VOLTS", "LABELTEXT"],
+            "max_allowable_offset": 0.0001,
+            "geometry_precision": 5,
+        },
+        "sin/enterradas_lineas": {
+            "out_fields": ["ESTADO", "VOLTS", "LABELTEXT"],
+            "max_allowable_offset": 0.0001,
+            "geometry_precision": 5,
+        },
+    },
+    # Attribute tables only, without geometry.
+    "attributes": {"*": {"return_geometry": False}},
+}
+
+# Fields requested whatever the out_fields of a profile: the rows are keyed by OBJECTID and synced from the DATEMODIFIED high-water mark.
+required_fields = ["OBJECTID", "DATEMODIFIED"]
+
+
+def profile_folder(variable: str, profile: str):
+    """
+    Folder the outputs of a profile are saved to: the Map Service folder itself for "full", "{variable}.{profile}" for the rest,
+    so simplified geometries and field subsets never overwrite the complete features and final tables.
+
+    Args:
+        variable (str): Name of the Map Service folder.
+        profile (str): Name of the profile, None for config.EXTRACTION_PROFILE.
+    """
+    profile = profile or EXTRACTION_PROFILE
+    return variable if profile == "full" else f"{variable}.{profile}"
+
+
+def profile_variable(folder: str):
+    """
+    Map Service folder of a profile folder, e.g. "sin" for "sin.map".
+    """
+    return folder.split(".")[0]
+
+
+def layer_profile(profile: str, variable: str, name_: str):
+    """
+    Options of a layer in a profile.
+
+    Args:
+        profile (str): Name of the profile, None for config.EXTRACTION_PROFILE.
+        variable (str): Name of the Map Service (or profile) folder.
+        name_ (str): Name of the layer.
+
+    Returns:
+        options (dict): Options of the layer (empty for "full").
+    """
+    layers = profiles[profile or EXTRACTION_PROFILE]
+    # Profile folders take the options of their Map Service.
+    variable = profile_variable(variable)
+    return layers.get(f"{variable}/{name_}", layers.get("*", {}))
+
+
+def profile_params(profile: str, variable: str, name_: str, out_fields: bool = True):
+    """
+    Query parameters that a profile overrides for a layer.
+
+    Args:
+        profile (str): Name of the profile, None for config.EXTRACTION_PROFILE.
+        variable (str): Name of the Map Service folder.
+        name_ (str): Name of the layer.
+        out_fields (bool, optional): Apply the field subset. Defaults to True.
+
+    Returns:
+        params (dict): Parameters to update the feature query parameters with.
+    """
+    options = layer_profile(profile, variable, name_)
+    params = {}
+    if out_fields and options.get("out_fields"):
+        fields = options["out_fields"] + [
+            field for field in required_fields if field not in options["out_fields"]
+        ]
+        params["outFields"] = ",".join(fields)
+    if options.get("return_geometry") is False:
+        params["returnGeometry"] = "false"
+    if options.get("max_allowable_offset") is not None:
+        params["maxAllowableOffset"] = str(options["max_allowable_offset"])
+    if options.get("geometry_precision") is not None:
+        params["geometryPrecision"] = str(options["geometry_precision"])
+    return params
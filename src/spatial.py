@@ -0,0 +1,413 @@
+import os
+import numpy as np
+import pandas as pd
+
+from .config import OUTPUTS_DIR, SPATIAL_CELL_ROWS, SPATIAL_QUERY_CHUNK
+from .geometry import GeometryArray, decode_geometries, expand_ranges
+from .telemetry import telemetry
+
+
+class SpatialIndex:
+    """
+    Uniform grid over the bounding boxes of a final table, with its decoded geometries, for vectorised lookups:
+        - intersects(): rows whose bounding box intersects every query box.
+        - contains(): polygon containing every query point.
+        - nearest(): geometry closest to every query point.
+    Every row is listed in the cells its bounding box covers, the rows of cell c are rows[cell_offsets[c]:cell_offsets[c + 1]].
+    Lookups return row positions of the final table as it was read (df.iloc), -1 where there is no match.
+
+    Usage:
+        index = SpatialIndex.load(spatial_index_path("landbase", "bordes"))
+        rows = index.contains(nodo["x"], nodo["y"])
+    """
+
+    def __init__(
+        self,
+        bounds: np.ndarray,
+        geometry_array: GeometryArray = None,
+        geometry_type: str = None,
+        ids: np.ndarray = None,
+        cell_size: float = None,
+    ):
+        """
+        Args:
+            bounds (np.ndarray): (n_rows, 4) array with xmin, ymin, xmax, ymax, NaN for rows without geometry.
+            geometry_array (GeometryArray, optional): Geometries of the rows, None for point layers. Defaults to None.
+            geometry_type (str, optional): "rings", "paths" or "points". Defaults to None.
+            ids (np.ndarray, optional): OBJECTID of every row. Defaults to None.
+            cell_size (float, optional): Side of the grid cells. Defaults to about SPATIAL_CELL_ROWS rows per cell.
+        """
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.geometry_array = geometry_array
+        self.geometry_type = geometry_type
+        self.ids = ids
+        valid = ~np.isnan(self.bounds).any(axis=1)
+        if valid.any():
+            extent = np.r_[
+                self.bounds[valid, :2].min(axis=0), self.bounds[valid, 2:].max(axis=0)
+            ]
+        else:
+            extent = np.zeros(4)
+        self.origin = extent[:2]
+        if cell_size is None:
+            width, height = np.maximum(extent[2:] - extent[:2], 1e-9)
+            share = SPATIAL_CELL_ROWS / max(valid.sum(), 1)
+            # Layers spread along a line (e.g. a single transmission line) get cells along it, not a grid of empty ones.
+            cell_size = max(np.sqrt(width * height * share), max(width, height) * share)
+        self.cell_size = float(cell_size)
+        self.shape = (
+            np.floor((extent[2:] - extent[:2]) / self.cell_size).astype(np.int64) + 1
+        )
+
+        rows = np.flatnonzero(valid)
+        cells, owner = self._cells(self.bounds[rows])
+        order = np.argsort(cells, kind="stable")
+        self.rows = rows[owner[order]]
+        self.cell_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(cells, minlength=int(np.prod(self.shape))))]
+        ).astype(np.int64)
+        self._segments = None
+
+    def __len__(self):
+        return len(self.bounds)
+
+    @classmethod
+    def from_table(
+        cls,
+        df: pd.DataFrame,
+        geometry_array: GeometryArray = None,
+        geometry_type: str = None,
+    ):
+        """
+        Index of a final table, from its bounding box columns (rings / paths) or its x, y columns (points).
+
+        Args:
+            df (pd.DataFrame): Final table.
+            geometry_array (GeometryArray, optional): Geometries already decoded from df. Defaults to decoding the rings / paths column.
+            geometry_type (str, optional): "rings" or "paths" of geometry_array, for a df without that column. Defaults to the column of df.
+
+        Returns:
+            index (SpatialIndex): None when the table has no geometry.
+        """
+        ids = df["OBJECTID"].to_numpy() if "OBJECTID" in df.columns else None
+        if geometry_type is None:
+            geometry_type = next(
+                (column for column in ["rings", "paths"] if column in df.columns), None
+            )
+        if geometry_type is not None:
+            if geometry_array is None:
+                geometry_array = decode_geometries(df[geometry_type])
+            return cls(geometry_array.bounds(), geometry_array, geometry_type, ids)
+        if "x" in df.columns and "y" in df.columns:
+            points = df[["x", "y"]].apply(pd.to_numeric, errors="coerce").to_numpy()
+            return cls(np.c_[points, points], None, "points", ids)
+        return None
+
+    def save(self, path: str):
+        """
+        Write the index to a .npz file, swapping it in once it is complete.
+        """
+        arrays = {
+            "bounds": self.bounds,
+            "cell_size": np.array(self.cell_size),
+            "geometry_type": np.array(self.geometry_type or ""),
+        }
+        if self.ids is not None and np.asarray(self.ids).dtype != object:
+            arrays["ids"] = np.asarray(self.ids)
+        if self.geometry_array is not None:
+            arrays.update(
+                coords=self.geometry_array.coords,
+                part_offsets=self.geometry_array.part_offsets,
+                geom_offsets=self.geometry_array.geom_offsets,
+                valid=self.geometry_array.valid,
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Read an index written by save(). The grid is rebuilt from the bounding boxes, which takes a fraction of decoding the geometries.
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            geometry_array = None
+            if "coords" in arrays:
+                geometry_array = GeometryArray(
+                    arrays["coords"],
+                    arrays["part_offsets"],
+                    arrays["geom_offsets"],
+                    arrays["valid"],
+                )
+            return cls(
+                arrays["bounds"],
+                geometry_array,
+                str(arrays["geometry_type"]) or None,
+                arrays["ids"] if "ids" in arrays else None,
+                float(arrays["cell_size"]),
+            )
+
+    def _cells(self, boxes: np.ndarray):
+        """
+        Grid cells covered by every box.
+
+        Returns:
+            (cells, owner) (tuple): Cell numbers, and the box every one of them was covered by.
+        """
+        # Boxes entirely outside the grid (or missing) cover no cell.
+        outside = (
+            (boxes[:, 2:] < self.origin).any(axis=1)
+            | (boxes[:, :2] >= self.origin + self.shape * self.cell_size).any(axis=1)
+            | np.isnan(boxes).any(axis=1)
+        )
+        cells = np.floor((np.nan_to_num(boxes) - np.tile(self.origin, 2)) / self.cell_size)
+        cells = np.clip(cells, 0, np.tile(self.shape - 1, 2)).astype(np.int64)
+        low, high = cells[:, :2], cells[:, 2:]
+        spans = np.where(outside[:, None], 0, high - low + 1)
+        owner, position = expand_ranges(spans[:, 0] * spans[:, 1])
+        cx = low[owner, 0] + position % spans[owner, 0]
+        cy = low[owner, 1] + position // spans[owner, 0]
+        return cy * self.shape[0] + cx, owner
+
+    def _candidates(self, boxes: np.ndarray):
+        """
+        (query, row) pairs whose bounding boxes intersect, each one once and in no particular order.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        cells, owner = self._cells(boxes)
+        listed, position = expand_ranges(
+            self.cell_offsets[cells + 1] - self.cell_offsets[cells]
+        )
+        queries = owner[listed]
+        cells = cells[listed]
+        rows = self.rows[self.cell_offsets[cells] + position]
+        row_bounds, query_bounds = self.bounds[rows], boxes[queries]
+        low = np.maximum(row_bounds[:, :2], query_bounds[:, :2])
+        keep = (low <= np.minimum(row_bounds[:, 2:], query_bounds[:, 2:])).all(axis=1)
+        # A row is listed in every cell it covers: keep each pair only in the cell where the two boxes start to overlap.
+        low = np.floor((low - self.origin) / self.cell_size)
+        low = np.clip(low, 0, self.shape - 1).astype(np.int64)
+        keep &= cells == low[:, 1] * self.shape[0] + low[:, 0]
+        return queries[keep], rows[keep]
+
+    def intersects(self, xmin, ymin, xmax, ymax):
+        """
+        Rows whose bounding box intersects every query box.
+
+        Args:
+            xmin, ymin, xmax, ymax (array-like): Query boxes.
+
+        Returns:
+            (queries, rows) (tuple): Matching pairs, sorted by query then row.
+        """
+        queries, rows = self._candidates(np.c_[xmin, ymin, xmax, ymax])
+        order = np.lexsort((rows, queries))
+        return queries[order], rows[order]
+
+    def segments(self):
+        """
+        Segments of the geometries: (start, end) vertices and the row they belong to.
+        Rings are closed from their last vertex back to the first, paths are not.
+        """
+        if self._segments is None:
+            geometry_array = self.geometry_array
+            n_vertices = len(geometry_array.coords)
+            part_ends = np.repeat(
+                geometry_array.part_offsets[1:], geometry_array.part_lengths
+            )
+            part_starts = np.repeat(
+                geometry_array.part_offsets[:-1], geometry_array.part_lengths
+            )
+            following = np.arange(1, n_vertices + 1)
+            if self.geometry_type == "rings":
+                following = np.where(following == part_ends, part_starts, following)
+                starts = np.arange(n_vertices)
+            else:
+                starts = np.flatnonzero(following < part_ends)
+                following = following[starts]
+            vertex_rows = np.repeat(
+                np.arange(len(geometry_array)),
+                np.diff(geometry_array.vertex_offsets()),
+            )
+            rows = vertex_rows[starts]
+            self._segments = (
+                geometry_array.coords[starts],
+                geometry_array.coords[following],
+                np.concatenate(
+                    [[0], np.cumsum(np.bincount(rows, minlength=len(self)))]
+                ).astype(np.int64),
+            )
+        return self._segments
+
+    def _pair_segments(self, queries: np.ndarray, rows: np.ndarray):
+        """
+        Split (query, row) pairs into chunks of about SPATIAL_QUERY_CHUNK (pair, segment) combinations.
+
+        Yields:
+            (pairs, starts, ends) (tuple): Pair of every combination, and the segment it is tested against.
+        """
+        starts, ends, offsets = self.segments()
+        counts = offsets[rows + 1] - offsets[rows]
+        splits = np.searchsorted(
+            np.cumsum(counts),
+            np.arange(SPATIAL_QUERY_CHUNK, counts.sum(), SPATIAL_QUERY_CHUNK),
+        )
+        for chunk in np.split(np.arange(len(rows)), splits + 1):
+            if len(chunk) == 0:
+                continue
+            pairs, position = expand_ranges(counts[chunk])
+            segment = offsets[rows[chunk][pairs]] + position
+            yield chunk[pairs], starts[segment], ends[segment]
+
+    def _inside(self, x: np.ndarray, y: np.ndarray, queries: np.ndarray, rows: np.ndarray):
+        """
+        Whether point queries[i] is inside the polygon of rows[i] (even-odd rule, so holes are excluded).
+        """
+        crossings = np.zeros(len(rows), dtype=np.int64)
+        for pairs, a, b in self._pair_segments(queries, rows):
+            px, py = x[queries[pairs]], y[queries[pairs]]
+            straddles = (a[:, 1] > py) != (b[:, 1] > py)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cross_x = a[:, 0] + (py - a[:, 1]) * (b[:, 0] - a[:, 0]) / (
+                    b[:, 1] - a[:, 1]
+                )
+            crossings += np.bincount(
+                pairs[straddles & (px < cross_x)], minlength=len(rows)
+            )
+        return crossings % 2 == 1
+
+    def contains(self, x, y):
+        """
+        Polygon containing every point, e.g. the province of every substation.
+
+        Args:
+            x, y (array-like): Coordinates of the points.
+
+        Returns:
+            rows (np.ndarray): Row of the first polygon containing each point, -1 for points outside every polygon.
+        """
+        if self.geometry_type != "rings":
+            raise ValueError(f"contains() needs a polygon layer, not {self.geometry_type}")
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(len(x), -1, dtype=np.int64)
+        queries, rows = self._candidates(np.c_[x, y, x, y])
+        inside = self._inside(x, y, queries, rows)
+        # Overlapping polygons: the first row containing the point wins.
+        first = np.full(len(x), len(self), dtype=np.int64)
+        np.minimum.at(first, queries[inside], rows[inside])
+        result[first < len(self)] = first[first < len(self)]
+        return result
+
+    def _distances(self, x: np.ndarray, y: np.ndarray, queries: np.ndarray, rows: np.ndarray):
+        """
+        Distance from point queries[i] to the geometry of rows[i], 0 inside polygons.
+        """
+        if self.geometry_array is None:
+            return np.hypot(
+                self.bounds[rows, 0] - x[queries], self.bounds[rows, 1] - y[queries]
+            )
+        distances = np.full(len(rows), np.inf)
+        for pairs, a, b in self._pair_segments(queries, rows):
+            p = np.c_[x[queries[pairs]], y[queries[pairs]]]
+            ab = b - a
+            length = (ab**2).sum(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = np.clip(((p - a) * ab).sum(axis=1) / length, 0, 1)
+            t = np.where(length > 0, t, 0)
+            d = np.hypot(*(a + t[:, None] * ab - p).T)
+            np.minimum.at(distances, pairs, d)
+        if self.geometry_type == "rings":
+            distances[self._inside(x, y, queries, rows)] = 0
+        return distances
+
+    def nearest(self, x, y, max_distance: float = None):
+        """
+        Geometry closest to every point, e.g. the nearest nodo to every vertex of a line.
+        The search starts in the cell of every point and doubles its radius until a geometry is found within it.
+
+        Args:
+            x, y (array-like): Coordinates of the points.
+            max_distance (float, optional): Do not look further than this. Defaults to None (the whole layer).
+
+        Returns:
+            (rows, distances) (tuple): Nearest row of every point (-1 when there is none within max_distance) and the distance to it.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rows = np.full(len(x), -1, dtype=np.int64)
+        distances = np.full(len(x), np.inf)
+        # Beyond the farthest corner of the grid from every point there is nothing left to find.
+        far_corner = self.origin + self.shape * self.cell_size
+        limit = np.hypot(
+            np.maximum(np.abs(x - self.origin[0]), np.abs(x - far_corner[0])),
+            np.maximum(np.abs(y - self.origin[1]), np.abs(y - far_corner[1])),
+        )
+        if max_distance is not None:
+            limit = np.minimum(limit, max_distance)
+        pending = np.flatnonzero(~np.isnan(x) & ~np.isnan(y))
+        # Half a cell already holds several rows on average.
+        radius = np.full(len(x), self.cell_size / 2)
+        while len(pending):
+            r = np.minimum(radius[pending], limit[pending])
+            px, py = x[pending], y[pending]
+            queries, candidates = self._candidates(np.c_[px - r, py - r, px + r, py + r])
+            d = self._distances(px, py, queries, candidates)
+            # Closest candidate of every query, the first row on ties.
+            found = np.full(len(pending), np.inf)
+            np.minimum.at(found, queries, d)
+            closest = d == found[queries]
+            nearest_rows = np.full(len(pending), len(self), dtype=np.int64)
+            np.minimum.at(nearest_rows, queries[closest], candidates[closest])
+            # Anything closer than r has its box within the searched square.
+            done = (found <= r) | (r >= limit[pending])
+            within = done & (found <= r)
+            rows[pending[within]] = nearest_rows[within]
+            distances[pending[within]] = found[within]
+            radius[pending] *= 2
+            pending = pending[~done]
+        return rows, distances
+
+
+def spatial_index_path(variable: str, name_: str):
+    """
+    Path of the spatial index of a final table: outputs/{variable}/spatial/{layer}.npz
+    """
+    return os.path.join(OUTPUTS_DIR, variable, "spatial", f"{name_}.npz")
+
+
+def write_spatial_index(
+    df: pd.DataFrame,
+    path: str,
+    geometry_array: GeometryArray = None,
+    key: str = None,
+    geometry_type: str = None,
+):
+    """
+    Build the spatial index of a final table and save it to path. Tables without geometry get none.
+
+    Args:
+        df (pd.DataFrame): Final table.
+        path (str): Path of the index, see spatial_index_path().
+        geometry_array (GeometryArray, optional): Geometries already decoded from df. Defaults to None.
+        key (str, optional): Layer key the span is recorded under. Defaults to None.
+        geometry_type (str, optional): "rings" or "paths" of geometry_array, see SpatialIndex.from_table(). Defaults to None.
+
+    Returns:
+        index (SpatialIndex): None when the table has no geometry.
+    """
+    with telemetry.span("merge.spatial", key, rows=len(df)) as span:
+        index = SpatialIndex.from_table(df, geometry_array, geometry_type)
+        if index is None:
+            return None
+        index.save(path)
+        span["bytes"] = os.path.getsize(path)
+    return index
+
+
+def load_spatial_index(variable: str, name_: str):
+    """
+    Spatial index of the final table of a layer, e.g. load_spatial_index("landbase", "bordes").
+    """
+    return SpatialIndex.load(spatial_index_path(variable, name_))
@@ -0,0 +1,197 @@
+import os
+import json
+import glob
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+
+from .config import OUTPUT_FORMAT, STORE_PARTITION_SIZE
+from .writers import read_table, write_table, table_extension
+
+
+class FeatureStore:
+    """
+    Incremental store of the features of a layer, keyed on its objectIdField.
+    Rows are split in partitions of partition_size consecutive OBJECTIDs, so an upsert or a deletion only rewrites the partitions it touches:
+        - store.json: objectIdField, format, partition size and columns.
+        - oids.npy: sorted OBJECTIDs currently in the store.
+        - part-{n}.csv / .parquet: rows with n * partition_size <= OBJECTID < (n + 1) * partition_size.
+        - tombstones.csv / .parquet: OBJECTIDs deleted on the server and when the deletion was seen.
+
+    Usage:
+        store = FeatureStore(path)
+        store.upsert(changed_df)
+        store.delete(deleted_ids)
+        df = store.read()
+    """
+
+    def __init__(
+        self,
+        path: str,
+        partition_size: int = STORE_PARTITION_SIZE,
+        output_format: str = OUTPUT_FORMAT,
+    ):
+        self.path = path
+        self.meta = None
+        if self.exists():
+            with open(os.path.join(path, "store.json")) as json_file:
+                self.meta = json.load(json_file)
+        else:
+            self.meta = {
+                "oid_field": None,
+                "format": output_format,
+                "partition_size": partition_size,
+                "columns": [],
+            }
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "store.json"))
+
+    @property
+    def oid_column(self):
+        return f"attributes.{self.meta['oid_field']}"
+
+    @property
+    def extension(self):
+        return table_extension(self.meta["format"])
+
+    def _partition_path(self, partition: int):
+        return os.path.join(self.path, f"part-{partition:06d}{self.extension}")
+
+    def _partitions(self, object_ids):
+        return np.asarray(object_ids, dtype=np.int64) // self.meta["partition_size"]
+
+    def _save_meta(self):
+        tmp_path = os.path.join(self.path, "store.json.tmp")
+        with open(tmp_path, "w") as json_file:
+            json.dump(self.meta, json_file, indent=4)
+        os.replace(tmp_path, os.path.join(self.path, "store.json"))
+
+    def object_ids(self):
+        """
+        Returns:
+            object_ids (np.ndarray): Sorted OBJECTIDs in the store.
+        """
+        try:
+            return np.load(os.path.join(self.path, "oids.npy"))
+        except OSError:
+            return np.empty(0, dtype=np.int64)
+
+    def _save_object_ids(self, object_ids):
+        tmp_path = os.path.join(self.path, "oids.tmp.npy")
+        np.save(tmp_path, np.asarray(object_ids, dtype=np.int64))
+        os.replace(tmp_path, os.path.join(self.path, "oids.npy"))
+
+    def create(self, df: pd.DataFrame, oid_field: str):
+        """
+        Build the store from a full features table of the layer (e.g. the features file of the last full fetch).
+
+        Args:
+            df (pd.DataFrame): Normalised features of the layer.
+            oid_field (str): objectIdField of the layer.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.meta["oid_field"] = oid_field
+        self.meta["columns"] = list(df.columns)
+        df = df.sort_values(self.oid_column)
+        for partition, rows in df.groupby(self._partitions(df[self.oid_column])):
+            write_table(rows, self._partition_path(partition))
+        self._save_object_ids(df[self.oid_column].to_numpy())
+        self._save_meta()
+
+    def upsert(self, df: pd.DataFrame):
+        """
+        Insert new rows and replace the rows with the same OBJECTID, rewriting only the affected partitions.
+
+        Args:
+            df (pd.DataFrame): Normalised features with the new version of the rows.
+
+        Returns:
+            partitions (list): Partitions that were rewritten.
+        """
+        if len(df) == 0:
+            return []
+        df = df.drop_duplicates(subset=self.oid_column, keep="last")
+        self.meta["columns"] += [
+            column for column in df.columns if column not in self.meta["columns"]
+        ]
+        written = []
+        for partition, rows in df.groupby(self._partitions(df[self.oid_column])):
+            path = self._partition_path(partition)
+            if os.path.exists(path):
+                current = read_table(path)
+                current = current[~current[self.oid_column].isin(rows[self.oid_column])]
+                rows = pd.concat([current, rows])
+            rows = rows.reindex(columns=self.meta["columns"]).sort_values(
+                self.oid_column
+            )
+            write_table(rows, path)
+            written.append(int(partition))
+        self._save_object_ids(
+            np.union1d(self.object_ids(), df[self.oid_column].to_numpy(dtype=np.int64))
+        )
+        self._save_meta()
+        return written
+
+    def delete(self, object_ids):
+        """
+        Remove rows deleted on the server and record them as tombstones.
+
+        Args:
+            object_ids (list): OBJECTIDs to delete.
+
+        Returns:
+            partitions (list): Partitions that were rewritten.
+        """
+        object_ids = np.intersect1d(
+            np.asarray(object_ids, dtype=np.int64), self.object_ids()
+        )
+        if len(object_ids) == 0:
+            return []
+        written = []
+        for partition in np.unique(self._partitions(object_ids)):
+            path = self._partition_path(partition)
+            if not os.path.exists(path):
+                continue
+            current = read_table(path)
+            write_table(current[~current[self.oid_column].isin(object_ids)], path)
+            written.append(int(partition))
+
+        tombstones_path = os.path.join(self.path, f"tombstones{self.extension}")
+        tombstones = pd.DataFrame(
+            {
+                self.meta["oid_field"]: object_ids,
+                "deleted_at": datetime.datetime.now().strftime("%Y-%m-%d %X"),
+            }
+        )
+        if os.path.exists(tombstones_path):
+            tombstones = pd.concat([read_table(tombstones_path), tombstones])
+        write_table(tombstones, tombstones_path)
+
+        self._save_object_ids(np.setdiff1d(self.object_ids(), object_ids))
+        return written
+
+    def read(self, columns: list = None):
+        """
+        Returns:
+            df (pd.DataFrame): Every row of the store, ordered by OBJECTID.
+        """
+        frames = [
+            read_table(path, columns=columns)
+            for path in sorted(glob.glob(os.path.join(self.path, f"part-*{self.extension}")))
+        ]
+        if not frames:
+            return pd.DataFrame(columns=columns or self.meta["columns"])
+        return pd.concat(frames).reset_index(drop=True)
+
+
+def read_features(path: str):
+    """
+    Read the features of a layer, either a features file or a FeatureStore directory.
+    """
+    if os.path.isdir(path):
+        return FeatureStore(path).read()
+    return read_table(path)
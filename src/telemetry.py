@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import time
+import cProfile
+import datetime
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+
+from .config import REPORTS_DIR, PROFILE_STAGES
+
+
+class Telemetry:
+    """
+    Spans of an ETL run: stage (e.g. "login.signin", "request", "normalize", "write", "merge.domains"), layer key, seconds, bytes and rows.
+    The spans are summed per stage and per layer into a JSON run report, and the stages listed in profile_stages are also run under cProfile.
+    Thread-safe, a single instance (telemetry) is shared by the clients and the merge stage.
+
+    Usage:
+        with telemetry.span("write", key) as span:
+            span["rows"] = len(df)
+        telemetry.write_report()
+    """
+
+    # A single cProfile profiler can be active in a process (Python >= 3.12 raises otherwise), whichever span holds this lock.
+    _profile_lock = threading.Lock()
+
+    def __init__(self, profile_stages: list = PROFILE_STAGES, reports_dir: str = REPORTS_DIR):
+        self.profile_stages = list(profile_stages)
+        self.reports_dir = reports_dir
+        self._lock = threading.Lock()
+        self._profiles = itertools.count()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the spans recorded so far and start a new run.
+        """
+        with self._lock:
+            self.started = datetime.datetime.now()
+            self.spans = []
+            self.names = {}
+
+    def record(
+        self,
+        stage: str,
+        key: str = None,
+        seconds: float = 0.0,
+        bytes: int = 0,
+        rows: int = 0,
+        **fields,
+    ):
+        """
+        Record a span that was timed elsewhere.
+
+        Args:
+            stage (str): Name of the step.
+            key (str, optional): Layer the span belongs to, "{map_service}/{layer}" or "{variable}/{name}". Defaults to None.
+            seconds (float, optional): Duration. Defaults to 0.0.
+            bytes (int, optional): Bytes transferred or written. Defaults to 0.
+            rows (int, optional): Rows handled. Defaults to 0.
+        """
+        with self._lock:
+            self.spans.append(
+                {
+                    "stage": stage,
+                    "key": key,
+                    "start": round(time.time() - seconds, 3),
+                    "seconds": seconds,
+                    "bytes": int(bytes),
+                    "rows": int(rows),
+                    **fields,
+                }
+            )
+
+    def extend(self, spans: list):
+        """
+        Add spans recorded in another process, e.g. by a worker of the merge stage.
+        """
+        with self._lock:
+            self.spans.extend(spans)
+
+    def name(self, key: str, name: str):
+        """
+        Name ("{variable}/{name}") the spans of a layer key are reported under.
+        """
+        with self._lock:
+            self.names[key] = name
+
+    def _profiled(self, stage: str):
+        return any(
+            stage == prefix or stage.startswith(f"{prefix}.")
+            for prefix in self.profile_stages
+        )
+
+    @contextmanager
+    def span(self, stage: str, key: str = None, **fields):
+        """
+        Time the block as a span. The block can set "bytes", "rows" or any other field on the dict it gets.
+        If the stage is in profile_stages, the block is also profiled and its stats dumped to {reports_dir}/profiles/.
+        Only one span is profiled at a time: spans nested in a profiled one (e.g. "merge.dates" in "merge"), spans of other threads
+        running meanwhile and spans started while another profiler is active are timed but not profiled.
+        """
+        span = dict(fields)
+        profiler = None
+        if self._profiled(stage) and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # Another profiling tool is already active.
+                profiler = None
+                self._profile_lock.release()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profile_lock.release()
+                span["profile"] = self._dump_profile(profiler, stage, key)
+            self.record(stage, key, time.perf_counter() - start, **span)
+
+    def traced(self, stage: str):
+        """
+        Decorator running every call of a function as a span of stage.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _dump_profile(self, profiler: cProfile.Profile, stage: str, key: str = None):
+        profiles_dir = os.path.join(self.reports_dir, "profiles")
+        os.makedirs(profiles_dir, exist_ok=True)
+        label = re.sub(r"[^\w.-]+", "_", f"{stage}-{key}" if key else stage)
+        path = os.path.join(profiles_dir, f"{label}-{next(self._profiles)}.prof")
+        profiler.dump_stats(path)
+        return path
+
+    @staticmethod
+    def _totals(spans: list):
+        totals = {}
+        for span in spans:
+            total = totals.setdefault(
+                span["stage"], {"count": 0, "seconds": 0.0, "bytes": 0, "rows": 0}
+            )
+            total["count"] += 1
+            total["seconds"] += span["seconds"]
+            total["bytes"] += span["bytes"]
+            total["rows"] += span["rows"]
+        for total in totals.values():
+            total["seconds"] = round(total["seconds"], 3)
+        return totals
+
+    def report(self, spans: bool = True):
+        """
+        Run report: totals per stage and, per layer ("{variable}/{name}"), the totals of its stages with the rows and MB per second fetched.
+
+        Args:
+            spans (bool, optional): Also include every span. Defaults to True.
+
+        Returns:
+            report (dict): JSON serialisable report.
+        """
+        with self._lock:
+            recorded = list(self.spans)
+            names = dict(self.names)
+            started = self.started
+        finished = datetime.datetime.now()
+
+        # Spans of a layer are grouped under its "{variable}/{name}", so the fetch ("{map_service}/{layer}" keys, aliased Map Services included) and the merge of a layer end up together.
+        layer_spans = {}
+        for span in recorded:
+            if span["key"] is not None:
+                layer_spans.setdefault(names.get(span["key"], span["key"]), []).append(span)
+
+        layers = {}
+        for name in sorted(layer_spans):
+            stages = self._totals(layer_spans[name])
+            requests = stages.get("request", {"seconds": 0.0, "bytes": 0, "rows": 0})
+            # Requests of a layer overlap, its throughput is measured on the wall time of the layer when there is one.
+            seconds = stages.get("layer", requests)["seconds"]
+            layers[name] = {
+                "keys": sorted({span["key"] for span in layer_spans[name]}),
+                "stages": stages,
+                "rows": requests["rows"],
+                "bytes": requests["bytes"],
+                "rows_per_second": (
+                    round(requests["rows"] / seconds, 1) if seconds else None
+                ),
+                "mb_per_second": (
+                    round(requests["bytes"] / seconds / 1e6, 3) if seconds else None
+                ),
+            }
+
+        report = {
+            "started": started.strftime("%Y-%m-%d %X"),
+            "finished": finished.strftime("%Y-%m-%d %X"),
+            "seconds": round((finished - started).total_seconds(), 3),
+            "stages": self._totals(recorded),
+            "layers": layers,
+        }
+        if spans:
+            report["spans"] = recorded
+        return report
+
+    def write_report(self, path: str = None, spans: bool = True):
+        """
+        Write the run report as JSON.
+
+        Args:
+            path (str, optional): Defaults to {reports_dir}/run-{started}.json.
+            spans (bool, optional): Also include every span. Defaults to True.
+
+        Returns:
+            path (str): Path of the report.
+        """
+        if path is None:
+            path = os.path.join(
+                self.reports_dir, f"run-{self.started.strftime('%Y%m%d-%H%M%S')}.json"
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as json_file:
+            json.dump(self.report(spans), json_file, indent=4, default=str)
+        return path
+
+
+# Telemetry of the current run, shared by the clients, the writers and the merge stage.
+telemetry = Telemetry()
@@ -0,0 +1,417 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .config import OUTPUT_FORMAT
+from .telemetry import telemetry
+
+extensions = {"csv": ".csv", "parquet": ".parquet"}
+
+geometry_columns = {
+    "esriGeometryPoint": ["x", "y"],
+    "esriGeometryMultipoint": ["points"],
+    "esriGeometryPolyline": ["paths"],
+    "esriGeometryPolygon": ["rings"],
+}
+
+field_types = {
+    "esriFieldTypeOID": pa.int64(),
+    "esriFieldTypeInteger": pa.int64(),
+    "esriFieldTypeSmallInteger": pa.int32(),
+    "esriFieldTypeDouble": pa.float64(),
+    "esriFieldTypeSingle": pa.float64(),
+    "esriFieldTypeDate": pa.int64(),  # Raw epoch milliseconds, validated in the final stage.
+    "esriFieldTypeString": pa.string(),
+    "esriFieldTypeGUID": pa.string(),
+    "esriFieldTypeGlobalID": pa.string(),
+}
+
+geometry_types = {
+    "x": pa.float64(),
+    "y": pa.float64(),
+    "z": pa.float64(),
+    "m": pa.float64(),
+    "points": pa.list_(pa.list_(pa.float64())),
+    "paths": pa.list_(pa.list_(pa.list_(pa.float64()))),
+    "rings": pa.list_(pa.list_(pa.list_(pa.float64()))),
+}
+
+
+def table_extension(output_format: str = OUTPUT_FORMAT):
+    return extensions[output_format]
+
+
+def read_table(path: str, columns: list = None):
+    """
+    Read a features / attributes / final table written in any of the output formats.
+
+    Args:
+        path (str): Path to the .csv or .parquet file.
+        columns (list, optional): Only read these columns. Defaults to None (all).
+
+    Returns:
+        df (pd.DataFrame)
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def write_table(df: pd.DataFrame, path: str):
+    """
+    Write a table in the format given by the extension of path, swapping the file in once it is complete.
+    """
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    if path.endswith(".parquet"):
+        pq.write_table(arrow_table(df), tmp_path)
+    else:
+        text_cells(df).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def plain_lists(value):
+    """
+    value with its numpy arrays turned into (nested) lists.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return [plain_lists(item) for item in value]
+        return value.tolist()
+    return value
+
+
+def text_cells(df: pd.DataFrame):
+    """
+    df with the nested lists read from Parquet (numpy arrays of arrays) as lists, so they are written to CSV as the python literals
+    geometry._parse_string() reads back instead of numpy reprs.
+    """
+    # A column holds nested lists in all its cells or in none, its first value tells which.
+    nested = [
+        col
+        for col in df.columns[df.dtypes == object]
+        if isinstance(next(iter(df[col].dropna()), None), np.ndarray)
+    ]
+    if not nested:
+        return df
+    df = df.copy()
+    for col in nested:
+        df[col] = df[col].map(plain_lists)
+    return df
+
+
+def arrow_table(df: pd.DataFrame):
+    """
+    Arrow table with the rows of df, as write_table() stores them in Parquet.
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns with mixed python types (e.g. codes that were not mapped) are stored as text.
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            if not df[col].map(lambda x: isinstance(x, list)).any():
+                df[col] = df[col].astype("string")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    # The arrow types describe the columns already. The pandas metadata would also record
+    # ArrowDtype columns (nested geometries) by a name pandas cannot read back.
+    return table.replace_schema_metadata(None)
+
+
+def feature_columns(page: dict):
+    """
+    Columns that pd.json_normalize() produces for the features of a query response, taken from its fields and geometryType.
+    """
+    columns = [f"attributes.{field['name']}" for field in page.get("fields") or []]
+    columns += [
+        f"geometry.{column}"
+        for column in geometry_columns.get(page.get("geometryType"), [])
+    ]
+    return columns
+
+
+def feature_schema(page: dict, df: pd.DataFrame):
+    """
+    Arrow schema for the normalised features of a layer, typed from the esri field types of the query response.
+    Columns that are not described by the response are inferred from the first page, defaulting to text.
+    """
+    types = {
+        f"attributes.{field['name']}": field_types.get(field.get("type"), pa.string())
+        for field in page.get("fields") or []
+    }
+    types.update({f"geometry.{key}": value for key, value in geometry_types.items()})
+
+    schema = []
+    for column in df.columns:
+        if column in types:
+            schema.append(pa.field(column, types[column]))
+            continue
+        try:
+            inferred = pa.array(df[column], from_pandas=True).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            inferred = pa.string()
+        schema.append(pa.field(column, pa.string() if inferred == pa.null() else inferred))
+    return pa.schema(schema)
+
+
+def max_date_modified(values: pd.Series, current=None):
+    """
+    Highest epoch-millisecond DATEMODIFIED in values, or current if that is higher (None when there is none).
+    """
+    value = pd.to_numeric(values, errors="coerce").max()
+    if pd.isna(value):
+        return current
+    return value if current is None else max(current, value)
+
+
+class TableSink:
+    """
+    File a table is appended to page by page, written aside and swapped in on close().
+    CSV pages are appended to the file itself. Parquet pages are appended to an Arrow IPC stream, which is converted to Parquet on close():
+    unlike a Parquet file without its footer, the stream of an interrupted run can be cut at any page boundary (offset) and appended to again.
+    Dictionary columns (decoded domains) are staged as their values, the schema of the table is kept in the metadata of the stream.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        self.parquet = path.endswith(".parquet")
+        self.schema = None
+        self.stream_schema = None
+        # Bytes of the pages appended so far.
+        self.offset = 0
+
+    def append(self, data):
+        """
+        Append a page, a pd.DataFrame for CSV or a pa.Table for Parquet.
+        """
+        if self.offset == 0:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self.parquet:
+            if self.offset == 0:
+                self.schema = data.schema
+                self.stream_schema = pa.schema(
+                    [
+                        pa.field(
+                            field.name,
+                            field.type.value_type
+                            if pa.types.is_dictionary(field.type)
+                            else field.type,
+                        )
+                        for field in self.schema
+                    ],
+                    metadata={b"table_schema": self.schema.serialize().to_pybytes()},
+                )
+            with open(self.tmp_path, "ab" if self.offset else "wb") as stream:
+                if self.offset == 0:
+                    stream.write(self.stream_schema.serialize())
+                for batch in data.cast(self.stream_schema).to_batches():
+                    stream.write(batch.serialize())
+                self.offset = stream.tell()
+        else:
+            text_cells(data).to_csv(
+                self.tmp_path,
+                index=False,
+                header=self.offset == 0,
+                mode="a" if self.offset else "w",
+            )
+            self.offset = os.path.getsize(self.tmp_path)
+
+    def checkpoint(self):
+        return {"tmp_path": self.tmp_path, "offset": self.offset}
+
+    @staticmethod
+    def resumable(state: dict):
+        """
+        Whether the file of a checkpoint() is still there with all its pages.
+        """
+        return state["offset"] == 0 or (
+            os.path.exists(state["tmp_path"])
+            and os.path.getsize(state["tmp_path"]) >= state["offset"]
+        )
+
+    def resume(self, state: dict):
+        """
+        Continue the file of a checkpoint(), cutting whatever was appended after it.
+        """
+        self.tmp_path = state["tmp_path"]
+        self.offset = state["offset"]
+        if self.offset == 0:
+            return
+        os.truncate(self.tmp_path, self.offset)
+        if self.parquet:
+            self.stream_schema = pa.ipc.open_stream(self.tmp_path).schema
+            self.schema = pa.ipc.read_schema(
+                pa.py_buffer(self.stream_schema.metadata[b"table_schema"])
+            )
+
+    def read(self):
+        """
+        Returns:
+            df (pd.DataFrame): Rows appended so far.
+        """
+        if self.offset == 0:
+            return pd.DataFrame()
+        if self.parquet:
+            return (
+                pa.ipc.open_stream(self.tmp_path)
+                .read_all()
+                .cast(self.schema)
+                .to_pandas()
+            )
+        return pd.read_csv(self.tmp_path)
+
+    def close(self):
+        """
+        Swap the file in, if anything was appended.
+        """
+        if self.offset == 0:
+            return
+        if self.parquet:
+            parquet_path = f"{self.tmp_path}.parquet"
+            with pa.ipc.open_stream(self.tmp_path) as reader:
+                with pq.ParquetWriter(parquet_path, self.schema) as parquet_writer:
+                    # One row group per page, like the pages were appended.
+                    for batch in reader:
+                        parquet_writer.write_table(
+                            pa.Table.from_batches([batch]).cast(self.schema)
+                        )
+            os.remove(self.tmp_path)
+            os.replace(parquet_path, self.path)
+        else:
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self, keep: bool = False):
+        """
+        Remove the file, unless keep (to resume() it later).
+        """
+        if not keep and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class FeatureWriter:
+    """
+    Write the pages of a layer to its features file as they arrive, so only one page is held in memory at a time.
+    The file is written aside and swapped in on close(), so a reader never sees a half written layer and aliased MapServices writing the same layer do not interleave.
+    The format (CSV or Parquet) is taken from the extension of path.
+    checkpoint() records how far the file is written, so an interrupted run can resume() it instead of fetching the layer again.
+
+    Usage:
+        writer = FeatureWriter(path)
+        for page in pages:
+            writer.write(page)
+        writer.close()
+    """
+
+    def __init__(self, path: str, key: str = None):
+        """
+        Args:
+            path (str): Path of the features file.
+            key (str, optional): Layer key the normalize / write spans are recorded under. Defaults to None.
+        """
+        self.path = path
+        self.key = key
+        self.sink = TableSink(path)
+        self.parquet = self.sink.parquet
+        self.columns = None
+        self.schema = None
+        self.rows = 0
+        self.high_water_mark = None
+
+    def write(self, page: dict):
+        """
+        Normalise the features of a query response and append them to the file.
+
+        Args:
+            page (dict): Query response with "features" (and "fields"/"geometryType" to fix the columns).
+
+        Returns:
+            df (pd.DataFrame): Features of the page as written, with the columns of the file.
+        """
+        with telemetry.span("normalize", self.key) as span:
+            df = pd.json_normalize(page["features"])
+            span["rows"] = len(df)
+        return self.write_frame(df, page)
+
+    def write_frame(self, df: pd.DataFrame, page: dict):
+        """
+        Append features that are already normalised.
+
+        Args:
+            df (pd.DataFrame): Normalised features.
+            page (dict): Query response (or just its "fields"/"geometryType") the features come from.
+
+        Returns:
+            df (pd.DataFrame): df with the columns of the file.
+        """
+        with telemetry.span("write", self.key) as span:
+            span["rows"] = len(df)
+            return self._write_frame(df, page)
+
+    def _write_frame(self, df: pd.DataFrame, page: dict):
+        first_page = self.columns is None
+        if first_page:
+            self.columns = list(df.columns) + [
+                column for column in feature_columns(page) if column not in df.columns
+            ]
+        df = df.reindex(columns=self.columns)
+
+        if self.parquet:
+            if first_page:
+                self.schema = feature_schema(page, df)
+            self.sink.append(
+                pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            )
+        else:
+            self.sink.append(df)
+        self.rows += len(df)
+        if "attributes.DATEMODIFIED" in df.columns:
+            self.high_water_mark = max_date_modified(
+                df["attributes.DATEMODIFIED"], self.high_water_mark
+            )
+        return df
+
+    def checkpoint(self):
+        """
+        State of the writer after the pages written so far, from which resume() continues the file in another run.
+
+        Returns:
+            state (dict): File, offset, columns, rows and high-water mark written, and tmp_paths (the files to remove if the run is not resumed).
+        """
+        return dict(
+            self.sink.checkpoint(),
+            columns=self.columns,
+            rows=self.rows,
+            high_water_mark=(
+                None if self.high_water_mark is None else float(self.high_water_mark)
+            ),
+            tmp_paths=[self.sink.tmp_path],
+        )
+
+    def resumable(self, state: dict):
+        return TableSink.resumable(state)
+
+    def resume(self, state: dict):
+        """
+        Continue the file of an interrupted run from its checkpoint(), see resumable().
+        """
+        self.sink.resume(state)
+        if state["offset"]:
+            self.columns = state["columns"]
+            self.schema = self.sink.schema
+            self.rows = state["rows"]
+            self.high_water_mark = state["high_water_mark"]
+
+    def close(self):
+        if self.columns is None:
+            write_table(pd.DataFrame(), self.path)
+            return
+        self.sink.close()
+
+    def abort(self, keep: bool = False):
+        """
+        Drop the file written so far, unless keep (a journaled run resumes it).
+        """
+        self.sink.abort(keep)